@@ -0,0 +1,283 @@
+"""Микробенчмарки хелперов доступа к данным vpn_bot_with_cryptobot на синтетических базах.
+
+Для каждого масштаба строится (и кэшируется в --db-dir) база с N пользователями и пропорциональным
+числом конфигов, заказов, платежей и промокодов. Каждый прогон идёт на копии базы, поэтому
+изменяющие хелперы (update_balance, create_order, redeem_promo_code) не портят кэш.
+Результат — JSON для сравнения версий хранилища (см. --output).
+
+Примеры:
+    python benchmark.py --scales 10k,100k --output bench_results.json
+    python benchmark.py --scales 1M --iterations 500 --only get_balance,get_user_orders
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import random
+import shutil
+import sqlite3
+import subprocess
+import sys
+import time
+from datetime import datetime, timedelta
+
+DEFAULT_DB_DIR = "bench_data"
+
+# Модуль бота: импортируется в main(), когда окружение для него уже настроено
+bot = None
+
+PAYMENT_TYPES = ('topup', 'purchase')
+PAYMENT_STATUSES = ('paid', 'paid', 'pending', 'expired')
+
+
+def parse_scale(text):
+    text = text.strip().lower()
+    multiplier = 1
+    if text.endswith('k'):
+        multiplier, text = 1000, text[:-1]
+    elif text.endswith('m'):
+        multiplier, text = 1000000, text[:-1]
+    return int(float(text) * multiplier)
+
+
+# Пропорции таблиц относительно числа пользователей
+def table_sizes(users):
+    return {
+        'users': users,
+        'configs': users,
+        'orders': users,
+        'payments': users * 2,
+        'promo_codes': max(users // 10, 10),
+        'promo_activations': users // 10,
+    }
+
+
+# Синтетическая база: схема и индексы из init_db, данные — одной транзакцией через executemany
+def build_database(path, users, seed):
+    for suffix in ('', '-wal', '-shm', '-journal'):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+    bot.DB_PATH = path
+    bot.init_db()
+    sizes = table_sizes(users)
+    rng = random.Random(seed)
+    countries = list(bot.COUNTRIES)
+    plans = {plan[0]: plan[2] for plan in bot.get_plans()}  # id -> длительность в месяцах
+    plan_ids = list(plans)
+    now = datetime.now()
+    conn = sqlite3.connect(path)
+    conn.execute("PRAGMA journal_mode = OFF")
+    conn.execute("PRAGMA synchronous = OFF")
+    cursor = conn.cursor()
+    cursor.executemany(
+        "INSERT INTO users (user_id, username, first_name, balance) VALUES (?, ?, ?, ?)",
+        ((user_id, f"user{user_id}", f"User {user_id}", round(rng.random() * 20, 2))
+         for user_id in range(1, users + 1))
+    )
+    # Половина конфигов уже выдана — как в живой базе
+    cursor.executemany(
+        "INSERT INTO configs (id, plan_id, country, config, is_used) VALUES (?, ?, ?, ?, ?)",
+        ((config_id, rng.choice(plan_ids), rng.choice(countries), f"vless://bench-{config_id}@example.com:443",
+          config_id <= sizes['configs'] // 2)
+         for config_id in range(1, sizes['configs'] + 1))
+    )
+
+    def orders():
+        for order_id in range(1, sizes['orders'] + 1):
+            plan_id = rng.choice(plan_ids)
+            order_date = now - timedelta(days=rng.randint(0, 365), seconds=rng.randint(0, 86400))
+            expiry_date = order_date + timedelta(days=plans[plan_id] * 30)
+            yield (order_id, rng.randint(1, users), plan_id, rng.randint(1, sizes['configs'] // 2),
+                   order_date.strftime('%Y-%m-%d %H:%M:%S'), str(expiry_date))
+    cursor.executemany(
+        "INSERT INTO orders (id, user_id, plan_id, config_id, order_date, expiry_date) VALUES (?, ?, ?, ?, ?, ?)",
+        orders()
+    )
+
+    def payments():
+        for payment_id in range(1, sizes['payments'] + 1):
+            payment_type = rng.choice(PAYMENT_TYPES)
+            created_at = now - timedelta(days=rng.randint(0, 365), seconds=rng.randint(0, 86400))
+            yield (payment_id, rng.randint(1, users), payment_type,
+                   rng.choice(plan_ids) if payment_type == 'purchase' else None,
+                   round(rng.uniform(1, 50), 2), f"bench-{payment_id}", rng.choice(PAYMENT_STATUSES),
+                   created_at.strftime('%Y-%m-%d %H:%M:%S'))
+    cursor.executemany(
+        "INSERT INTO payments (id, user_id, type, plan_id, amount, invoice_id, status, created_at) "
+        "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+        payments()
+    )
+    cursor.executemany(
+        "INSERT INTO promo_codes (code, amount, max_activations, used_activations, expires_at, is_active) "
+        "VALUES (?, ?, ?, ?, ?, ?)",
+        ((f"BENCH{index:07d}", 1.0, 1000000, 0, None, 1) for index in range(sizes['promo_codes']))
+    )
+    # Активации: разные пары (код, пользователь) — уникальный индекс не даёт повторов
+    cursor.executemany(
+        "INSERT INTO promo_activations (code, user_id) VALUES (?, ?)",
+        ((f"BENCH{index % sizes['promo_codes']:07d}", index + 1) for index in range(sizes['promo_activations']))
+    )
+    conn.commit()
+    conn.execute("ANALYZE")
+    conn.close()
+    return sizes
+
+
+# Хелперы и генераторы их аргументов: каждый элемент — (имя, функция от rng)
+def helper_cases(users, sizes):
+    countries = list(bot.COUNTRIES)
+    plan_ids = [plan[0] for plan in bot.get_plans()]
+    promo_codes = sizes['promo_codes']
+    new_promo = iter(range(10 ** 9))
+
+    def user(rng):
+        return rng.randint(1, users)
+
+    return [
+        ("get_balance", lambda rng: bot.get_balance(user(rng))),
+        ("update_balance", lambda rng: bot.update_balance(user(rng), 1.0)),
+        ("claim_config_order", lambda rng: bot.claim_config_order(user(rng), rng.choice(plan_ids), rng.choice(countries), 1)),
+        ("purchase_with_balance", lambda rng: bot.purchase_with_balance(user(rng), rng.choice(plan_ids), rng.choice(countries), 1.0, 1)),
+        ("create_order", lambda rng: bot.create_order(user(rng), rng.choice(plan_ids), rng.randint(1, sizes['configs']), 1)),
+        ("get_user_orders", lambda rng: bot.get_user_orders(user(rng))),
+        ("get_user_orders_page", lambda rng: bot.get_user_orders_page(user(rng))),
+        ("get_expiring_orders", lambda rng: bot.get_expiring_orders(datetime.now(), datetime.now() + timedelta(days=3), 3,
+                                                                    bot.REMINDER_BATCH_SIZE)),
+        ("get_renewable_orders", lambda rng: bot.get_renewable_orders(datetime.now(), 0, datetime.now() + timedelta(days=1),
+                                                                      bot.RENEW_BATCH_SIZE)),
+        ("get_configs_stats", lambda rng: bot.get_configs_stats()),
+        ("get_payment", lambda rng: bot.get_payment(f"bench-{rng.randint(1, sizes['payments'])}")),
+        ("get_user_payments_page", lambda rng: bot.get_user_payments_page(user(rng))),
+        ("get_payments_page", lambda rng: bot.get_payments_page()),
+        ("search_users", lambda rng: bot.search_users(f"user{user(rng)}")),
+        ("get_promo_code", lambda rng: bot.get_promo_code(f"BENCH{rng.randrange(promo_codes):07d}")),
+        ("redeem_promo_code", lambda rng: bot.redeem_promo_code(f"BENCH{rng.randrange(promo_codes):07d}", user(rng))),
+        ("create_promo_code", lambda rng: bot.create_promo_code(f"NEW{next(new_promo):09d}", 1.0)),
+        ("get_promo_codes_page", lambda rng: bot.get_promo_codes_page()),
+        ("get_admin_stats", lambda rng: bot.get_admin_stats()),
+    ]
+
+
+def summarize(samples):
+    samples = sorted(samples)
+    count = len(samples)
+
+    def percentile(q):
+        return samples[min(count - 1, int(q * count))]
+    total = sum(samples)
+    return {
+        'iterations': count,
+        'mean_us': round(total / count * 1e6, 1),
+        'p50_us': round(percentile(0.5) * 1e6, 1),
+        'p95_us': round(percentile(0.95) * 1e6, 1),
+        'p99_us': round(percentile(0.99) * 1e6, 1),
+        'min_us': round(samples[0] * 1e6, 1),
+        'max_us': round(samples[-1] * 1e6, 1),
+        'ops_per_sec': round(count / total, 1) if total else None,
+    }
+
+
+def run_case(func, iterations, warmup, seed):
+    rng = random.Random(seed)
+    for _ in range(warmup):
+        func(rng)
+    samples = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        func(rng)
+        samples.append(time.perf_counter() - start)
+    return summarize(samples)
+
+
+def benchmark_scale(users, args):
+    base_path = os.path.join(args.db_dir, f"bench_{users}.db")
+    sizes = table_sizes(users)
+    build_seconds = None
+    if args.rebuild or not os.path.exists(base_path):
+        print(f"Сборка базы на {users} пользователей: {base_path}", file=sys.stderr)
+        start = time.perf_counter()
+        sizes = build_database(base_path, users, args.seed)
+        build_seconds = round(time.perf_counter() - start, 2)
+    work_path = os.path.join(args.db_dir, f"bench_{users}.work.db")
+    shutil.copyfile(base_path, work_path)
+    bot.DB_PATH = work_path
+    results = {}
+    try:
+        for name, func in helper_cases(users, sizes):
+            if args.only and name not in args.only:
+                continue
+            results[name] = run_case(func, args.iterations, args.warmup, args.seed)
+            print(f"  {users:>8} {name:<40} p50 {results[name]['p50_us']:>9} мкс  "
+                  f"p95 {results[name]['p95_us']:>9} мкс", file=sys.stderr)
+    finally:
+        os.remove(work_path)
+    return {
+        'rows': sizes,
+        'db_size_bytes': os.path.getsize(base_path),
+        'build_seconds': build_seconds,
+        'helpers': results,
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарки хелперов БД на синтетических базах")
+    parser.add_argument('--scales', default="10k,100k,1M", help="число пользователей через запятую (10k, 100k, 1M)")
+    parser.add_argument('--iterations', type=int, default=200, help="замеров на хелпер")
+    parser.add_argument('--warmup', type=int, default=20, help="прогревочных вызовов на хелпер")
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--db-dir', default=DEFAULT_DB_DIR, help="где хранить синтетические базы")
+    parser.add_argument('--rebuild', action='store_true', help="пересобрать базы, даже если они есть")
+    parser.add_argument('--only', default="", help="только эти хелперы (через запятую)")
+    parser.add_argument('--output', default="-", help="файл для JSON с результатами ('-' — stdout)")
+    args = parser.parse_args()
+    args.only = {name.strip() for name in args.only.split(',') if name.strip()}
+    os.makedirs(args.db_dir, exist_ok=True)
+
+    # Окружение для импорта бота без .env: токены не используются, лог — рядом с синтетическими базами
+    os.environ.setdefault("BOT_TOKEN", "0:benchmark")
+    os.environ.setdefault("ADMIN_ID", "0")
+    os.environ.setdefault("CRYPTO_BOT_TOKEN", "benchmark")
+    os.environ.setdefault("LOG_FILE", os.path.join(args.db_dir, "benchmark.log"))
+    global bot
+    import vpn_bot_with_cryptobot as bot
+
+    # Меряем доступ к данным: без логов хелперов и без EXPLAIN для «медленных» запросов
+    logging.getLogger().setLevel(logging.WARNING)
+    bot.SLOW_QUERY_MS = float('inf')
+
+    report = {
+        'meta': {
+            'timestamp': datetime.now().isoformat(timespec='seconds'),
+            'git_commit': git_commit(),
+            'python': platform.python_version(),
+            'sqlite': sqlite3.sqlite_version,
+            'platform': platform.platform(),
+            'iterations': args.iterations,
+            'warmup': args.warmup,
+            'seed': args.seed,
+        },
+        'scales': {},
+    }
+    for users in (parse_scale(scale) for scale in args.scales.split(',')):
+        report['scales'][str(users)] = benchmark_scale(users, args)
+
+    if args.output == '-':
+        json.dump(report, sys.stdout, ensure_ascii=False, indent=2)
+        print()
+    else:
+        with open(args.output, 'w', encoding='utf-8') as output:
+            json.dump(report, output, ensure_ascii=False, indent=2)
+        print(f"Результаты записаны в {args.output}", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
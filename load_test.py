@@ -0,0 +1,626 @@
+"""Сквозной нагрузочный тест: настоящие обработчики бота, офлайн Telegram и локальные CryptoBot/CrystalPAY.
+
+Апдейты идут через application.update_queue, как при polling, поэтому учитывается и очередь
+(concurrent_updates), и сами обработчики. Вызовы Bot API перехватывает FakeTelegramRequest,
+платёжные провайдеры — HTTP-серверы в отдельном потоке с настраиваемыми задержкой и долей ошибок.
+Виртуальные пользователи нажимают кнопки из последнего присланного им сообщения: смотрят меню,
+пополняют баланс через CryptoBot и CrystalPAY (иногда нажимая «Проверить» дважды), платят звёздами
+(иногда Telegram доставляет successful_payment повторно) и покупают VPN с баланса.
+
+В конце сверяются инварианты: каждое пополнение зачислено ровно один раз, баланс не ушёл в минус
+и сходится с зачислениями минус покупки, ни один конфиг не выдан дважды.
+
+Пример:
+    python load_test.py --users 2000 --duration 60 --provider-latency 0.2 --provider-failure-rate 0.05
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import re
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+# Окружение для импорта бота: своя база и лог, токены не используются
+WORK_DIR = tempfile.mkdtemp(prefix="vpn_bot_load_")
+os.environ.setdefault("BOT_TOKEN", "123456:load-test")
+os.environ.setdefault("ADMIN_ID", "1")
+os.environ.setdefault("CRYPTO_BOT_TOKEN", "load-test")
+os.environ["DB_PATH"] = os.path.join(WORK_DIR, "load_test.db")
+os.environ.setdefault("LOG_FILE", os.path.join(WORK_DIR, "load_test.log"))
+os.environ.setdefault("METRICS_PORT", "0")
+os.environ["UPDATE_RECORD_FILE"] = ""
+
+from telegram import Update  # noqa: E402
+from telegram.ext import Application  # noqa: E402
+from telegram.request import BaseRequest  # noqa: E402
+
+import vpn_bot_with_cryptobot as bot  # noqa: E402
+
+CONFIG_RE = re.compile(r'vless://load-(\d+)@')
+BOT_USER = {"id": 123456, "is_bot": True, "first_name": "LoadTest", "username": "load_test_bot"}
+
+
+def percentiles(samples):
+    if not samples:
+        return {'count': 0}
+    samples = sorted(samples)
+
+    def pick(q):
+        return round(samples[min(len(samples) - 1, int(q * len(samples)))] * 1000, 1)
+    return {'count': len(samples), 'p50_ms': pick(0.5), 'p95_ms': pick(0.95), 'p99_ms': pick(0.99),
+            'max_ms': round(samples[-1] * 1000, 1)}
+
+
+class FakeTelegram:
+    """Состояние «серверов Telegram»: последнее сообщение и клавиатура в каждом чате, выданные конфиги."""
+
+    def __init__(self, latency, failure_rate, seed):
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.rng = random.Random(seed)
+        self.chats = {}  # chat_id -> {'message_id', 'text', 'markup'}
+        self.calls = {}
+        self.failures = 0
+        self.deliveries = {}  # id конфига -> [chat_id, ...]
+        self.next_message_id = 1
+
+    def chat(self, chat_id):
+        return self.chats.setdefault(int(chat_id), {'message_id': 0, 'text': '', 'markup': None})
+
+    def handle(self, method, params):
+        self.calls[method] = self.calls.get(method, 0) + 1
+        if method == 'getMe':
+            return dict(BOT_USER, can_join_groups=False, can_read_all_group_messages=False,
+                        supports_inline_queries=False)
+        if method == 'getChatMember':
+            return {"status": "member", "user": {"id": int(params['user_id']), "is_bot": False, "first_name": "U"}}
+        if method in ('sendMessage', 'editMessageText', 'sendInvoice', 'sendDocument'):
+            chat_id = int(params.get('chat_id', 0))
+            chat = self.chat(chat_id)
+            text = params.get('text') or params.get('title') or ''
+            for config_id in CONFIG_RE.findall(text):
+                self.deliveries.setdefault(int(config_id), []).append(chat_id)
+            markup = params.get('reply_markup')
+            if isinstance(markup, str):
+                markup = json.loads(markup)
+            if method == 'editMessageText':
+                message_id = int(params.get('message_id', chat['message_id']))
+            else:
+                self.next_message_id += 1
+                message_id = self.next_message_id
+            chat.update(message_id=message_id, text=text, markup=markup)
+            return {"message_id": message_id, "date": int(time.time()), "text": text,
+                    "chat": {"id": chat_id, "type": "private"}, "from": BOT_USER}
+        return True
+
+
+class FakeTelegramRequest(BaseRequest):
+    """Транспорт Bot API без сети: отвечает из FakeTelegram с заданной задержкой."""
+
+    def __init__(self, telegram):
+        self.telegram = telegram
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None, write_timeout=None,
+                         connect_timeout=None, pool_timeout=None):
+        endpoint = url.rsplit('/', 1)[-1]
+        if self.telegram.latency:
+            await asyncio.sleep(self.telegram.rng.uniform(0.5, 1.5) * self.telegram.latency)
+        if endpoint != 'getMe' and self.telegram.rng.random() < self.telegram.failure_rate:
+            self.telegram.failures += 1
+            return 500, json.dumps({"ok": False, "error_code": 500, "description": "Internal Server Error"}).encode()
+        params = request_data.parameters if request_data else {}
+        result = self.telegram.handle(endpoint, params)
+        return 200, json.dumps({"ok": True, "result": result}).encode()
+
+
+class FakeProviders:
+    """CryptoBot и CrystalPAY на локальном HTTP-сервере (в своём потоке: бот ходит к ним синхронно)."""
+
+    def __init__(self, latency, failure_rate, seed, auto_pay=False):
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.rng = random.Random(seed)
+        self.auto_pay = auto_pay  # счета сразу оплачены (для replay, где пользователей не симулируем)
+        self.lock = threading.Lock()
+        self.invoices = {}  # внешний id -> {'provider', 'internal_id', 'paid'}
+        self.next_id = 1000
+        self.calls = {}
+        self.failures = 0
+        self.server = None
+
+    def start(self):
+        providers = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                self.respond(parse_qs(urlparse(self.path).query))
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get('Content-Length', 0))).decode()
+                if self.headers.get('Content-Type', '').startswith('application/json'):
+                    params = json.loads(body or '{}')
+                else:
+                    params = {key: values[0] for key, values in parse_qs(body).items()}
+                self.respond(params)
+
+            def respond(self, params):
+                status, payload = providers.handle(urlparse(self.path).path, params)
+                data = json.dumps(payload).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, name="fake-providers", daemon=True).start()
+        base = f"http://127.0.0.1:{self.server.server_address[1]}"
+        bot.CRYPTO_BOT_API_URL = f"{base}/cryptobot/api"
+        bot.CRYSTAL_PAY_API_URL = f"{base}/crystalpay/v2"
+
+    def stop(self):
+        if self.server:
+            self.server.shutdown()
+
+    def handle(self, path, params):
+        endpoint = path.rstrip('/').rsplit('/', 2)
+        name = f"{endpoint[-2]}/{endpoint[-1]}" if path.startswith('/crystalpay') else endpoint[-1]
+        with self.lock:
+            self.calls[name] = self.calls.get(name, 0) + 1
+            fail = self.rng.random() < self.failure_rate
+            delay = self.rng.uniform(0.5, 1.5) * self.latency
+        if delay:
+            time.sleep(delay)
+        if fail:
+            with self.lock:
+                self.failures += 1
+            return 500, {"error": "internal"}
+        with self.lock:
+            if name == 'createInvoice':
+                self.next_id += 1
+                payload = params.get('payload') or '{}'
+                self.invoices[str(self.next_id)] = {
+                    'provider': 'cryptobot', 'internal_id': json.loads(payload).get('invoice_id'),
+                    'payload': payload, 'amount': params.get('amount'), 'paid': self.auto_pay,
+                }
+                return 200, {"ok": True, "result": {"invoice_id": self.next_id, "status": "active",
+                                                    "pay_url": f"https://t.me/CryptoBot?start=IV{self.next_id}"}}
+            if name == 'getInvoices':
+                ids = params.get('invoice_ids', [''])
+                ids = str(ids[0] if isinstance(ids, list) else ids).split(',')
+                return 200, {"ok": True, "result": {"items": [{
+                    "invoice_id": int(invoice_id), "status": "paid" if invoice['paid'] else "active",
+                    "payload": invoice['payload'], "amount": invoice['amount'],
+                } for invoice_id, invoice in ((i, self.invoices.get(i)) for i in ids) if invoice is not None]}}
+            if name == 'invoice/create':
+                self.next_id += 1
+                crystal_id = f"cp{self.next_id}"
+                self.invoices[crystal_id] = {'provider': 'crystalpay', 'internal_id': params.get('extra'),
+                                             'paid': self.auto_pay}
+                return 200, {"error": False, "errors": [], "id": crystal_id,
+                             "url": f"https://pay.crystalpay.io/?i={crystal_id}"}
+            if name == 'invoice/info':
+                invoice = self.invoices.get(str(params.get('id')))
+                if invoice is None:
+                    return 200, {"error": True, "errors": ["Invoice not found"]}
+                return 200, {"error": False, "errors": [], "state": "payed" if invoice['paid'] else "notpayed"}
+        return 404, {"error": "unknown method"}
+
+    # Пользователь оплатил счёт по ссылке из кнопки «Оплатить»
+    def pay(self, url):
+        match = re.search(r'(?:start=IV|\?i=)(\w+)', url or '')
+        if not match:
+            return False
+        with self.lock:
+            invoice = self.invoices.get(match.group(1))
+            if invoice is None:
+                return False
+            invoice['paid'] = True
+        return True
+
+
+class LoadTestApplication(bot.TracedApplication):
+    """Сообщает харнессу о завершении каждого апдейта и измеряет время обработки (без ожидания в очереди)."""
+
+    harness = None
+
+    async def process_update(self, update):
+        start = time.perf_counter()
+        try:
+            await super().process_update(update)
+        finally:
+            self.harness.completed(update, time.perf_counter() - start)
+
+
+class Harness:
+    def __init__(self, args):
+        self.args = args
+        self.rng = random.Random(args.seed)
+        self.telegram = FakeTelegram(args.telegram_latency, args.telegram_failure_rate, args.seed)
+        self.providers = FakeProviders(args.provider_latency, args.provider_failure_rate, args.seed + 1)
+        self.application = None
+        self.next_update_id = 1
+        self.waiters = {}  # update_id -> [Future, ...]
+        self.latencies = []  # от постановки в очередь до завершения
+        self.service_times = []  # только обработка
+        self.step_latencies = {}
+        self.updates_sent = 0
+        self.stars_credits = {}  # user_id -> сумма уникальных Stars-пополнений, USDT
+        self.scenarios = {}
+        self.handler_errors = 0
+        self.deadline = float('inf')
+
+    def completed(self, update, service_time):
+        self.service_times.append(service_time)
+        for future in self.waiters.pop(update.update_id, []):
+            if not future.done():
+                future.set_result(None)
+
+    async def send(self, payload, step):
+        # После окончания теста пользователи не начинают новых действий, незавершённые сценарии обрываются
+        if time.perf_counter() >= self.deadline:
+            return None
+        update_id = payload.get('update_id')
+        if update_id is None:
+            update_id = payload['update_id'] = self.next_update_id
+            self.next_update_id += 1
+        future = asyncio.get_running_loop().create_future()
+        self.waiters.setdefault(update_id, []).append(future)
+        start = time.perf_counter()
+        await self.application.update_queue.put(Update.de_json(payload, self.application.bot))
+        self.updates_sent += 1
+        await future
+        elapsed = time.perf_counter() - start
+        self.latencies.append(elapsed)
+        self.step_latencies.setdefault(step, []).append(elapsed)
+        return payload
+
+    def setup_database(self):
+        bot.init_db()
+        conn = bot.db_connect()
+        plans = [plan[0] for plan in bot.get_plans()]
+        rows = []
+        config_id = 0
+        for plan_id in plans:
+            for country in bot.COUNTRIES:
+                for _ in range(self.args.configs_per_slot):
+                    config_id += 1
+                    rows.append((config_id, plan_id, country, f"vless://load-{config_id}@example.com:443"))
+        conn.executemany("INSERT INTO configs (id, plan_id, country, config) VALUES (?, ?, ?, ?)", rows)
+        # Стартовый баланс, чтобы покупки с баланса шли и без предварительного пополнения
+        conn.executemany("INSERT INTO users (user_id, username, first_name, balance) VALUES (?, ?, ?, ?)",
+                         ((user_id, f"load{user_id}", f"Load{user_id}", self.args.initial_balance)
+                          for user_id in self.user_ids()))
+        conn.commit()
+        conn.close()
+
+    def user_ids(self):
+        return range(10_000_000, 10_000_000 + self.args.users)
+
+    def instrument(self):
+        harness = self
+
+        class ErrorCounter(logging.Handler):
+            def emit(self, record):
+                harness.handler_errors += 1
+        counter = ErrorCounter(level=logging.ERROR)
+        logging.getLogger().addHandler(counter)
+
+    async def run(self):
+        args = self.args
+        self.setup_database()
+        self.instrument()
+        self.providers.start()
+        request = FakeTelegramRequest(self.telegram)
+        builder = (
+            Application.builder()
+            .token(os.environ["BOT_TOKEN"])
+            .application_class(LoadTestApplication)
+            .request(request)
+            .get_updates_request(FakeTelegramRequest(self.telegram))
+            .concurrent_updates(args.concurrent_updates or False)
+        )
+        if not args.no_persistence:
+            builder = builder.persistence(bot.DatabasePersistence(update_interval=bot.PERSISTENCE_FLUSH_INTERVAL))
+        self.application = builder.build()
+        LoadTestApplication.harness = self
+        bot.register_handlers(self.application)
+        await self.application.initialize()
+        await self.application.start()
+        started = time.perf_counter()
+        self.deadline = started + args.duration
+        try:
+            users = [VirtualUser(self, user_id, random.Random(args.seed * 1000 + index))
+                     for index, user_id in enumerate(self.user_ids())]
+            # Пользователи приходят не одновременно, а в течение ramp-up
+            await asyncio.gather(*(user.run(args.ramp_up * index / max(args.users, 1))
+                                   for index, user in enumerate(users)))
+            elapsed = time.perf_counter() - started
+        finally:
+            await self.application.stop()
+            await self.application.shutdown()
+            self.providers.stop()
+        return self.report(elapsed)
+
+    def anomalies(self):
+        conn = bot.db_connect()
+        cursor = conn.cursor()
+        # Пополнения через провайдеров; Stars сверяются с тем, что harness действительно отправил
+        cursor.execute("""
+            SELECT user_id, COALESCE(SUM(amount), 0) FROM payments
+            WHERE type = 'topup' AND status = 'paid' AND invoice_id NOT LIKE 'stars:%'
+            GROUP BY user_id
+        """)
+        paid_topups = dict(cursor.fetchall())
+        cursor.execute("""
+            SELECT o.user_id, COALESCE(SUM(p.price), 0) FROM orders o JOIN plans p ON o.plan_id = p.id GROUP BY o.user_id
+        """)
+        spent = dict(cursor.fetchall())
+        cursor.execute("SELECT user_id, balance FROM users WHERE user_id >= 10000000")
+        balances = dict(cursor.fetchall())
+        cursor.execute("SELECT config_id, COUNT(*) FROM orders GROUP BY config_id HAVING COUNT(*) > 1")
+        shared_configs = cursor.fetchall()
+        conn.close()
+
+        double_credit = []
+        balance_mismatch = []
+        for user_id, balance in balances.items():
+            expected = paid_topups.get(user_id, 0.0) + self.stars_credits.get(user_id, 0.0)
+            # Сколько реально зачислено: остаток минус стартовый баланс плюс потраченное на заказы
+            credited = balance - self.args.initial_balance + spent.get(user_id, 0.0)
+            if credited - expected > 0.005:
+                double_credit.append({'user_id': user_id, 'credited': round(credited, 2), 'expected': round(expected, 2)})
+            elif expected - credited > 0.005:
+                balance_mismatch.append({'user_id': user_id, 'balance': round(balance, 2),
+                                         'expected': round(balance + expected - credited, 2)})
+        duplicate_deliveries = {config_id: chats for config_id, chats in self.telegram.deliveries.items() if len(chats) > 1}
+        return {
+            'double_credit_users': len(double_credit),
+            'over_credited_usdt': round(sum(item['credited'] - item['expected'] for item in double_credit), 2),
+            'double_credit_examples': double_credit[:10],
+            'negative_balances': sum(1 for balance in balances.values() if balance < -0.005),
+            'balance_mismatches': len(balance_mismatch),
+            'balance_mismatch_examples': balance_mismatch[:10],
+            'configs_in_multiple_orders': len(shared_configs),
+            'duplicate_config_deliveries': len(duplicate_deliveries),
+            'duplicate_delivery_examples': [{'config_id': config_id, 'chats': chats}
+                                            for config_id, chats in list(duplicate_deliveries.items())[:10]],
+            'handler_errors_logged': self.handler_errors,
+        }
+
+    def report(self, elapsed):
+        args = self.args
+        return {
+            'config': {key: value for key, value in vars(args).items() if key != 'output'},
+            'elapsed_s': round(elapsed, 2),
+            'updates': self.updates_sent,
+            'throughput_per_s': round(self.updates_sent / elapsed, 1) if elapsed else None,
+            'latency': percentiles(self.latencies),
+            'service_time': percentiles(self.service_times),
+            'steps': {step: percentiles(samples) for step, samples in sorted(self.step_latencies.items())},
+            'scenarios': self.scenarios,
+            'telegram': {'calls': self.telegram.calls, 'injected_failures': self.telegram.failures},
+            'providers': {'calls': self.providers.calls, 'injected_failures': self.providers.failures,
+                          'invoices': len(self.providers.invoices),
+                          'paid': sum(1 for invoice in self.providers.invoices.values() if invoice['paid'])},
+            'anomalies': self.anomalies(),
+        }
+
+
+class VirtualUser:
+    """Пользователь, который ходит по кнопкам из последнего сообщения бота."""
+
+    def __init__(self, harness, user_id, rng):
+        self.harness = harness
+        self.user_id = user_id
+        self.rng = rng
+        self.user = {"id": user_id, "is_bot": False, "first_name": f"Load{user_id}", "username": f"load{user_id}"}
+
+    async def run(self, delay):
+        await asyncio.sleep(delay)
+        scenarios = [
+            (self.browse, 5), (self.topup_cryptobot, 2), (self.topup_crystalpay, 1),
+            (self.topup_stars, 1), (self.buy_with_balance, 2),
+        ]
+        await self.command("/start")
+        while time.perf_counter() < self.harness.deadline:
+            scenario = self.rng.choices([item[0] for item in scenarios], [item[1] for item in scenarios])[0]
+            name = scenario.__name__
+            counts = self.harness.scenarios.setdefault(name, {'started': 0, 'completed': 0})
+            counts['started'] += 1
+            if await scenario():
+                counts['completed'] += 1
+
+    async def think(self):
+        low, high = self.harness.args.think
+        await asyncio.sleep(self.rng.uniform(low, high))
+
+    def message(self, **fields):
+        self.harness.telegram.next_message_id += 1
+        return dict({"message_id": self.harness.telegram.next_message_id, "date": int(time.time()),
+                     "chat": {"id": self.user_id, "type": "private"}, "from": self.user}, **fields)
+
+    async def command(self, text):
+        command = text.split()[0]
+        message = self.message(text=text, entities=[{"type": "bot_command", "offset": 0, "length": len(command)}])
+        await self.harness.send({"message": message}, f"command:{command}")
+        await self.think()
+
+    def buttons(self):
+        markup = self.harness.telegram.chat(self.user_id)['markup'] or {}
+        return [button for row in markup.get('inline_keyboard', []) for button in row]
+
+    # Нажать кнопку, callback_data которой начинается с prefix (случайную из подходящих)
+    async def click(self, prefix, exact=False):
+        matches = [button['callback_data'] for button in self.buttons()
+                   if 'callback_data' in button
+                   and (button['callback_data'] == prefix if exact else button['callback_data'].startswith(prefix))]
+        if not matches:
+            return None
+        data = self.rng.choice(matches)
+        if await self.press(data) is None:
+            return None
+        return data
+
+    async def press(self, data):
+        chat = self.harness.telegram.chat(self.user_id)
+        message = {"message_id": chat['message_id'] or 1, "date": int(time.time()), "text": chat['text'] or '-',
+                   "chat": {"id": self.user_id, "type": "private"}, "from": BOT_USER}
+        callback = {"id": str(self.harness.next_update_id), "from": self.user, "chat_instance": str(self.user_id),
+                    "data": data, "message": message}
+        sent = await self.harness.send({"callback_query": callback}, f"callback:{bot.callback_route(data)}")
+        await self.think()
+        return sent
+
+    def pay_url(self):
+        return next((button['url'] for button in self.buttons() if button.get('url')), None)
+
+    async def browse(self):
+        for target in ("profile", "payment_history", "profile", "orders"):
+            await self.press(target)
+        await self.press("plans")
+        if not await self.click("plan_"):
+            return False
+        await self.click("country_")
+        await self.press("menu")
+        await self.press("help")
+        return True
+
+    async def check_payment(self, prefix):
+        # Нетерпеливые пользователи жмут «Проверить» повторно
+        presses = 2 if self.rng.random() < self.harness.args.double_check_rate else 1
+        data = None
+        for _ in range(presses):
+            data = data or next((button['callback_data'] for button in self.buttons()
+                                 if button.get('callback_data', '').startswith(prefix)), None)
+            if data is None:
+                return False
+            await self.press(data)
+        return True
+
+    async def topup_cryptobot(self):
+        await self.press("profile")
+        await self.press("topup")
+        if not await self.click("topup_rub_amount_"):
+            return False
+        if not await self.click("topup_crypto_"):
+            return False
+        if self.rng.random() < self.harness.args.pay_rate:
+            self.harness.providers.pay(self.pay_url())
+        return await self.check_payment("check_payment_")
+
+    async def topup_crystalpay(self):
+        await self.press("profile")
+        await self.press("topup")
+        if not await self.click("topup_rub_amount_"):
+            return False
+        if not await self.click("topup_crystal_rub_"):
+            return False
+        if self.rng.random() < self.harness.args.pay_rate:
+            self.harness.providers.pay(self.pay_url())
+        return await self.check_payment("check_crystal_topup_")
+
+    async def topup_stars(self):
+        stars = self.rng.choice((50, 100, 250))
+        payload = json.dumps({"type": "stars_topup"})
+        charge_id = f"load-{self.user_id}-{self.harness.next_update_id}"
+        await self.harness.send({"pre_checkout_query": {
+            "id": charge_id, "from": self.user, "currency": "XTR", "total_amount": stars, "invoice_payload": payload,
+        }}, "pre_checkout")
+        update = {"message": self.message(successful_payment={
+            "currency": "XTR", "total_amount": stars, "invoice_payload": payload,
+            "telegram_payment_charge_id": charge_id, "provider_payment_charge_id": charge_id,
+        })}
+        if await self.harness.send(update, "successful_payment") is None:
+            return False
+        credits = self.harness.stars_credits
+        credits[self.user_id] = credits.get(self.user_id, 0.0) + stars / bot.STARS_PER_USDT
+        if self.rng.random() < self.harness.args.duplicate_delivery_rate:
+            # Повторная доставка того же апдейта (тот же update_id), как после сбоя getUpdates
+            await self.harness.send(dict(update), "successful_payment(redelivery)")
+        await self.think()
+        return True
+
+    async def buy_with_balance(self):
+        await self.press("plans")
+        if not await self.click("plan_"):
+            return False
+        if not await self.click("country_"):
+            return False
+        return await self.click("buy_balance_") is not None
+
+
+def print_summary(report):
+    out = sys.stderr
+    print(f"Апдейтов: {report['updates']} за {report['elapsed_s']} с — {report['throughput_per_s']}/с", file=out)
+    latency, service = report['latency'], report['service_time']
+    print(f"Задержка (с очередью): p50 {latency.get('p50_ms')} мс, p99 {latency.get('p99_ms')} мс; "
+          f"обработка: p50 {service.get('p50_ms')} мс, p99 {service.get('p99_ms')} мс", file=out)
+    for step, stats in report['steps'].items():
+        print(f"  {step:<40}{stats['count']:>8}  p50 {stats['p50_ms']:>8} мс  p99 {stats['p99_ms']:>8} мс", file=out)
+    anomalies = report['anomalies']
+    print("Аномалии:", file=out)
+    for key in ('double_credit_users', 'over_credited_usdt', 'negative_balances', 'balance_mismatches',
+                'configs_in_multiple_orders', 'duplicate_config_deliveries', 'handler_errors_logged'):
+        print(f"  {key}: {anomalies[key]}", file=out)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Нагрузочный тест бота с фейковыми Telegram и платёжными провайдерами")
+    parser.add_argument('--users', type=int, default=1000, help="виртуальных пользователей")
+    parser.add_argument('--duration', type=float, default=60, help="длительность, сек")
+    parser.add_argument('--ramp-up', type=float, default=10, help="за сколько секунд подключаются все пользователи")
+    parser.add_argument('--think', type=float, nargs=2, default=(0.5, 2.0), metavar=('MIN', 'MAX'),
+                        help="пауза пользователя между нажатиями, сек")
+    parser.add_argument('--concurrent-updates', type=int, default=0, help="как в ApplicationBuilder (0 — последовательно)")
+    parser.add_argument('--no-persistence', action='store_true', help="без DatabasePersistence")
+    parser.add_argument('--telegram-latency', type=float, default=0.05, help="средняя задержка Bot API, сек")
+    parser.add_argument('--telegram-failure-rate', type=float, default=0.0)
+    parser.add_argument('--provider-latency', type=float, default=0.2, help="средняя задержка провайдеров, сек")
+    parser.add_argument('--provider-failure-rate', type=float, default=0.02)
+    parser.add_argument('--pay-rate', type=float, default=0.8, help="доля счетов, которые пользователь оплачивает")
+    parser.add_argument('--double-check-rate', type=float, default=0.2, help="доля повторных нажатий «Проверить»")
+    parser.add_argument('--duplicate-delivery-rate', type=float, default=0.05,
+                        help="доля successful_payment, доставленных повторно")
+    parser.add_argument('--initial-balance', type=float, default=5.0, help="стартовый баланс пользователей, USDT")
+    parser.add_argument('--configs-per-slot', type=int, default=500, help="конфигов на тариф и страну")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', default="-", help="файл для JSON-отчёта ('-' — stdout)")
+    args = parser.parse_args()
+
+    # Лог бота (WARNING и выше) — в файл рабочего каталога; в консоль только итоги
+    logging.getLogger().setLevel(logging.WARNING)
+    for handler in bot.log_listener.handlers:
+        if not isinstance(handler, logging.FileHandler):
+            handler.setLevel(logging.CRITICAL)
+    bot.SLOW_QUERY_MS = float('inf')
+    print(f"Рабочий каталог: {WORK_DIR}", file=sys.stderr)
+    report = asyncio.run(Harness(args).run())
+    print_summary(report)
+    if args.output == '-':
+        json.dump(report, sys.stdout, ensure_ascii=False, indent=2)
+        print()
+    else:
+        with open(args.output, 'w', encoding='utf-8') as output:
+            json.dump(report, output, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,511 @@
+"""Офлайн-анализ bot.log: нагрузка, популярность маршрутов, задержки Telegram и платёжных провайдеров.
+
+Читает логи потоково (в т.ч. ротированные bot.log.N и bot.log.N.gz) с постоянным расходом памяти.
+Понимает оба формата: старый текстовый («дата - логгер - уровень - сообщение») и JSON-строки
+с трассировкой. В текстовом формате длительности восстанавливаются по промежуткам между строками
+одного апдейта (апдейты обрабатываются последовательно), поэтому они приблизительные (≈).
+
+Примеры:
+    python log_analyzer.py bot.log*
+    python log_analyzer.py --encoding cp1251 --json old_logs/bot.log.3.gz
+"""
+import argparse
+import gzip
+import heapq
+import json
+import math
+import re
+import sys
+from datetime import datetime
+
+TEXT_LINE_RE = re.compile(r'^(\d{4}-\d\d-\d\d \d\d:\d\d:\d\d),(\d{3}) - (\S+) - (\w+) - (.*)$')
+CALLBACK_RE = re.compile(r'^Callback data: (.*?), user_id: (\d+)')
+HTTPX_RE = re.compile(r'^HTTP Request: (\w+) (\S+) "HTTP/[\d.]+ (\d{3})')
+PROVIDER_REQUEST_RE = re.compile(r'^Sending request to (CryptoBot|CrystalPAY) API')
+PROVIDER_RESPONSE_RE = re.compile(r'^(CryptoBot|CrystalPAY)(?: RUB| check)? response: (\d{3})')
+PROVIDER_ERROR_RE = re.compile(r'^(CryptoBot|CrystalPAY).*\berror\b', re.IGNORECASE)
+ROTATED_RE = re.compile(r'\.(\d+)(?:\.gz)?$')
+
+UPDATE_IDLE_GAP = 30.0  # сек без строк — текущий апдейт считаем завершённым
+STARTUP_METHODS = {'getMe', 'deleteWebhook', 'setWebhook', 'setMyCommands', 'close', 'logOut'}
+
+
+class LatencyHistogram:
+    """Потоковая гистограмма с логарифмическими корзинами (шаг 10%): перцентили без хранения значений."""
+
+    BASE = 1.1
+    MIN_MS = 0.1
+
+    def __init__(self):
+        self.buckets = {}
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, ms, weight=1):
+        index = 0 if ms <= self.MIN_MS else int(math.log(ms / self.MIN_MS, self.BASE)) + 1
+        self.buckets[index] = self.buckets.get(index, 0) + weight
+        self.count += weight
+        self.total += ms * weight
+        self.max = max(self.max, ms)
+
+    def percentile(self, q):
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if seen >= rank:
+                return min(self.MIN_MS * self.BASE ** index, self.max)
+        return self.max
+
+    def summary(self):
+        return {
+            'count': self.count,
+            'avg_ms': round(self.total / self.count, 1) if self.count else 0.0,
+            'p50_ms': round(self.percentile(0.5), 1),
+            'p95_ms': round(self.percentile(0.95), 1),
+            'p99_ms': round(self.percentile(0.99), 1),
+            'max_ms': round(self.max, 1),
+        }
+
+
+class RateCounter:
+    """Событий в секунду: считает только текущую секунду и минуту, итоги сворачивает в распределение."""
+
+    def __init__(self):
+        self.total = 0
+        self.first = None
+        self.last = None
+        self.second = None
+        self.second_count = 0
+        self.minute = None
+        self.minute_count = 0
+        self.per_second = {}  # событий за секунду -> сколько таких секунд
+        self.peak_second = (0, None)
+        self.peak_minute = (0, None)
+
+    def add(self, ts):
+        self.total += 1
+        self.first = ts if self.first is None else min(self.first, ts)
+        self.last = ts if self.last is None else max(self.last, ts)
+        second = int(ts)
+        if second != self.second:
+            self.close_second()
+            self.second = second
+        self.second_count += 1
+        minute = second // 60
+        if minute != self.minute:
+            self.close_minute()
+            self.minute = minute
+        self.minute_count += 1
+
+    def close_second(self):
+        if self.second_count:
+            self.per_second[self.second_count] = self.per_second.get(self.second_count, 0) + 1
+            if self.second_count > self.peak_second[0]:
+                self.peak_second = (self.second_count, self.second)
+        self.second_count = 0
+
+    def close_minute(self):
+        if self.minute_count > self.peak_minute[0]:
+            self.peak_minute = (self.minute_count, self.minute * 60)
+        self.minute_count = 0
+
+    def summary(self):
+        self.close_second()
+        self.close_minute()
+        span = (self.last - self.first) if self.total else 0.0
+        busy_seconds = sum(self.per_second.values())
+        p99 = 0
+        seen = 0
+        for rate in sorted(self.per_second):
+            seen += self.per_second[rate]
+            if seen >= 0.99 * busy_seconds:
+                p99 = rate
+                break
+        return {
+            'total': self.total,
+            'avg_per_sec': round(self.total / span, 3) if span else float(self.total),
+            'p99_busy_second': p99,
+            'peak_per_sec': self.peak_second[0],
+            'peak_second_at': format_ts(self.peak_second[1]),
+            'peak_per_min': self.peak_minute[0],
+            'peak_minute_at': format_ts(self.peak_minute[1]),
+        }
+
+
+class CallStats:
+    """Вызовы одного вида (метод Telegram, провайдер): задержки и доля ошибок."""
+
+    def __init__(self):
+        self.latency = LatencyHistogram()
+        self.calls = 0
+        self.errors = 0
+
+    def add(self, ms, ok=True, count=1):
+        self.calls += count
+        if ms is not None:
+            self.latency.add(ms / count if count > 1 else ms, weight=count)
+        if not ok:
+            self.errors += 1
+
+    def summary(self):
+        result = {'calls': self.calls, 'errors': self.errors,
+                  'error_rate': round(self.errors / self.calls, 4) if self.calls else 0.0}
+        result.update(self.latency.summary())
+        return result
+
+
+def format_ts(ts):
+    return datetime.fromtimestamp(ts).strftime('%Y-%m-%d %H:%M:%S') if ts is not None else None
+
+
+# Маршрут из callback_data старого лога: отбрасываем ID, суммы и промокоды (части с цифрами или заглавными)
+def normalize_callback(data):
+    parts = []
+    for part in data.split('_'):
+        if not part or any(ch.isdigit() or ch.isupper() for ch in part):
+            break
+        parts.append(part)
+    return f"callback:{'_'.join(parts) or 'unknown'}"
+
+
+# Имя метода Bot API из URL (токен в вывод не попадает)
+def telegram_method(url):
+    if '/file/bot' in url:
+        return 'file_download'
+    return url.rsplit('/', 1)[-1].split('?')[0]
+
+
+class Update:
+    __slots__ = ('route', 'start', 'last', 'steps', 'error', 'duration')
+
+    def __init__(self, route, start):
+        self.route = route
+        self.start = start
+        self.last = start
+        self.steps = []  # (смещение от начала, описание, мс)
+        self.error = False
+        self.duration = None
+
+
+class LogAnalyzer:
+    def __init__(self, slowest=10):
+        self.lines = 0
+        self.unparsed = 0
+        self.first_ts = None
+        self.last_ts = None
+        self.updates = RateCounter()
+        self.telegram_rate = RateCounter()
+        self.routes = {}  # маршрут -> [апдейтов, ошибок, LatencyHistogram]
+        self.telegram = {}  # метод -> CallStats
+        self.providers = {}  # провайдер -> CallStats
+        self.slowest_limit = slowest
+        self.slowest = []  # min-heap (длительность, порядковый номер, Update)
+        self.sequence = 0
+        self.current = None  # текущий апдейт текстового лога
+        self.previous_end = None  # время последней строки предыдущего апдейта
+        self.last_poll = None  # время последнего ответа getUpdates
+        self.provider_started = {}  # провайдер -> время строки «Sending request»
+        self.provider_flagged = {}  # провайдер -> ошибка последнего вызова уже учтена
+        self.timestamp_cache = (None, None)
+        self.estimated = False
+
+    def parse_ts(self, text, millis):
+        # strptime медленный; строки идут подряд в пределах одной секунды, кэшируем последнюю
+        cached_text, cached_value = self.timestamp_cache
+        if text != cached_text:
+            cached_value = datetime.strptime(text, '%Y-%m-%d %H:%M:%S').timestamp()
+            self.timestamp_cache = (text, cached_value)
+        return cached_value + int(millis) / 1000
+
+    def feed(self, line):
+        self.lines += 1
+        line = line.rstrip('\n')
+        if line.startswith('{'):
+            try:
+                record = json.loads(line)
+            except ValueError:
+                self.unparsed += 1
+                return
+            self.feed_json(record)
+            return
+        match = TEXT_LINE_RE.match(line)
+        if not match:
+            # Продолжение многострочной записи (traceback) или мусор
+            self.unparsed += 1
+            return
+        date_text, millis, logger_name, level, message = match.groups()
+        self.feed_text(self.parse_ts(date_text, millis), logger_name, level, message)
+
+    def touch(self, ts):
+        self.first_ts = ts if self.first_ts is None else min(self.first_ts, ts)
+        self.last_ts = ts if self.last_ts is None else max(self.last_ts, ts)
+
+    def feed_json(self, record):
+        try:
+            ts = datetime.strptime(record['ts'], '%Y-%m-%d %H:%M:%S,%f').timestamp()
+        except (KeyError, ValueError):
+            self.unparsed += 1
+            return
+        self.touch(ts)
+        if 'spans' in record and 'duration_ms' in record:
+            # Итог апдейта из TracedApplication: точные длительности по видам вызовов
+            self.close_current()
+            update = Update(record.get('route') or 'unknown', ts - record['duration_ms'] / 1000)
+            update.duration = record['duration_ms']
+            for name, span in record['spans'].items():
+                kind, _, call = name.partition(':')
+                ok = not span.get('errors')
+                if kind == 'telegram':
+                    self.call_stats(self.telegram, call).add(span['ms'], ok, span['count'])
+                    for _ in range(span['count']):
+                        self.telegram_rate.add(ts)
+                elif kind == 'provider':
+                    self.call_stats(self.providers, call).add(span['ms'], ok, span['count'])
+                update.steps.append((None, f"{name} ×{span['count']}", span['ms']))
+            self.finish_update(update, ts)
+            return
+        if record.get('trace_id'):
+            # Прочие строки трассированного апдейта уже учтены в его итоге
+            if record.get('level') == 'ERROR':
+                self.route_stats(record.get('route') or 'unknown')[1] += 1
+            return
+        if record.get('logger') == 'httpx':
+            # Вне апдейтов (getUpdates, фоновые задачи) — без трассы, только счётчики
+            self.feed_text(ts, 'httpx', record.get('level', ''), record.get('msg', ''))
+
+    def feed_text(self, ts, logger_name, level, message):
+        self.touch(ts)
+        if self.current is not None and ts - self.current.last > UPDATE_IDLE_GAP:
+            self.close_current()
+        callback = CALLBACK_RE.match(message)
+        if callback:
+            route = normalize_callback(callback.group(1))
+            current = self.current
+            if current is not None and current.route == 'message' and current.start == self.last_poll:
+                # answerCallbackQuery пишется до «Callback data»: апдейт уже начат, уточняем маршрут
+                current.route = route
+            else:
+                self.close_current()
+                self.current = Update(route, self.arrival(ts))
+            self.estimated = True
+            return
+        if logger_name == 'httpx':
+            http = HTTPX_RE.match(message)
+            if not http:
+                return
+            method = telegram_method(http.group(2))
+            if method == 'getUpdates':
+                # Ответ long polling: апдейты, пришедшие в нём, начинают обрабатываться с этого момента
+                self.last_poll = ts
+                return
+            ok = int(http.group(3)) < 400
+            self.telegram_rate.add(ts)
+            if method in STARTUP_METHODS:
+                # Вызовы при запуске бота, вне апдейтов: длительность не восстановить
+                self.call_stats(self.telegram, method).add(None, ok)
+                return
+            current = self.update_for(ts)
+            # httpx пишет строку по получении ответа: длительность ≈ время с предыдущей строки апдейта
+            latency = (ts - current.last) * 1000
+            self.call_stats(self.telegram, method).add(latency, ok)
+            current.steps.append((ts - current.start, f"telegram:{method}", latency))
+            current.last = ts
+            return
+        provider_request = PROVIDER_REQUEST_RE.match(message)
+        if provider_request:
+            self.provider_started[provider_request.group(1)] = ts
+            self.update_for(ts).last = ts
+            return
+        provider_response = PROVIDER_RESPONSE_RE.match(message)
+        if provider_response:
+            provider = provider_response.group(1)
+            started = self.provider_started.pop(provider, None)
+            latency = (ts - started) * 1000 if started is not None else None
+            ok = int(provider_response.group(2)) < 400
+            self.call_stats(self.providers, provider).add(latency, ok)
+            self.provider_flagged[provider] = not ok
+            if self.current is not None:
+                self.current.steps.append((ts - self.current.start, f"provider:{provider}", latency))
+                self.current.last = ts
+            return
+        if level == 'ERROR':
+            provider_error = PROVIDER_ERROR_RE.match(message)
+            if provider_error and not self.provider_flagged.get(provider_error.group(1), True):
+                # HTTP 200, но провайдер вернул ошибку в теле ответа
+                self.providers[provider_error.group(1)].errors += 1
+                self.provider_flagged[provider_error.group(1)] = True
+            # Ошибка относится к текущему апдейту, только если после него не приходили новые
+            current = self.current
+            if current is not None and (self.last_poll is None or self.last_poll <= current.last):
+                current.error = True
+                current.last = ts
+
+    # Начало апдейта: последний getUpdates, если он был после предыдущего апдейта и недавно
+    def arrival(self, ts):
+        previous_end = self.previous_end or 0.0
+        if self.last_poll is not None and previous_end <= self.last_poll <= ts and ts - self.last_poll < 5:
+            return self.last_poll
+        return ts
+
+    # Апдейт, к которому относится строка. Если после последней строки текущего апдейта вернулся
+    # getUpdates, это уже следующий апдейт (сообщение или команда — в старом логе без маршрута)
+    def update_for(self, ts):
+        current = self.current
+        if current is None or (self.last_poll is not None and self.last_poll > current.last):
+            self.close_current()
+            current = self.current = Update('message', self.arrival(ts))
+        return current
+
+    def call_stats(self, registry, name):
+        stats = registry.get(name)
+        if stats is None:
+            stats = registry[name] = CallStats()
+        return stats
+
+    def route_stats(self, route):
+        stats = self.routes.get(route)
+        if stats is None:
+            stats = self.routes[route] = [0, 0, LatencyHistogram()]
+        return stats
+
+    def close_current(self):
+        if self.current is not None:
+            update, self.current = self.current, None
+            update.duration = (update.last - update.start) * 1000
+            self.previous_end = update.last
+            self.finish_update(update, update.start)
+
+    def finish_update(self, update, ts):
+        self.updates.add(ts)
+        stats = self.route_stats(update.route)
+        stats[0] += 1
+        stats[1] += 1 if update.error else 0
+        stats[2].add(update.duration)
+        self.sequence += 1
+        entry = (update.duration, self.sequence, update)
+        if len(self.slowest) < self.slowest_limit:
+            heapq.heappush(self.slowest, entry)
+        elif self.slowest_limit and entry[0] > self.slowest[0][0]:
+            heapq.heapreplace(self.slowest, entry)
+
+    def report(self):
+        self.close_current()
+        routes = {}
+        for route, (count, errors, latency) in sorted(self.routes.items(), key=lambda item: item[1][0], reverse=True):
+            routes[route] = dict(latency.summary(), count=count, errors=errors)
+        slowest = []
+        for duration, _, update in sorted(self.slowest, key=lambda entry: entry[0], reverse=True):
+            slowest.append({
+                'route': update.route,
+                'start': format_ts(update.start),
+                'duration_ms': round(duration, 1),
+                'error': update.error,
+                'steps': [
+                    {'offset_ms': round(offset * 1000, 1) if offset is not None else None, 'step': step,
+                     'ms': round(ms, 1) if ms is not None else None}
+                    for offset, step, ms in update.steps
+                ],
+            })
+        return {
+            'period': {'from': format_ts(self.first_ts), 'to': format_ts(self.last_ts),
+                       'lines': self.lines, 'unparsed_lines': self.unparsed, 'estimated': self.estimated},
+            'updates': self.updates.summary(),
+            'telegram_calls': self.telegram_rate.summary(),
+            'routes': routes,
+            'telegram': {name: stats.summary() for name, stats in sorted(self.telegram.items())},
+            'providers': {name: stats.summary() for name, stats in sorted(self.providers.items())},
+            'slowest_updates': slowest,
+        }
+
+
+# Ротированные файлы в хронологическом порядке: bot.log.10.gz ... bot.log.1.gz, затем bot.log
+def chronological(paths):
+    def key(path):
+        match = ROTATED_RE.search(path)
+        return -int(match.group(1)) if match else 0
+    return sorted(paths, key=key)
+
+
+def open_log(path, encoding):
+    if path == '-':
+        return sys.stdin
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rt', encoding=encoding, errors='replace')
+    return open(path, 'r', encoding=encoding, errors='replace')
+
+
+def print_calls(title, registry, estimated):
+    if not registry:
+        return
+    approx = '≈' if estimated else ''
+    print(f"\n{title}")
+    print(f"  {'вызов':<28}{'всего':>8}{'ошибок':>9}{approx + 'p50 мс':>10}{approx + 'p95 мс':>10}{approx + 'p99 мс':>10}")
+    for name, stats in registry.items():
+        # Без замеров (вызовы при запуске) перцентили не показываем
+        latencies = [stats[key] if stats['count'] else '-' for key in ('p50_ms', 'p95_ms', 'p99_ms')]
+        print(f"  {name:<28}{stats['calls']:>8}{stats['error_rate'] * 100:>8.1f}%"
+              f"{latencies[0]:>10}{latencies[1]:>10}{latencies[2]:>10}")
+
+
+def print_rate(title, rate):
+    print(f"\n{title}: {rate['total']}, в среднем {rate['avg_per_sec']}/с, "
+          f"p99 по активным секундам {rate['p99_busy_second']}/с")
+    if rate['total']:
+        print(f"  пик: {rate['peak_per_sec']}/с ({rate['peak_second_at']}), "
+              f"{rate['peak_per_min']}/мин ({rate['peak_minute_at']})")
+
+
+def print_report(report, top_routes):
+    period = report['period']
+    print(f"Период: {period['from']} — {period['to']}, строк {period['lines']}, "
+          f"нераспознанных {period['unparsed_lines']}")
+    if period['estimated']:
+        print("≈ длительности из текстового лога восстановлены по промежуткам между строками")
+    print_rate("Апдейты", report['updates'])
+    print_rate("Исходящие вызовы Telegram (без getUpdates)", report['telegram_calls'])
+    total = report['updates']['total'] or 1
+    print(f"\nМаршруты (топ {top_routes}):")
+    for route, stats in list(report['routes'].items())[:top_routes]:
+        print(f"  {route:<32}{stats['count']:>8} {stats['count'] / total * 100:5.1f}%  "
+              f"p50 {stats['p50_ms']} мс, p95 {stats['p95_ms']} мс, ошибок {stats['errors']}")
+    print_calls("Telegram Bot API:", report['telegram'], period['estimated'])
+    print_calls("Платёжные провайдеры:", report['providers'], period['estimated'])
+    if report['slowest_updates']:
+        print("\nСамые медленные апдейты:")
+        for update in report['slowest_updates']:
+            print(f"  {update['start']} {update['route']} — {update['duration_ms']} мс"
+                  f"{' (ошибка)' if update['error'] else ''}")
+            for step in update['steps']:
+                offset = f"+{step['offset_ms']} мс " if step['offset_ms'] is not None else ""
+                duration = f" {step['ms']} мс" if step['ms'] is not None else ""
+                print(f"      {offset}{step['step']}{duration}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Анализ трафика и задержек по bot.log")
+    parser.add_argument('paths', nargs='+', help="файлы логов (.gz читаются сжатыми, '-' — stdin)")
+    parser.add_argument('--encoding', default='utf-8', help="кодировка текстовых логов (старые логи Windows — cp1251)")
+    parser.add_argument('--json', action='store_true', help="вывести отчёт в JSON")
+    parser.add_argument('--slowest', type=int, default=10, help="сколько самых медленных апдейтов показать")
+    parser.add_argument('--top-routes', type=int, default=30, help="сколько маршрутов показать")
+    args = parser.parse_args()
+
+    analyzer = LogAnalyzer(slowest=args.slowest)
+    for path in chronological(args.paths):
+        with open_log(path, args.encoding) as log_file:
+            for line in log_file:
+                analyzer.feed(line)
+    report = analyzer.report()
+    if args.json:
+        json.dump(report, sys.stdout, ensure_ascii=False, indent=2)
+        print()
+    else:
+        print_report(report, args.top_routes)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,209 @@
+"""Проверка производительности перед деплоем: сравнение результатов benchmark.py, load_test.py и replay.py с базовыми.
+
+Базовая линия — несколько прогонов одного и того же теста на эталонной версии:
+    python perf_gate.py save bench --runs bench1.json bench2.json bench3.json
+    python perf_gate.py save e2e --runs load1.json load2.json load3.json
+Проверка новой версии (код возврата 1, если горячий путь стал медленнее порога):
+    python perf_gate.py compare bench --runs new1.json new2.json new3.json
+
+Метрика — медиана выбранного перцентиля по прогонам. Изменение считается регрессией, только если
+оно больше порога (--threshold), больше разброса между прогонами и базы, и новой версии (шум,
+не меньше --noise-floor), и больше --min-delta-ms в абсолютных величинах. Регрессии вне горячих путей выводятся, но не валят проверку.
+"""
+import argparse
+import fnmatch
+import json
+import os
+import statistics
+import subprocess
+import sys
+from datetime import datetime
+
+DEFAULT_BASELINE_DIR = "perf_baselines"
+
+# Горячие пути: покупка, проверка оплаты, профиль, список тарифов — маршруты load_test/replay и хелперы БД под ними
+DEFAULT_HOT_PATHS = [
+    "e2e:callback:buy_balance", "e2e:callback:check_payment", "e2e:callback:check_crystal_topup",
+    "e2e:callback:profile", "e2e:callback:plans", "e2e:successful_payment",
+    "db:*:claim_config_order", "db:*:purchase_with_balance", "db:*:create_order", "db:*:update_balance",
+    "db:*:get_balance", "db:*:get_payment",
+]
+
+
+# Плоский словарь метрик прогона: имя -> {'p50': мс, 'p95': мс, 'p99': мс, 'count': n}
+def flatten(report, min_count):
+    metrics = {}
+    if 'scales' in report:
+        for scale, result in report['scales'].items():
+            for helper, stats in result['helpers'].items():
+                metrics[f"db:{scale}:{helper}"] = {
+                    'p50': stats['p50_us'] / 1000, 'p95': stats['p95_us'] / 1000, 'p99': stats['p99_us'] / 1000,
+                    'count': stats['iterations'],
+                }
+    for section in ('steps', 'routes'):
+        for step, stats in report.get(section, {}).items():
+            if stats.get('count', 0) < min_count:
+                continue
+            metrics[f"e2e:{step}"] = {'p50': stats['p50_ms'], 'p95': stats['p95_ms'], 'p99': stats['p99_ms'],
+                                      'count': stats['count']}
+    return metrics
+
+
+def load_runs(paths, min_count):
+    runs = []
+    for path in paths:
+        with open(path, encoding='utf-8') as source:
+            report = json.load(source)
+        # Параметры прогона без полей, которые меняются от запуска к запуску
+        config = {key: value for key, value in (report.get('config') or report.get('meta') or {}).items()
+                  if key not in ('timestamp', 'git_commit')}
+        runs.append({'source': os.path.basename(path), 'config': config, 'metrics': flatten(report, min_count)})
+    return runs
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def baseline_path(args):
+    return os.path.join(args.baseline_dir, f"{args.name}.json")
+
+
+def save(args):
+    runs = load_runs(args.runs, args.min_count)
+    os.makedirs(args.baseline_dir, exist_ok=True)
+    baseline = {
+        'name': args.name,
+        'saved_at': datetime.now().isoformat(timespec='seconds'),
+        'git_commit': git_commit(),
+        'runs': runs,
+    }
+    with open(baseline_path(args), 'w', encoding='utf-8') as output:
+        json.dump(baseline, output, ensure_ascii=False, indent=2)
+    metrics = set().union(*(run['metrics'] for run in runs))
+    print(f"Базовая линия {args.name}: {len(runs)} прогонов, {len(metrics)} метрик -> {baseline_path(args)}")
+    return 0
+
+
+# Относительный разброс значений метрики между прогонами
+def spread(values):
+    if len(values) < 2:
+        return 0.0
+    middle = statistics.median(values)
+    return (max(values) - min(values)) / middle if middle else 0.0
+
+
+def compare_metric(name, old, new, args):
+    base, current = statistics.median(old), statistics.median(new)
+    change = current / base - 1 if base else 0.0
+    noise = max(spread(old), spread(new), args.noise_floor)
+    significant = abs(change) > args.threshold and abs(change) > noise and abs(current - base) >= args.min_delta_ms
+    status = 'ok'
+    if significant:
+        status = 'regression' if change > 0 else 'improvement'
+    elif abs(change) > args.threshold:
+        status = 'noise'
+    return {'metric': name, 'base_ms': round(base, 3), 'new_ms': round(current, 3), 'change': round(change, 4),
+            'noise': round(noise, 4), 'status': status, 'hot': is_hot(name, args.hot)}
+
+
+def is_hot(name, patterns):
+    return any(fnmatch.fnmatchcase(name, pattern) for pattern in patterns)
+
+
+def compare(args):
+    path = baseline_path(args)
+    if not os.path.exists(path):
+        print(f"Нет базовой линии {path}: сохраните её командой save", file=sys.stderr)
+        return 2
+    with open(path, encoding='utf-8') as source:
+        baseline = json.load(source)
+    runs = load_runs(args.runs, args.min_count)
+
+    warnings = []
+    if baseline['runs'][0].get('config') != runs[0].get('config'):
+        warnings.append("параметры прогона отличаются от базовой линии — сравнение может быть некорректным")
+    if min(len(baseline['runs']), len(runs)) < 3:
+        warnings.append(f"меньше 3 прогонов с одной из сторон: шум оценивается только по --noise-floor ({args.noise_floor:.0%})")
+
+    results = []
+    missing = []
+    for name in sorted(set().union(*(run['metrics'] for run in baseline['runs']))):
+        old = [run['metrics'][name][args.stat] for run in baseline['runs'] if name in run['metrics']]
+        new = [run['metrics'][name][args.stat] for run in runs if name in run['metrics']]
+        if not new:
+            missing.append(name)
+            continue
+        results.append(compare_metric(name, old, new, args))
+
+    failed = [item for item in results if item['status'] == 'regression' and item['hot']]
+    report = {
+        'baseline': {'name': baseline['name'], 'git_commit': baseline.get('git_commit'), 'runs': len(baseline['runs'])},
+        'candidate': {'git_commit': git_commit(), 'runs': len(runs)},
+        'stat': args.stat,
+        'threshold': args.threshold,
+        'passed': not failed,
+        'warnings': warnings,
+        'missing': missing,
+        'metrics': results,
+    }
+    print_report(report)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as output:
+            json.dump(report, output, ensure_ascii=False, indent=2)
+    return 0 if report['passed'] else 1
+
+
+def print_report(report):
+    marks = {'regression': "РЕГРЕССИЯ", 'improvement': "быстрее", 'noise': "шум", 'ok': ""}
+    print(f"Сравнение с базовой линией {report['baseline']['name']} ({report['baseline']['git_commit']}, "
+          f"{report['baseline']['runs']} прогонов) — {report['candidate']['runs']} прогонов {report['candidate']['git_commit']}, "
+          f"{report['stat']}, порог {report['threshold']:.0%}")
+    for warning in report['warnings']:
+        print(f"⚠️  {warning}")
+    # Сначала то, что изменилось: регрессии горячих путей, остальные регрессии, шум, улучшения
+    order = {'regression': 0, 'noise': 1, 'improvement': 2, 'ok': 3}
+    rows = sorted(report['metrics'], key=lambda item: (order[item['status']], not item['hot'], -item['change']))
+    print(f"{'':2}{'метрика':<58}{'было, мс':>12}{'стало, мс':>12}{'изм.':>9}{'шум':>8}")
+    for item in rows:
+        hot = "🔥" if item['hot'] else "  "
+        print(f"{hot}{item['metric']:<58}{item['base_ms']:>12}{item['new_ms']:>12}{item['change']:>+9.1%}"
+              f"{item['noise']:>8.1%}  {marks[item['status']]}")
+    if report['missing']:
+        print(f"Нет в новых прогонах: {', '.join(report['missing'])}")
+    regressions = [item for item in report['metrics'] if item['status'] == 'regression']
+    hot = [item for item in regressions if item['hot']]
+    if hot:
+        print(f"❌ Регрессия горячих путей: {', '.join(item['metric'] for item in hot)}")
+    elif regressions:
+        print(f"✅ Горячие пути в норме (регрессии вне их: {len(regressions)})")
+    else:
+        print("✅ Регрессий нет")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Сравнение результатов бенчмарков с базовой линией")
+    parser.add_argument('command', choices=('save', 'compare'))
+    parser.add_argument('name', help="имя базовой линии (например bench или e2e)")
+    parser.add_argument('--runs', nargs='+', required=True, help="JSON-отчёты benchmark.py / load_test.py / replay.py")
+    parser.add_argument('--baseline-dir', default=DEFAULT_BASELINE_DIR)
+    parser.add_argument('--stat', choices=('p50', 'p95', 'p99'), default='p50', help="какой перцентиль сравнивать")
+    parser.add_argument('--threshold', type=float, default=0.10, help="допустимое замедление (0.10 — 10%%)")
+    parser.add_argument('--noise-floor', type=float, default=0.05,
+                        help="минимальная оценка шума, если прогоны почти совпадают или прогон один")
+    parser.add_argument('--min-delta-ms', type=float, default=0.05, help="изменения меньше этого не считаются")
+    parser.add_argument('--min-count', type=int, default=20, help="шаги load_test с меньшим числом замеров не сравниваются")
+    parser.add_argument('--hot', default=",".join(DEFAULT_HOT_PATHS),
+                        help="горячие пути (шаблоны fnmatch через запятую): их регрессия валит проверку")
+    parser.add_argument('--output', default="", help="файл для JSON-отчёта сравнения")
+    args = parser.parse_args()
+    args.hot = [pattern.strip() for pattern in args.hot.split(',') if pattern.strip()]
+    sys.exit(save(args) if args.command == 'save' else compare(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,221 @@
+"""Воспроизведение записанного потока апдейтов (UPDATE_RECORD_FILE) на копии базы.
+
+Апдейты подаются в application.update_queue в исходном темпе (--speed 1), ускоренно (--speed 10)
+или без пауз (--speed 0); Telegram и платёжные провайдеры — заглушки из load_test.py.
+Если передать ключ обезличивания записи (--salt, он же UPDATE_RECORD_SALT), id пользователей
+в копии базы и ADMIN_ID пересчитываются так же, как в записи: воспроизведённые апдейты видят
+свои балансы, заказы и админку. Без ключа авторы апдейтов — новые пользователи.
+
+Пример:
+    python replay.py updates.ndjson.gz --db vpn_bot.db --speed 10 --salt "$UPDATE_RECORD_SALT"
+"""
+import argparse
+import asyncio
+import gzip
+import json
+import logging
+import os
+import sqlite3
+import sys
+import time
+
+import load_test
+from load_test import FakeProviders, FakeTelegram, FakeTelegramRequest, LoadTestApplication, percentiles, bot
+from telegram import Update
+from telegram.ext import Application
+
+
+def read_recording(path):
+    opener = gzip.open if path.endswith('.gz') else open
+    with opener(path, 'rt', encoding='utf-8') as recording:
+        for line in recording:
+            line = line.strip()
+            if line:
+                record = json.loads(line)
+                yield record['ts'], record['u']
+
+
+# Копия базы через backup API (можно снимать с работающего бота) и пересчёт id пользователей
+def prepare_database(source, target, salt):
+    src = sqlite3.connect(source)
+    dst = sqlite3.connect(target)
+    src.backup(dst)
+    src.close()
+    remapped = {}
+    if salt:
+        dst.create_function('anonymize_id', 1, lambda value: None if value is None else bot.anonymize_id(value, salt))
+        for (table,) in dst.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name NOT LIKE 'sqlite_%'").fetchall():
+            for column in dst.execute(f"PRAGMA table_info({table})").fetchall():
+                if column[1] in ('user_id', 'chat_id'):
+                    dst.execute(f"UPDATE {table} SET {column[1]} = anonymize_id({column[1]})")
+                    remapped.setdefault(table, []).append(column[1])
+        dst.commit()
+    dst.close()
+    return remapped
+
+
+class Replayer:
+    def __init__(self, args):
+        self.args = args
+        self.telegram = FakeTelegram(args.telegram_latency, 0.0, args.seed)
+        self.providers = FakeProviders(args.provider_latency, args.provider_failure_rate, args.seed + 1,
+                                       auto_pay=args.pay)
+        self.application = None
+        self.pending = {}  # update_id -> [(время постановки в очередь, маршрут), ...]
+        self.latencies = []
+        self.service_times = []
+        self.route_latencies = {}
+        self.schedule_lag = []  # насколько подача отстала от расписания записи
+        self.handler_errors = 0
+        self.done = asyncio.Event()
+        self.sent = 0
+        self.finished = 0
+        self.all_sent = False
+
+    def completed(self, update, service_time):
+        self.service_times.append(service_time)
+        waiting = self.pending.get(update.update_id)
+        if waiting:
+            enqueued, route = waiting.pop(0)
+            if not waiting:
+                del self.pending[update.update_id]
+            elapsed = time.perf_counter() - enqueued
+            self.latencies.append(elapsed)
+            self.route_latencies.setdefault(route, []).append(elapsed)
+        self.finished += 1
+        if self.all_sent and self.finished >= self.sent:
+            self.done.set()
+
+    @staticmethod
+    def route(update):
+        if update.callback_query:
+            return f"callback:{bot.callback_route(update.callback_query.data or '')}"
+        return bot.update_route(update)
+
+    async def feed(self):
+        args = self.args
+        first_ts = None
+        started = time.perf_counter()
+        for ts, data in read_recording(args.recording):
+            if args.limit and self.sent >= args.limit:
+                break
+            if first_ts is None:
+                first_ts = ts
+            if args.speed:
+                target = started + (ts - first_ts) / args.speed
+                delay = target - time.perf_counter()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                else:
+                    self.schedule_lag.append(-delay)
+            update = Update.de_json(data, self.application.bot)
+            self.pending.setdefault(update.update_id, []).append((time.perf_counter(), self.route(update)))
+            await self.application.update_queue.put(update)
+            self.sent += 1
+        self.all_sent = True
+        if self.finished >= self.sent:
+            self.done.set()
+
+    async def run(self):
+        args = self.args
+        target = os.path.join(load_test.WORK_DIR, "replay.db")
+        remapped = prepare_database(args.db, target, args.salt.encode() if args.salt else None)
+        bot.DB_PATH = target
+        bot.init_db()
+        if args.salt:
+            bot.ADMIN_ID = bot.anonymize_id(bot.ADMIN_ID, args.salt.encode())
+
+        replayer = self
+
+        class ErrorCounter(logging.Handler):
+            def emit(self, record):
+                replayer.handler_errors += 1
+        logging.getLogger().addHandler(ErrorCounter(level=logging.ERROR))
+
+        self.providers.start()
+        builder = (
+            Application.builder()
+            .token(os.environ["BOT_TOKEN"])
+            .application_class(LoadTestApplication)
+            .request(FakeTelegramRequest(self.telegram))
+            .get_updates_request(FakeTelegramRequest(self.telegram))
+            .concurrent_updates(args.concurrent_updates or False)
+        )
+        if not args.no_persistence:
+            builder = builder.persistence(bot.DatabasePersistence(update_interval=bot.PERSISTENCE_FLUSH_INTERVAL))
+        self.application = builder.build()
+        LoadTestApplication.harness = self
+        bot.register_handlers(self.application)
+        await self.application.initialize()
+        await self.application.start()
+        started = time.perf_counter()
+        try:
+            await self.feed()
+            try:
+                await asyncio.wait_for(self.done.wait(), timeout=args.drain_timeout)
+            except asyncio.TimeoutError:
+                print(f"Не дождались {self.sent - self.finished} апдейтов за {args.drain_timeout} с", file=sys.stderr)
+            elapsed = time.perf_counter() - started
+        finally:
+            await self.application.stop()
+            await self.application.shutdown()
+            self.providers.stop()
+        return {
+            'config': {key: value for key, value in vars(args).items() if key not in ('output', 'salt')},
+            'database': {'copy': target, 'remapped_columns': remapped},
+            'elapsed_s': round(elapsed, 2),
+            'updates': self.sent,
+            'completed': self.finished,
+            'throughput_per_s': round(self.finished / elapsed, 1) if elapsed else None,
+            'latency': percentiles(self.latencies),
+            'service_time': percentiles(self.service_times),
+            'schedule_lag': percentiles(self.schedule_lag),
+            'routes': {route: percentiles(samples) for route, samples in sorted(self.route_latencies.items())},
+            'telegram': {'calls': self.telegram.calls},
+            'providers': {'calls': self.providers.calls, 'injected_failures': self.providers.failures},
+            'handler_errors_logged': self.handler_errors,
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Воспроизведение записанных апдейтов на копии базы")
+    parser.add_argument('recording', help="файл UPDATE_RECORD_FILE (.ndjson или .ndjson.gz)")
+    parser.add_argument('--db', default="vpn_bot.db", help="база, с копии которой начинается воспроизведение")
+    parser.add_argument('--salt', default=os.environ.get("UPDATE_RECORD_SALT", ""),
+                        help="ключ обезличивания записи (UPDATE_RECORD_SALT) для пересчёта id в копии базы")
+    parser.add_argument('--speed', type=float, default=1.0, help="ускорение относительно записи; 0 — без пауз")
+    parser.add_argument('--limit', type=int, default=0, help="воспроизвести только первые N апдейтов")
+    parser.add_argument('--concurrent-updates', type=int, default=0, help="как в ApplicationBuilder (0 — последовательно)")
+    parser.add_argument('--no-persistence', action='store_true', help="без DatabasePersistence")
+    parser.add_argument('--pay', action='store_true', help="счета провайдеров сразу оплачены")
+    parser.add_argument('--telegram-latency', type=float, default=0.05, help="средняя задержка Bot API, сек")
+    parser.add_argument('--provider-latency', type=float, default=0.2, help="средняя задержка провайдеров, сек")
+    parser.add_argument('--provider-failure-rate', type=float, default=0.0)
+    parser.add_argument('--drain-timeout', type=float, default=120, help="сколько ждать обработки после подачи, сек")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', default="-", help="файл для JSON-отчёта ('-' — stdout)")
+    args = parser.parse_args()
+
+    logging.getLogger().setLevel(logging.WARNING)
+    for handler in bot.log_listener.handlers:
+        if not isinstance(handler, logging.FileHandler):
+            handler.setLevel(logging.CRITICAL)
+    bot.SLOW_QUERY_MS = float('inf')
+    print(f"Рабочий каталог: {load_test.WORK_DIR}", file=sys.stderr)
+    report = asyncio.run(Replayer(args).run())
+    latency, service = report['latency'], report['service_time']
+    print(f"Воспроизведено {report['completed']}/{report['updates']} апдейтов за {report['elapsed_s']} с; "
+          f"задержка p50 {latency.get('p50_ms')} мс, p99 {latency.get('p99_ms')} мс; "
+          f"обработка p99 {service.get('p99_ms')} мс; ошибок в логе: {report['handler_errors_logged']}", file=sys.stderr)
+    for route, stats in report['routes'].items():
+        print(f"  {route:<40}{stats['count']:>8}  p50 {stats['p50_ms']:>8} мс  p99 {stats['p99_ms']:>8} мс", file=sys.stderr)
+    if args.output == '-':
+        json.dump(report, sys.stdout, ensure_ascii=False, indent=2)
+        print()
+    else:
+        with open(args.output, 'w', encoding='utf-8') as output:
+            json.dump(report, output, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -4,25 +4,318 @@ import logging
 import json
 import os
 import uuid
+import asyncio
+import time
+import math
+import hashlib
+import hmac
+import functools
+import secrets
+import re
+import gzip
+import shutil
+import queue
+import atexit
+import logging.handlers
+import sys
+import io
+import traceback
+import cProfile
+import pstats
+import threading
+import contextvars
+from contextlib import closing, contextmanager
 from datetime import datetime, timedelta
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import Application, CommandHandler, CallbackQueryHandler, ContextTypes, MessageHandler, filters
 from telegram.constants import ParseMode
 import requests
+import httpx
 from telegram import LabeledPrice
-from telegram.ext import PreCheckoutQueryHandler
-
-# Настройка логирования
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', 
-    level=logging.INFO,
-    handlers=[
-        logging.FileHandler("bot.log"),
-        logging.StreamHandler()
-    ]
-)
+from telegram.ext import PreCheckoutQueryHandler, BasePersistence, PersistenceInput
+from telegram.error import Forbidden, BadRequest, RetryAfter, TimedOut, NetworkError
+from telegram.request import HTTPXRequest
+
 logger = logging.getLogger(__name__)
 
+# Трасса текущего апдейта (см. TracedApplication)
+current_trace = contextvars.ContextVar('current_trace', default=None)
+
+class UpdateTrace:
+    """Трасса одного апдейта: correlation id, маршрут и спаны с длительностями."""
+
+    def __init__(self, update):
+        self.trace_id = uuid.uuid4().hex[:12]
+        self.update_id = getattr(update, 'update_id', None)
+        user = getattr(update, 'effective_user', None)
+        self.user_id = user.id if user else None
+        self.route = update_route(update)
+        self.started = time.perf_counter()
+        self.spans = []  # (вид, имя, мс, успех)
+
+    def add_span(self, kind, name, duration, ok):
+        self.spans.append((kind, name, round(duration * 1000, 2), ok))
+
+    def summary(self):
+        # Сворачиваем повторяющиеся спаны: {"db:get_balance": {"count": 2, "ms": 1.3, "errors": 0}}
+        summary = {}
+        for kind, name, ms, ok in self.spans:
+            item = summary.setdefault(f"{kind}:{name}", {'count': 0, 'ms': 0.0, 'errors': 0})
+            item['count'] += 1
+            item['ms'] = round(item['ms'] + ms, 2)
+            item['errors'] += 0 if ok else 1
+        return summary
+
+# Запись спана: в метрики всегда, в трассу — если идёт обработка апдейта
+def record_span(kind, name, duration, ok=True):
+    if kind == 'db':
+        DB_QUERY_SECONDS.observe(duration, name)
+        if not ok:
+            DB_QUERY_ERRORS.inc(name)
+    else:
+        EXTERNAL_CALL_SECONDS.observe(duration, kind, name)
+        if not ok:
+            EXTERNAL_CALL_ERRORS.inc(kind, name)
+    trace = current_trace.get()
+    if trace is not None:
+        trace.add_span(kind, name, duration, ok)
+
+@contextmanager
+def trace_span(kind, name):
+    start = time.perf_counter()
+    ok = False
+    try:
+        yield
+        ok = True
+    finally:
+        record_span(kind, name, time.perf_counter() - start, ok)
+
+# Метрики в текстовом формате Prometheus (отдаются по /metrics, см. serve_metrics)
+def format_labels(names, values):
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for v in values)
+    return ','.join(f'{n}="{v}"' for n, v in zip(names, escaped))
+
+class Counter:
+    def __init__(self, name, help_text, label_names):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, *label_values, amount=1):
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def render(self):
+        with self.lock:
+            items = sorted(self.values.items())
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        for label_values, value in items:
+            lines.append(f"{self.name}{{{format_labels(self.label_names, label_values)}}} {value}")
+        return lines
+
+class Histogram:
+    """Гистограмма с метками. Потокобезопасна: DB-хелперы вызываются и из asyncio.to_thread."""
+
+    def __init__(self, name, help_text, label_names, buckets):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self.buckets = buckets
+        self.series = {}  # значения меток -> [счётчики по бакетам, сумма, количество]
+        self.lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        with self.lock:
+            series = self.series.get(label_values)
+            if series is None:
+                series = self.series[label_values] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[0][i] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self):
+        with self.lock:
+            items = sorted((k, list(v[0]), v[1], v[2]) for k, v in self.series.items())
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        for label_values, counts, total, count in items:
+            labels = format_labels(self.label_names, label_values)
+            bucket_prefix = f"{labels}," if labels else ""
+            series_labels = f"{{{labels}}}" if labels else ""
+            for bound, bucket_count in zip(self.buckets, counts):
+                lines.append(f'{self.name}_bucket{{{bucket_prefix}le="{bound}"}} {bucket_count}')
+            lines.append(f'{self.name}_bucket{{{bucket_prefix}le="+Inf"}} {count}')
+            lines.append(f"{self.name}_sum{series_labels} {total:.6f}")
+            lines.append(f"{self.name}_count{series_labels} {count}")
+        return lines
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+DB_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.5)
+
+UPDATE_SECONDS = Histogram("vpn_bot_update_duration_seconds",
+                           "Время обработки апдейта по маршруту (команда, callback, состояние)",
+                           ("route",), LATENCY_BUCKETS)
+DB_QUERY_SECONDS = Histogram("vpn_bot_db_query_duration_seconds",
+                             "Время SQL-запросов по хелперу, открывшему соединение",
+                             ("helper",), DB_BUCKETS)
+DB_QUERY_ERRORS = Counter("vpn_bot_db_query_errors_total", "Запросы, завершившиеся ошибкой", ("helper",))
+EXTERNAL_CALL_SECONDS = Histogram("vpn_bot_external_call_duration_seconds",
+                                  "Время вызовов Telegram Bot API и платёжных провайдеров",
+                                  ("kind", "call"), LATENCY_BUCKETS)
+EXTERNAL_CALL_ERRORS = Counter("vpn_bot_external_call_errors_total",
+                               "Вызовы, завершившиеся исключением или HTTP-статусом >= 400", ("kind", "call"))
+LOOP_LAG_SECONDS = Histogram("vpn_bot_event_loop_lag_seconds",
+                             "Опоздание пульса event loop относительно расписания", (), LATENCY_BUCKETS)
+LOOP_STALLS = Counter("vpn_bot_event_loop_stalls_total",
+                      "Блокировки event loop дольше LOOP_STALL_MS по маршруту и месту в коде", ("route", "site"))
+LOOP_STALL_SECONDS = Counter("vpn_bot_event_loop_stall_seconds_total",
+                             "Суммарная длительность блокировок event loop", ("route", "site"))
+
+# Маршрут апдейта по умолчанию (button_callback уточняет его через set_trace_route)
+def update_route(update):
+    if not isinstance(update, Update):
+        return type(update).__name__
+    if update.callback_query:
+        return "callback"
+    if update.pre_checkout_query:
+        return "pre_checkout"
+    message = update.effective_message
+    if message:
+        if message.successful_payment:
+            return "successful_payment"
+        if message.document:
+            return "document"
+        if message.text and message.text.startswith('/'):
+            return f"command:{message.text.split()[0].split('@')[0][1:]}"
+        return "message"
+    return "other"
+
+def set_trace_route(route):
+    trace = current_trace.get()
+    if trace is not None:
+        trace.route = route
+
+class SecretRedactingFilter(logging.Filter):
+    """Вырезает токены и секреты из записей и обрезает слишком длинные сообщения (тела ответов API)."""
+
+    # Токен бота, в том числе внутри URL api.telegram.org/bot<token>/...
+    TOKEN_RE = re.compile(r'\d{6,}:[A-Za-z0-9_-]{30,}')
+    # Секретные поля в JSON/заголовках: "auth_secret": "...", Crypto-Pay-API-Token: ...
+    FIELD_RE = re.compile(r'((?:auth_secret|Crypto-Pay-API-Token|api_token)["\']?\s*[:=]\s*["\']?)[^"\',\s}]+', re.IGNORECASE)
+
+    def __init__(self, max_length=2000):
+        super().__init__()
+        self.max_length = max_length
+        self.secrets = []
+
+    def add_secrets(self, *values):
+        self.secrets.extend(v for v in values if v and len(v) >= 6)
+
+    def filter(self, record):
+        message = record.getMessage()
+        for secret in self.secrets:
+            message = message.replace(secret, '***')
+        message = self.TOKEN_RE.sub('<BOT_TOKEN>', message)
+        message = self.FIELD_RE.sub(r'\1***', message)
+        if len(message) > self.max_length:
+            message = message[:self.max_length] + f"... [обрезано {len(message) - self.max_length} симв.]"
+        record.msg = message
+        record.args = None
+        return True
+
+class LogSamplingFilter(logging.Filter):
+    """Пропускает только каждую N-ю INFO-запись шумных логгеров (httpx пишет строку на каждый запрос).
+    Предупреждения, ошибки и ответы со статусом >= 400 проходят всегда."""
+
+    def __init__(self, every, prefixes=('httpx', 'httpcore')):
+        super().__init__()
+        self.every = every
+        self.prefixes = prefixes
+        self.counters = {}
+
+    def filter(self, record):
+        if self.every <= 1 or record.levelno > logging.INFO or not record.name.startswith(self.prefixes):
+            return True
+        if isinstance(record.args, tuple) and any(isinstance(a, int) and a >= 400 for a in record.args):
+            return True
+        count = self.counters.get(record.name, 0)
+        self.counters[record.name] = count + 1
+        return count % self.every == 0
+
+class TraceContextFilter(logging.Filter):
+    """Добавляет к записи correlation id, пользователя и маршрут текущего апдейта.
+    Стоит на QueueHandler: contextvars доступны только в потоке, где пишется лог."""
+
+    def filter(self, record):
+        trace = current_trace.get()
+        if trace is not None:
+            record.trace_id = trace.trace_id
+            record.update_id = trace.update_id
+            record.user_id = trace.user_id
+            record.route = trace.route
+        return True
+
+class JsonLogFormatter(logging.Formatter):
+    """Одна JSON-строка на запись: время, уровень, логгер, сообщение и поля трассировки."""
+
+    FIELDS = ('trace_id', 'update_id', 'user_id', 'route', 'duration_ms', 'spans')
+
+    def format(self, record):
+        entry = {
+            'ts': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage(),
+        }
+        for field in self.FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = value
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+# Сжатие ротированных файлов лога
+def gzip_rotator(source, dest):
+    with open(source, 'rb') as f_in, gzip.open(dest, 'wb') as f_out:
+        shutil.copyfileobj(f_in, f_out)
+    os.remove(source)
+
+log_redactor = SecretRedactingFilter()
+
+# Настройка логирования: обработчики вызывают только QueueHandler (запись в очередь),
+# форматирование, редактирование секретов и запись на диск — в потоке QueueListener
+def setup_logging():
+    formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    file_formatter = JsonLogFormatter() if LOG_FORMAT == 'json' else formatter
+    if LOG_ROTATE_WHEN:
+        file_handler = logging.handlers.TimedRotatingFileHandler(LOG_FILE, when=LOG_ROTATE_WHEN, backupCount=LOG_BACKUP_COUNT, encoding='utf-8')
+    else:
+        file_handler = logging.handlers.RotatingFileHandler(LOG_FILE, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT, encoding='utf-8')
+    file_handler.rotator = gzip_rotator
+    file_handler.namer = lambda name: name + ".gz"
+    file_handler.setFormatter(file_formatter)
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(formatter)
+    for handler in (file_handler, stream_handler):
+        handler.addFilter(log_redactor)
+
+    log_queue = queue.Queue(-1)
+    queue_handler = logging.handlers.QueueHandler(log_queue)
+    queue_handler.addFilter(LogSamplingFilter(HTTPX_LOG_SAMPLE))
+    queue_handler.addFilter(TraceContextFilter())
+    root = logging.getLogger()
+    root.handlers = [queue_handler]
+    root.setLevel(logging.INFO)
+
+    listener = logging.handlers.QueueListener(log_queue, file_handler, stream_handler, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
+
 # Конфигурация бота
 try:
     from dotenv import load_dotenv
@@ -35,357 +328,1731 @@ try:
     STARS_PER_USDT = float(os.environ.get("STARS_PER_USDT", "70"))
     RUB_PER_USDT = float(os.environ.get("RUB_PER_USDT", "100"))  # курс: сколько RUB за 1 USDT
     CHANNEL_ID = os.environ.get("CHANNEL_ID", "@EcliptVPN")  # ID канала для обязательной подписки
+    # Рассылка: Telegram допускает ~30 сообщений/сек на бота, оставляем запас для обычного трафика
+    BROADCAST_RATE = float(os.environ.get("BROADCAST_RATE", "20"))  # сообщений в секунду
+    BROADCAST_WORKERS = int(os.environ.get("BROADCAST_WORKERS", "8"))  # параллельных отправителей
+    # Состояние диалогов в БД: как часто сбрасывать изменения и когда выгружать неактивных из памяти
+    PERSISTENCE_FLUSH_INTERVAL = float(os.environ.get("PERSISTENCE_FLUSH_INTERVAL", "30"))  # секунд
+    PERSISTENCE_IDLE_TIMEOUT = float(os.environ.get("PERSISTENCE_IDLE_TIMEOUT", "1800"))  # секунд
+    # Срок жизни счёта на покупку; на это время под счёт резервируется конфиг
+    INVOICE_LIFETIME = int(os.environ.get("INVOICE_LIFETIME", "3600"))  # секунд
+    # Сколько конфигов один пользователь может держать в резерве под неоплаченные счета
+    MAX_USER_RESERVATIONS = int(os.environ.get("MAX_USER_RESERVATIONS", "3"))
+    # При старте перепроверяются незавершённые платежи не старше RECONCILE_WINDOW; 0 отключает
+    RECONCILE_WINDOW = int(os.environ.get("RECONCILE_WINDOW", "86400"))  # секунд
+    # Напоминания об окончании подписки: за сколько дней (через запятую) и как часто проверять; 0 отключает
+    REMINDER_DAYS = sorted({int(days) for days in os.environ.get("REMINDER_DAYS", "3,1").split(",") if days.strip()})
+    REMINDER_INTERVAL = float(os.environ.get("REMINDER_INTERVAL", "3600"))  # секунд, общий для напоминаний и автопродления
+    # Автопродление с баланса: за сколько дней до окончания продлевать; 0 отключает
+    RENEW_BEFORE_DAYS = float(os.environ.get("RENEW_BEFORE_DAYS", "1"))
+    # Логи: ротация по размеру (LOG_MAX_BYTES) или по времени (LOG_ROTATE_WHEN, например midnight), старые файлы сжимаются
+    LOG_FILE = os.environ.get("LOG_FILE", "bot.log")
+    LOG_MAX_BYTES = int(os.environ.get("LOG_MAX_BYTES", str(10 * 1024 * 1024)))
+    LOG_BACKUP_COUNT = int(os.environ.get("LOG_BACKUP_COUNT", "10"))
+    LOG_ROTATE_WHEN = os.environ.get("LOG_ROTATE_WHEN", "")
+    HTTPX_LOG_SAMPLE = int(os.environ.get("HTTPX_LOG_SAMPLE", "100"))  # писать каждый N-й успешный HTTP-запрос
+    LOG_FORMAT = os.environ.get("LOG_FORMAT", "json")  # формат файла лога: json или text (консоль всегда text)
+    SLOW_UPDATE_MS = float(os.environ.get("SLOW_UPDATE_MS", "1000"))  # апдейты дольше пишутся с уровнем WARNING
+    # Хранилище: sqlite (файл DB_PATH) или postgres (DATABASE_URL, пул до PG_POOL_SIZE соединений)
+    STORAGE_BACKEND = os.environ.get("STORAGE_BACKEND", "sqlite").lower()
+    DB_PATH = os.environ.get("DB_PATH", "vpn_bot.db")
+    DATABASE_URL = os.environ.get("DATABASE_URL", "")
+    PG_POOL_SIZE = int(os.environ.get("PG_POOL_SIZE", "10"))
+    LOOP_STALL_MS = float(os.environ.get("LOOP_STALL_MS", "250"))  # блокировка event loop дольше — в лог со стеком; 0 отключает
+    SLOW_QUERY_MS = float(os.environ.get("SLOW_QUERY_MS", "50"))  # запросы дольше пишутся в лог с планом выполнения
+    # HTTP-эндпоинт /metrics; METRICS_PORT=0 отключает его
+    METRICS_HOST = os.environ.get("METRICS_HOST", "127.0.0.1")
+    METRICS_PORT = int(os.environ.get("METRICS_PORT", "9090"))
+    # Несколько процессов: BOT_ROLE=router получает апдейты (getUpdates) и раздаёт их по user_id
+    # воркерам BOT_ROLE=worker (WORKER_INDEX из WORKER_COUNT, порт WORKER_BASE_PORT + WORKER_INDEX)
+    BOT_ROLE = os.environ.get("BOT_ROLE", "single").lower()
+    WORKER_COUNT = int(os.environ.get("WORKER_COUNT", "1"))
+    WORKER_INDEX = int(os.environ.get("WORKER_INDEX", "0"))
+    WORKER_HOST = os.environ.get("WORKER_HOST", "127.0.0.1")
+    WORKER_BASE_PORT = int(os.environ.get("WORKER_BASE_PORT", "8600"))
+    WORKER_SECRET = os.environ.get("WORKER_SECRET", "")  # пусто — выводится из BOT_TOKEN
+    # Запись входящих апдейтов для replay.py (NDJSON, .gz сжимается); пусто — не записывать
+    UPDATE_RECORD_FILE = os.environ.get("UPDATE_RECORD_FILE", "")
+    UPDATE_RECORD_SALT = os.environ.get("UPDATE_RECORD_SALT", "")  # ключ обезличивания id; без него — случайный
 except (KeyError, ImportError) as e:
     logger.error(f"Отсутствует переменная окружения или dotenv: {e}")
     logger.error("Пожалуйста, установите переменные окружения: BOT_TOKEN, ADMIN_ID, CRYPTO_BOT_TOKEN")
     exit(1)
 
-CRYPTO_BOT_API_URL = "https://pay.crypt.bot/api"
-CRYSTAL_PAY_API_URL = "https://api.crystalpay.io/v2"
+log_redactor.add_secrets(BOT_TOKEN, CRYPTO_BOT_TOKEN, CRYSTAL_PAY_SECRET)
+log_listener = setup_logging()
+
+CRYPTO_BOT_API_URL = "https://pay.crypt.bot/api"
+CRYSTAL_PAY_API_URL = "https://api.crystalpay.io/v2"
+
+# Фиксированные цены в звёздах для тарифов
+STARS_PRICE_BY_PLAN = {
+    1: 50,    # 1 месяц
+    2: 110,   # 3 месяца
+    3: 205,   # 6 месяцев
+    4: 285    # 12 месяцев
+}
+
+# Список стран
+COUNTRIES = {
+    'de': '🇩🇪 Германия',
+    'ch': '🇨🇭 Швейцария',
+    'nl': '🇳🇱 Нидерланды',
+    'fi': '🇫🇮 Финляндия'
+}
+
+SLOW_QUERIES_TOP = 10  # сколько запросов показывать в админке
+
+# Форма параметров запроса без значений: (int, str) или 500 × (int, str) для executemany
+def describe_parameters(parameters, many=False):
+    if many:
+        if not isinstance(parameters, (list, tuple)):
+            return "iterator"
+        if not parameters:
+            return "0 ×"
+        return f"{len(parameters)} × {describe_parameters(parameters[0])}"
+    if isinstance(parameters, dict):
+        return "{" + ", ".join(f"{k}: {type(v).__name__}" for k, v in parameters.items()) + "}"
+    return "(" + ", ".join(type(v).__name__ for v in parameters) + ")"
+
+class SlowQueryLog:
+    """Медленные запросы, сгруппированные по тексту SQL: число, суммарное и максимальное время, план."""
+
+    EXPLAINABLE = ('SELECT', 'INSERT', 'UPDATE', 'DELETE', 'REPLACE', 'WITH')
+    MAX_STATEMENTS = 500
+
+    def __init__(self):
+        self.statements = {}
+        self.lock = threading.Lock()
+
+    def record(self, conn, helper, sql, parameters, duration, many=False):
+        statement = ' '.join(sql.split())
+        shape = describe_parameters(parameters, many)
+        with self.lock:
+            entry = self.statements.get(statement)
+            plan = entry['plan'] if entry else None
+        if plan is None:
+            plan = self.explain(conn, statement, parameters, many)
+        with self.lock:
+            entry = self.statements.get(statement)
+            if entry is None:
+                if len(self.statements) >= self.MAX_STATEMENTS:
+                    # Вытесняем самый «быстрый» из медленных, чтобы динамический SQL не раздул память
+                    fastest = min(self.statements, key=lambda k: self.statements[k]['max'])
+                    del self.statements[fastest]
+                entry = self.statements[statement] = {
+                    'helpers': set(), 'count': 0, 'total': 0.0, 'max': 0.0, 'params': shape, 'plan': plan,
+                }
+            entry['helpers'].add(helper)
+            entry['count'] += 1
+            entry['total'] += duration
+            entry['max'] = max(entry['max'], duration)
+            entry['params'] = shape
+        logger.warning(
+            f"Медленный запрос {duration * 1000:.1f} мс в {helper}: {statement} | "
+            f"параметры: {shape} | план: {'; '.join(plan) if plan else '-'}"
+        )
+
+    def explain(self, conn, statement, parameters, many):
+        if not statement.upper().startswith(self.EXPLAINABLE):
+            return []
+        if many:
+            if not isinstance(parameters, (list, tuple)) or not parameters:
+                return []
+            parameters = parameters[0]
+        try:
+            return conn.query_plan(statement, parameters)
+        except Exception as e:
+            return [f"не удалось получить план: {e}"]
+
+    def top(self, limit=10):
+        with self.lock:
+            entries = [dict(entry, sql=sql, helpers=sorted(entry['helpers'])) for sql, entry in self.statements.items()]
+        return sorted(entries, key=lambda entry: entry['max'], reverse=True)[:limit]
+
+slow_query_log = SlowQueryLog()
+
+# Учёт выполненного запроса: спан 'db' с именем хелпера, открывшего соединение, и лог медленных
+def observe_query(conn, sql, parameters, duration, ok, many=False):
+    helper = conn.helper
+    record_span('db', helper, duration, ok)
+    if duration * 1000 >= SLOW_QUERY_MS:
+        slow_query_log.record(conn, helper, sql, parameters, duration, many)
+
+class TracedCursor(sqlite3.Cursor):
+    """Курсор, замеряющий каждый запрос (спан 'db' с именем хелпера, открывшего соединение).
+    Запросы дольше SLOW_QUERY_MS попадают в slow_query_log вместе с планом выполнения."""
+
+    def execute(self, sql, parameters=()):
+        start = time.perf_counter()
+        ok = False
+        try:
+            result = super().execute(sql, parameters)
+            ok = True
+            return result
+        finally:
+            observe_query(self.connection, sql, parameters, time.perf_counter() - start, ok)
+
+    def executemany(self, sql, seq_of_parameters):
+        start = time.perf_counter()
+        ok = False
+        try:
+            result = super().executemany(sql, seq_of_parameters)
+            ok = True
+            return result
+        finally:
+            observe_query(self.connection, sql, seq_of_parameters, time.perf_counter() - start, ok, many=True)
+
+class TracedConnection(sqlite3.Connection):
+    helper = 'unknown'
+
+    def cursor(self, factory=TracedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+    def query_plan(self, statement, parameters):
+        # Обычный курсор, чтобы сам EXPLAIN не замерялся и не попадал в лог
+        cursor = super().cursor(sqlite3.Cursor)
+        cursor.execute(f"EXPLAIN QUERY PLAN {statement}", parameters)
+        return [row[3] for row in cursor.fetchall()]
+
+# Соединение с БД. Запросы атрибутируются функции, вызвавшей db_connect (get_balance, create_order, ...)
+def db_connect(database=None, **kwargs):
+    conn = sqlite3.connect(database or DB_PATH, factory=TracedConnection, **kwargs)
+    conn.helper = sys._getframe(1).f_code.co_name
+    return conn
+
+ORDERS_PAGE_SIZE = 5  # заказов на одной странице «Мои VPN»
+PAYMENTS_PAGE_SIZE = 8  # платежей на одной странице истории
+PROMOS_PAGE_SIZE = 8  # промокодов на одной странице списка
+
+# Конвертация RUB->USDT
+def rub_to_usdt(rub_amount):
+    try:
+        return round(float(rub_amount) / RUB_PER_USDT, 2)
+    except Exception:
+        return 0.0
+
+# Keyset-пагинация «от новых к старым» по sort_cols (последняя колонка — id).
+# Курсор — id крайней строки страницы, значения sort_cols для него подставляет anchor_sql,
+# поэтому в callback_data достаточно одного числа. Возвращает (rows, has_newer, has_older).
+def fetch_keyset_page(cursor, query, params, sort_cols, anchor_sql, after_id=None, before_id=None, limit=10):
+    key = f"({', '.join(sort_cols)})"
+    if before_id is not None:
+        # Назад: идём к более новым строкам по возрастанию и разворачиваем
+        order = ', '.join(f"{col} ASC" for col in sort_cols)
+        cursor.execute(f"{query} AND {key} > ({anchor_sql}) ORDER BY {order} LIMIT ?", (*params, before_id, limit + 1))
+        rows = cursor.fetchall()
+        return rows[:limit][::-1], len(rows) > limit, True
+    order = ', '.join(f"{col} DESC" for col in sort_cols)
+    if after_id is not None:
+        cursor.execute(f"{query} AND {key} < ({anchor_sql}) ORDER BY {order} LIMIT ?", (*params, after_id, limit + 1))
+    else:
+        cursor.execute(f"{query} ORDER BY {order} LIMIT ?", (*params, limit + 1))
+    rows = cursor.fetchall()
+    return rows[:limit], after_id is not None, len(rows) > limit
+
+# Кнопки «Назад/Далее» для страницы, полученной через fetch_keyset_page
+def keyset_nav_buttons(rows, has_newer, has_older, prefix):
+    nav = []
+    if rows and has_newer:
+        nav.append(InlineKeyboardButton("◀️ Назад", callback_data=f"{prefix}_p{rows[0][0]}"))
+    if rows and has_older:
+        nav.append(InlineKeyboardButton("Далее ▶️", callback_data=f"{prefix}_n{rows[-1][0]}"))
+    return nav
+
+# Фильтры истории платежей: короткие коды для callback_data -> (подпись, значения в БД)
+PAYMENT_STATUS_FILTERS = {
+    'a': ("Все", None),
+    'p': ("✅ Оплачены", ('paid',)),
+    'w': ("⏳ Ожидают", ('pending', 'active')),
+    'x': ("⌛ Истекли", ('expired',)),
+}
+PAYMENT_TYPE_FILTERS = {
+    'a': ("Все", None),
+    't': ("💰 Пополнения", 'topup'),
+    'b': ("🛍️ Покупки", 'purchase'),
+}
+
+# Статусы для ленты платежей в админке (по одному статусу — чтобы работал индекс status, created_at, id)
+ADMIN_PAYMENT_STATUSES = {
+    'a': ("Все", None),
+    'p': ("✅ paid", 'paid'),
+    'w': ("⏳ pending", 'pending'),
+    'c': ("🕓 active", 'active'),
+    'x': ("⌛ expired", 'expired'),
+}
+
+# Фильтры списка промокодов: код для callback_data -> (подпись, условие SQL)
+PROMO_FILTERS = {
+    'a': ("Все", "1 = 1"),
+    'v': ("✅ Активные", "is_active = TRUE AND (expires_at IS NULL OR expires_at > :now) "
+                        "AND (max_activations IS NULL OR used_activations < max_activations)"),
+    'x': ("⌛ Истекли", "expires_at IS NOT NULL AND expires_at <= :now"),
+    'e': ("🔚 Исчерпаны", "max_activations IS NOT NULL AND used_activations >= max_activations"),
+    'd': ("❌ Выключены", "is_active = FALSE"),
+}
+
+class Storage:
+    """Хранилище бота: пользователи, тарифы, конфиги, заказы, платежи, промокоды, рассылки и состояние диалогов.
+
+    Запросы здесь общие для бэкендов (плейсхолдеры ?/:name, UPSERT через ON CONFLICT, TRUE/FALSE);
+    бэкенд даёт соединение (connect), схему (init_schema) и то, что в диалектах различается.
+    Каждый метод открывает и закрывает своё соединение — как раньше функции модуля.
+    """
+
+    IntegrityError = Exception  # ошибка нарушения ограничения у драйвера бэкенда
+    BEGIN = "BEGIN"
+
+    # Соединение с учётом запросов на имя вызвавшего метода (get_balance, create_order, ...)
+    def connect(self, **kwargs):
+        raise NotImplementedError
+
+    # Соединение, в котором транзакцию открывают и закрывают явно (BEGIN ... COMMIT)
+    def connect_transaction(self):
+        raise NotImplementedError
+
+    def init_schema(self):
+        raise NotImplementedError
+
+    # Вставка строки с автоинкрементным id, возвращает id
+    def insert_returning_id(self, cursor, sql, parameters):
+        cursor.execute(sql, parameters)
+        return cursor.lastrowid
+
+    # Пользователи
+
+    def get_balance(self, user_id):
+        with closing(self.connect()) as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT balance FROM users WHERE user_id = ?", (user_id,))
+            result = cursor.fetchone()
+        return result[0] if result else 0.0
+
+    def get_auto_renew(self, user_id):
+        with closing(self.connect()) as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT auto_renew FROM users WHERE user_id = ?", (user_id,))
+            result = cursor.fetchone()
+        return bool(result and result[0])
+
+    # Переключить автопродление; возвращает новое значение
+    def toggle_auto_renew(self, user_id):
+        with closing(self.connect()) as conn:
+            cursor = conn.cursor()
+            cursor.execute("UPDATE users SET auto_renew = NOT auto_renew WHERE user_id = ? RETURNING auto_renew", (user_id,))
+            result = cursor.fetchone()
+            conn.commit()
+        return bool(result and result[0])
+
+    def update_balance(self, user_id, amount):
+        with closing(self.connect()) as conn:
+            cursor = conn.cursor()
+            cursor.execute("""
+                UPDATE users SET balance = balance + ? WHERE user_id = ?
+            """, (amount, user_id))
+            conn.commit()
+
+    def save_user(self, user):
+        with closing(self.connect()) as conn:
+            cursor = conn.cursor()
+            # Повторный /start сбрасывает is_blocked: раз пользователь написал боту, он его не блокирует
+            cursor.execute("""
+                INSERT INTO users (user_id, username, first_name, last_name, balance, is_blocked)
+                VALUES (?, ?, ?, ?, 0.0, FALSE)
+                ON CONFLICT (user_id) DO UPDATE SET
+                    username = excluded.username, first_name = excluded.first_name,
+                    last_name = excluded.last_name, is_blocked = FALSE
+            """, (user.id, user.username, user.first_name, user.last_name))
+            conn.commit()
+        logger.info(f"Пользователь сохранён: user_id={user.id}, username={user.username}")
+
+    # Поиск пользователей для админки: точный ID или начало username (индекс idx_users_username)
+    def search_users(self, term, limit=10):
+        term = term.strip().lstrip('@')
+        with closing(self.connect()) as conn:
+            cursor = conn.cursor()
+            if term.isdigit():
+                cursor.execute("SELECT user_id, username, first_name FROM users WHERE user_id = ?", (int(term),))
+            else:
+                pattern = term.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+                cursor.execute(self.USERNAME_SEARCH_SQL, (pattern, limit + 1))
+            users = cursor.fetchall()
+        return users
+
+    USERNAME_SEARCH_SQL = """
+        SELECT user_id, username, first_name FROM users
+        WHERE username LIKE ? ESCAPE '\\'
+        ORDER BY username COLLATE NOCASE
+        LIMIT ?
+    """
+
+    # Карточка пользователя для админки
+    def get_user_card(self, user_id):
+        with closing(self.connect()) as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT user_id, username, first_name, last_name, balance, is_blocked FROM users WHERE user_id = ?", (user_id,))
+            user = cursor.fetchone()
+            if not user:
+                return None
+            cursor.execute("SELECT COUNT(*) FROM orders WHERE user_id = ? AND expiry_date > CURRENT_TIMESTAMP", (user_id,))
+            active_orders = cursor.fetchone()[0]
+            cursor.execute("SELECT COUNT(*), COALESCE(SUM(amount), 0) FROM payments WHERE user_id = ? AND status = 'paid'", (user_id,))
+            paid_count, paid_sum = cursor.fetchone()
+        return tuple(user) + (active_orders, paid_count, paid_sum)
+
+    # Тарифы и конфиги
+
+    def get_plans(self):
+        with closing(self.connect()) as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT * FROM plans ORDER BY duration")
+            plans = cursor.fetchall()
+        return plans
+
+    # Блокировка строки при выборе свободного конфига (у Postgres — FOR UPDATE SKIP LOCKED)
+    LOCK_FREE_CONFIG = ""
+
+    # Первый свободный конфиг тарифа и страны: не продан и не зарезервирован (или резерв истёк).
+    # Параметры: plan_id, country, текущее время
+    def free_config_sql(self):
+        return f"""
+            SELECT id FROM configs
+            WHERE plan_id = ? AND country = ? AND is_used = FALSE
+              AND (reserved_until IS NULL OR reserved_until < ?)
+            LIMIT 1 {self.LOCK_FREE_CONFIG}
+        """
+
+    # Выполняет fn(cursor) в явной транзакции; fn возвращает (commit, результат)
+    def run_transaction(self, conn, fn):
+        cursor = conn.cursor()
+        try:
+            cursor.execute(self.BEGIN)
+            commit, result = fn(cursor)
+            cursor.execute("COMMIT" if commit else "ROLLBACK")
+            return result
+        except Exception:
+            if conn.in_transaction:
+                cursor.execute("ROLLBACK")
+            raise
+        finally:
+            conn.close()
+
+    # Захват конфига одним условным UPDATE: два процесса не получат один и тот же конфиг.
+    # С reservation сначала берётся конфиг, зарезервированный под этот счёт (поиск по ключу);
+    # если резерв истёк и конфиг успели продать — любой свободный.
+    def _claim_config_order(self, cursor, user_id, plan_id, country, duration, reservation=None):
+        row = None
+        if reservation:
+            cursor.execute("""
+                UPDATE configs SET is_used = TRUE, reserved_until = NULL, reserved_for = NULL
+                WHERE reserved_by = ? AND is_used = FALSE
+                RETURNING id, config
+            """, (reservation,))
+            row = cursor.fetchone()
+        if not row:
+            cursor.execute(f"""
+                UPDATE configs SET is_used = TRUE, reserved_by = NULL, reserved_until = NULL, reserved_for = NULL
+                WHERE is_used = FALSE AND id = ({self.free_config_sql()})
+                RETURNING id, config
+            """, (plan_id, country, datetime.now()))
+            row = cursor.fetchone()
+        if not row:
+            return None
+        config_id, config = row
+        expiry_date = datetime.now() + timedelta(days=duration * 30)
+        order_id = self.insert_returning_id(cursor, """
+            INSERT INTO orders (user_id, plan_id, config_id, expiry_date)
+            VALUES (?, ?, ?, ?)
+        """, (user_id, plan_id, config_id, expiry_date))
+        return order_id, config
+
+    # Выдача конфига по оплаченному заказу: захват конфига и заказ одной транзакцией.
+    # Возвращает (order_id, config) или None, если конфиги закончились.
+    def claim_config_order(self, user_id, plan_id, country, duration, reservation=None):
+        def claim(cursor):
+            result = self._claim_config_order(cursor, user_id, plan_id, country, duration, reservation)
+            return result is not None, result
+        return self.run_transaction(self.connect_transaction(), claim)
+
+    # Резерв конфига под выставленный счёт до reserved_until одной транзакцией. Прежний резерв
+    # пользователя на тот же тариф и страну снимается (повторные нажатия «Купить» не копят резервы),
+    # всего активных резервов у пользователя не больше MAX_USER_RESERVATIONS.
+    # Возвращает 'ok', 'limit' или 'sold_out'.
+    def reserve_config(self, reservation, user_id, plan_id, country, reserved_until):
+        def reserve(cursor):
+            now = datetime.now()
+            cursor.execute("""
+                UPDATE configs SET reserved_by = NULL, reserved_until = NULL, reserved_for = NULL
+                WHERE reserved_for = ? AND plan_id = ? AND country = ? AND is_used = FALSE
+            """, (user_id, plan_id, country))
+            cursor.execute("""
+                SELECT COUNT(*) FROM configs
+                WHERE reserved_for = ? AND is_used = FALSE AND reserved_until >= ?
+            """, (user_id, now))
+            if cursor.fetchone()[0] >= MAX_USER_RESERVATIONS:
+                return True, 'limit'
+            cursor.execute(f"""
+                UPDATE configs SET reserved_by = ?, reserved_until = ?, reserved_for = ?
+                WHERE is_used = FALSE AND id = ({self.free_config_sql()})
+                RETURNING id
+            """, (reservation, reserved_until, user_id, plan_id, country, now))
+            return True, ('ok' if cursor.fetchone() is not None else 'sold_out')
+        return self.run_transaction(self.connect_transaction(), reserve)
+
+    # Снять резерв (счёт истёк или не создался), конфиг снова свободен
+    def release_reservation(self, reservation):
+        with closing(self.connect()) as conn:
+            cursor = conn.cursor()
+            cursor.execute("""
+                UPDATE configs SET reserved_by = NULL, reserved_until = NULL, reserved_for = NULL
+                WHERE reserved_by = ? AND is_used = FALSE
+            """, (reservation,))
+            conn.commit()
+
+    # Списание внутри транзакции покупки или продления: только при достаточном балансе
+    def _debit_balance(self, cursor, user_id, amount):
+        cursor.execute("UPDATE users SET balance = balance - ? WHERE user_id = ? AND balance >= ?", (amount, user_id, amount))
+        return cursor.rowcount > 0
+
+    # Покупка с баланса одной транзакцией: списание только при достаточном балансе, захват конфига, заказ.
+    # Возвращает ('ok', config), ('no_funds', None) или ('no_configs', None) — в последних двух ничего не списано.
+    def purchase_with_balance(self, user_id, plan_id, country, price, duration):
+        def purchase(cursor):
+            if not self._debit_balance(cursor, user_id, price):
+                return False, ('no_funds', None)
+            result = self._claim_config_order(cursor, user_id, plan_id, country, duration)
+            if result is None:
+                return False, ('no_configs', None)
+            return True, ('ok', result[1])
+        return self.run_transaction(self.connect_transaction(), purchase)
+
+    # Загрузка конфигов из файла админа одной транзакцией
+    def add_configs(self, plan_id, country, configs):
+        with closing(self.connect()) as conn:
+            cursor = conn.cursor()
+            cursor.executemany("INSERT INTO configs (plan_id, country, config) VALUES (?, ?, ?)",
+                               [(plan_id, country, config) for config in configs])
+            conn.commit()
+
+    def get_configs_stats(self):
+        with closing(self.connect()) as conn:
+            cursor = conn.cursor()
+            cursor.execute("""
+                SELECT p.name, c.country, COUNT(*) as count
+                FROM configs c
+                JOIN plans p ON c.plan_id = p.id
+                WHERE c.is_used = FALSE
+                GROUP BY p.id, c.country
+            """)
+            stats = cursor.fetchall()
+        return stats
+
+    # Заказы
+
+    def create_order(self, user_id, plan_id, config_id, duration):
+        expiry_date = datetime.now() + timedelta(days=duration * 30)
+        with closing(self.connect()) as conn:
+            cursor = conn.cursor()
+            order_id = self.insert_returning_id(cursor, """
+                INSERT INTO orders (user_id, plan_id, config_id, expiry_date)
+                VALUES (?, ?, ?, ?)
+            """, (user_id, plan_id, config_id, expiry_date))
+            conn.commit()
+        return order_id
+
+    def get_user_orders(self, user_id):
+        with closing(self.connect()) as conn:
+            cursor = conn.cursor()
+            cursor.execute("""
+                SELECT o.id, p.name, o.order_date, o.expiry_date, c.config, c.country
+                FROM orders o
+                JOIN plans p ON o.plan_id = p.id
+                LEFT JOIN configs c ON o.config_id = c.id
+                WHERE o.user_id = ? AND o.expiry_date > CURRENT_TIMESTAMP
+                ORDER BY o.order_date DESC
+            """, (user_id,))
+            orders = cursor.fetchall()
+        return orders
+
+    # Страница активных заказов пользователя без текста конфигов
+    def get_user_orders_page(self, user_id, after_order_id=None, before_order_id=None, limit=ORDERS_PAGE_SIZE):
+        with closing(self.connect()) as conn:
+            cursor = conn.cursor()
+            page = fetch_keyset_page(
+                cursor,
+                """
+                SELECT o.id, p.name, o.order_date, o.expiry_date, c.country
+                FROM orders o
+                JOIN plans p ON o.plan_id = p.id
+                LEFT JOIN configs c ON o.config_id = c.id
+                WHERE o.user_id = ? AND o.expiry_date > CURRENT_TIMESTAMP
+                """,
+                (user_id,),
+                ("o.order_date", "o.id"),
+                "SELECT order_date, id FROM orders WHERE id = ?",
+                after_order_id, before_order_id, limit
+            )
+        return page
+
+    # Конфиг конкретного заказа (только если заказ принадлежит пользователю)
+    def get_order_config(self, user_id, order_id):
+        with closing(self.connect()) as conn:
+            cursor = conn.cursor()
+            cursor.execute("""
+                SELECT c.config, c.country
+                FROM orders o
+                JOIN configs c ON o.config_id = c.id
+                WHERE o.id = ? AND o.user_id = ?
+            """, (order_id, user_id))
+            result = cursor.fetchone()
+        return result
+
+    # Заказы, истекающие в (after, until], без напоминания за days дней или с более ранним (индекс idx_orders_expiry)
+    def get_expiring_orders(self, after, until, days, limit):
+        with closing(self.connect()) as conn:
+            cursor = conn.cursor()
+            cursor.execute("""
+                SELECT o.id, o.user_id, o.expiry_date, p.name, c.country, u.auto_renew, u.balance, p.price
+                FROM orders o
+                JOIN users u ON o.user_id = u.user_id
+                LEFT JOIN plans p ON o.plan_id = p.id
+                LEFT JOIN configs c ON o.config_id = c.id
+                WHERE o.expiry_date > ? AND o.expiry_date <= ?
+                  AND (o.reminder_days IS NULL OR o.reminder_days > ?)
+                  AND u.is_blocked = FALSE
+                ORDER BY o.expiry_date, o.id
+                LIMIT ?
+            """, (after, until, days, limit))
+            orders = cursor.fetchall()
+        return orders
+
+    # Отметить напоминание за days дней (до отправки — повторно заказ в эту выборку не попадёт)
+    def mark_orders_reminded(self, order_ids, days):
+        with closing(self.connect()) as conn:
+            cursor = conn.cursor()
+            cursor.executemany("UPDATE orders SET reminder_days = ? WHERE id = ?", [(days, order_id) for order_id in order_ids])
+            conn.commit()
+
+    # Отметить, что владельцу сообщили о нехватке средств на автопродление (сбрасывается при продлении)
+    def mark_orders_renew_notified(self, order_ids):
+        with closing(self.connect()) as conn:
+            cursor = conn.cursor()
+            cursor.executemany("UPDATE orders SET renew_notified = TRUE WHERE id = ?", [(order_id,) for order_id in order_ids])
+            conn.commit()
+
+    # Заказы пользователей с автопродлением, истекающие до until, после курсора (expiry_date, id) — индекс idx_orders_expiry
+    def get_renewable_orders(self, after_expiry, after_id, until, limit):
+        with closing(self.connect()) as conn:
+            cursor = conn.cursor()
+            cursor.execute("""
+                SELECT o.id, o.user_id, o.expiry_date, o.renew_notified, p.name, p.duration, p.price
+                FROM orders o
+                JOIN users u ON o.user_id = u.user_id
+                JOIN plans p ON o.plan_id = p.id
+                WHERE (o.expiry_date, o.id) > (?, ?) AND o.expiry_date <= ?
+                  AND u.auto_renew = TRUE
+                ORDER BY o.expiry_date, o.id
+                LIMIT ?
+            """, (after_expiry, after_id, until, limit))
+            orders = cursor.fetchall()
+        return orders
+
+    # Продление пачки заказов одной транзакцией: списание как при покупке с баланса и сдвиг срока того же заказа
+    # (конфиг остаётся прежним). renewals — [(order_id, user_id, expiry_date, new_expiry_date, price)];
+    # старый срок сверяется, чтобы заказ не продлили дважды. Возвращает (продлённые order_id, order_id без средств)
+    def renew_orders(self, renewals):
+        def renew(cursor):
+            renewed, no_funds = [], []
+            for order_id, user_id, expiry_date, new_expiry_date, price in renewals:
+                if not self._debit_balance(cursor, user_id, price):
+                    no_funds.append(order_id)
+                    continue
+                cursor.execute("""
+                    UPDATE orders SET expiry_date = ?, reminder_days = NULL, renew_notified = FALSE
+                    WHERE id = ? AND expiry_date = ?
+                """, (new_expiry_date, order_id, expiry_date))
+                if cursor.rowcount == 0:
+                    cursor.execute("UPDATE users SET balance = balance + ? WHERE user_id = ?", (price, user_id))
+                    continue
+                renewed.append(order_id)
+            return True, (renewed, no_funds)
+        return self.run_transaction(self.connect_transaction(), renew)
+
+    # Сводка для экрана статистики админки
+    def get_admin_stats(self):
+        with closing(self.connect()) as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT COUNT(*) FROM users")
+            users_count = cursor.fetchone()[0]
+            cursor.execute("SELECT COUNT(*) FROM orders WHERE expiry_date > CURRENT_TIMESTAMP")
+            active_orders = cursor.fetchone()[0]
+            cursor.execute("SELECT SUM(amount) FROM payments WHERE status = 'paid'")
+            total_revenue = cursor.fetchone()[0] or 0
+            # Количество использованных промокодов
+            cursor.execute("SELECT COUNT(*) FROM promo_activations")
+            promo_used = cursor.fetchone()[0]
+            # Сумма выданных бонусов через промокоды
+            cursor.execute("SELECT SUM(p.amount) FROM promo_activations a JOIN promo_codes p ON a.code = p.code")
+            promo_bonus = cursor.fetchone()[0] or 0
+        return users_count, active_orders, total_revenue, promo_used, promo_bonus
+
+    # Платежи
+
+    def get_pending_payments_stats(self):
+        with closing(self.connect()) as conn:
+            cursor = conn.cursor()
+            cursor.execute("""
+                SELECT type, COUNT(*) FROM payments
+                WHERE status IN ('pending', 'active')
+                GROUP BY type
+            """)
+            stats = cursor.fetchall()
+        return stats
+
+    def create_payment(self, user_id, payment_type, plan_id, amount, invoice_id=None, country=None):
+        invoice_id = invoice_id or str(uuid.uuid4())
+        with closing(self.connect()) as conn:
+            cursor = conn.cursor()
+            cursor.execute("""
+                INSERT INTO payments (user_id, type, plan_id, invoice_id, amount, country)
+                VALUES (?, ?, ?, ?, ?, ?)
+            """, (user_id, payment_type, plan_id, invoice_id, amount, country))
+            conn.commit()
+        logger.info(f"Создан платёж: user_id={user_id}, type={payment_type}, plan_id={plan_id}, amount={amount}, invoice_id={invoice_id}")
+        return invoice_id
+
+    def update_cryptobot_invoice_id(self, internal_invoice_id, cb_invoice_id):
+        with closing(self.connect()) as conn:
+            cursor = conn.cursor()
+            # Столбец текстовый: CryptoBot отдаёт число
+            cursor.execute("""
+                UPDATE payments SET cryptobot_invoice_id = ? WHERE invoice_id = ?
+            """, (None if cb_invoice_id is None else str(cb_invoice_id), internal_invoice_id))
+            conn.commit()
+
+    def update_crystal_pay_id(self, internal_invoice_id, crystal_id):
+        with closing(self.connect()) as conn:
+            cursor = conn.cursor()
+            cursor.execute("""
+                UPDATE payments SET crystal_pay_id = ? WHERE invoice_id = ?
+            """, (crystal_id, internal_invoice_id))
+            conn.commit()
+
+    # Оплаченный платёж больше не меняет статус (поздняя проверка не вернёт его в expired/active).
+    # True — статус изменился этим вызовом
+    def update_payment_status(self, invoice_id, status):
+        with closing(self.connect()) as conn:
+            cursor = conn.cursor()
+            cursor.execute("""
+                UPDATE payments SET status = ? WHERE invoice_id = ? AND status NOT IN ('paid', ?)
+            """, (status, invoice_id, status))
+            changed = cursor.rowcount > 0
+            conn.commit()
+        return changed
+
+    # Перевод платежа в paid ровно один раз (для всех процессов): True — этот вызов провёл платёж
+    # и должен выдать товар; для пополнений баланс зачисляется в той же транзакции.
+    def settle_payment(self, invoice_id, credit_balance=False):
+        def settle(cursor):
+            cursor.execute("UPDATE payments SET status = 'paid' WHERE invoice_id = ? AND status <> 'paid'", (invoice_id,))
+            if cursor.rowcount == 0:
+                return False, False
+            if credit_balance:
+                cursor.execute("""
+                    UPDATE users SET balance = balance + (SELECT amount FROM payments WHERE invoice_id = ?)
+                    WHERE user_id = (SELECT user_id FROM payments WHERE invoice_id = ?)
+                """, (invoice_id, invoice_id))
+            return True, True
+        return self.run_transaction(self.connect_transaction(), settle)
+
+    # Платёж, пришедший уже оплаченным (Telegram Stars): запись по внешнему id с ON CONFLICT DO NOTHING,
+    # повторная доставка того же платежа вернёт False
+    def settle_external_payment(self, invoice_id, user_id, payment_type, plan_id, amount, credit_balance=False):
+        def settle(cursor):
+            cursor.execute("""
+                INSERT INTO payments (user_id, type, plan_id, invoice_id, amount, status)
+                VALUES (?, ?, ?, ?, ?, 'paid')
+                ON CONFLICT (invoice_id) DO NOTHING
+            """, (user_id, payment_type, plan_id, invoice_id, amount))
+            if cursor.rowcount == 0:
+                return False, False
+            if credit_balance:
+                cursor.execute("UPDATE users SET balance = balance + ? WHERE user_id = ?", (amount, user_id))
+            return True, True
+        return self.run_transaction(self.connect_transaction(), settle)
+
+    # Оплата покупки и выдача конфига одной транзакцией: падение процесса между ними не оставит
+    # оплаченный платёж без заказа. Возвращает ('ok', (order_id, config)), ('no_configs', None) —
+    # платёж всё равно проведён, деньги получены — или ('duplicate', None), если его уже провели.
+    def settle_purchase(self, invoice_id, user_id, plan_id, country, duration, reservation=None):
+        def settle(cursor):
+            cursor.execute("UPDATE payments SET status = 'paid' WHERE invoice_id = ? AND status <> 'paid'", (invoice_id,))
+            if cursor.rowcount == 0:
+                return False, ('duplicate', None)
+            result = self._claim_config_order(cursor, user_id, plan_id, country, duration, reservation)
+            if result is None:
+                return True, ('no_configs', None)
+            return True, ('ok', result)
+        return self.run_transaction(self.connect_transaction(), settle)
+
+    # То же для покупки, пришедшей уже оплаченной (Telegram Stars)
+    def settle_external_purchase(self, invoice_id, user_id, plan_id, amount, country, duration, reservation=None):
+        def settle(cursor):
+            cursor.execute("""
+                INSERT INTO payments (user_id, type, plan_id, invoice_id, amount, country, status)
+                VALUES (?, 'purchase', ?, ?, ?, ?, 'paid')
+                ON CONFLICT (invoice_id) DO NOTHING
+            """, (user_id, plan_id, invoice_id, amount, country))
+            if cursor.rowcount == 0:
+                return False, ('duplicate', None)
+            result = self._claim_config_order(cursor, user_id, plan_id, country, duration, reservation)
+            if result is None:
+                return True, ('no_configs', None)
+            return True, ('ok', result)
+        return self.run_transaction(self.connect_transaction(), settle)
+
+    # Момент seconds секунд назад в тех же часах, что и DEFAULT CURRENT_TIMESTAMP у created_at
+    # (у SQLite — UTC, у Postgres — часовой пояс сессии); параметр — seconds
+    SECONDS_AGO_SQL = "datetime('now', '-' || ? || ' seconds')"
+
+    # Незавершённые платежи, созданные за последние seconds секунд, для сверки при старте.
+    # Граница считается в базе: часы created_at у бэкендов разные
+    def get_pending_payments(self, seconds):
+        with closing(self.connect()) as conn:
+            cursor = conn.cursor()
+            cursor.execute(f"""
+                SELECT p.invoice_id, p.user_id, p.type, p.plan_id, p.amount, p.cryptobot_invoice_id, p.crystal_pay_id, pl.name, p.country
+                FROM payments p
+                LEFT JOIN plans pl ON p.plan_id = pl.id
+                WHERE p.status IN ('pending', 'active') AND p.created_at >= {self.SECONDS_AGO_SQL}
+                ORDER BY p.created_at, p.id
+            """, (seconds,))
+            payments = cursor.fetchall()
+        return payments
+
+    # Страница платежей пользователя (индекс user_id, created_at, id)
+    def get_user_payments_page(self, user_id, statuses=None, payment_type=None, after_id=None, before_id=None, limit=PAYMENTS_PAGE_SIZE):
+        query = """
+            SELECT p.id, p.type, p.amount, p.status, p.created_at, pl.name
+            FROM payments p
+            LEFT JOIN plans pl ON p.plan_id = pl.id
+            WHERE p.user_id = ?
+        """
+        params = [user_id]
+        if statuses:
+            query += f" AND p.status IN ({', '.join('?' * len(statuses))})"
+            params.extend(statuses)
+        if payment_type:
+            query += " AND p.type = ?"
+            params.append(payment_type)
+        with closing(self.connect()) as conn:
+            cursor = conn.cursor()
+            page = fetch_keyset_page(
+                cursor, query, params,
+                ("p.created_at", "p.id"),
+                "SELECT created_at, id FROM payments WHERE id = ?",
+                after_id, before_id, limit
+            )
+        return page
+
+    # Страница всех платежей (для админки), опционально по одному статусу
+    def get_payments_page(self, status=None, after_id=None, before_id=None, limit=PAYMENTS_PAGE_SIZE):
+        query = "SELECT p.id, p.user_id, p.type, p.amount, p.status, p.created_at FROM payments p WHERE 1 = 1"
+        params = []
+        if status:
+            query += " AND p.status = ?"
+            params.append(status)
+        with closing(self.connect()) as conn:
+            cursor = conn.cursor()
+            page = fetch_keyset_page(
+                cursor, query, params,
+                ("p.created_at", "p.id"),
+                "SELECT created_at, id FROM payments WHERE id = ?",
+                after_id, before_id, limit
+            )
+        return page
+
+    def get_payment(self, internal_invoice_id):
+        with closing(self.connect()) as conn:
+            cursor = conn.cursor()
+            cursor.execute("""
+                SELECT p.id, p.user_id, p.type, p.plan_id, p.amount, p.invoice_id, p.cryptobot_invoice_id, p.crystal_pay_id, p.status, p.created_at, pl.name as plan_name, p.country
+                FROM payments p
+                LEFT JOIN plans pl ON p.plan_id = pl.id
+                WHERE p.invoice_id = ?
+            """, (internal_invoice_id,))
+            payment = cursor.fetchone()
+        if payment:
+            logger.info(f"Получен платёж: invoice_id={internal_invoice_id}, type={payment[2]}, status={payment[8]}")
+        else:
+            logger.warning(f"Платёж не найден: invoice_id={internal_invoice_id}")
+        return payment
+
+    # Промокоды
+
+    def get_promo_code(self, code):
+        with closing(self.connect()) as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT code, amount, max_activations, used_activations, expires_at, is_active FROM promo_codes WHERE code = ?", (code,))
+            promo = cursor.fetchone()
+        return promo
+
+    # Все коды (или созданные начиная с since) — для фильтра известных промокодов
+    def get_promo_code_list(self, since=None):
+        with closing(self.connect()) as conn:
+            cursor = conn.cursor()
+            if since is None:
+                cursor.execute("SELECT code FROM promo_codes")
+            else:
+                cursor.execute("SELECT code FROM promo_codes WHERE created_at >= ?", (since,))
+            codes = [row[0] for row in cursor.fetchall()]
+        return codes
+
+    # Погашение промокода одной транзакцией: условный инкремент счётчика, вставка активации
+    # (уникальный индекс code, user_id) и зачисление на баланс. Возвращает (статус, сумма).
+    def redeem_promo_code(self, code, user_id):
+        conn = self.connect_transaction()
+        cursor = conn.cursor()
+        try:
+            cursor.execute(self.BEGIN)
+            cursor.execute("""
+                UPDATE promo_codes SET used_activations = used_activations + 1
+                WHERE code = ? AND is_active = TRUE
+                  AND (max_activations IS NULL OR used_activations < max_activations)
+                  AND (expires_at IS NULL OR expires_at > ?)
+            """, (code, datetime.now().isoformat()))
+            if cursor.rowcount == 0:
+                # Ничего не обновили — выясняем причину
+                cursor.execute("SELECT max_activations, used_activations, expires_at, is_active FROM promo_codes WHERE code = ?", (code,))
+                promo = cursor.fetchone()
+                cursor.execute("ROLLBACK")
+                if not promo:
+                    return 'not_found', 0.0
+                max_a, used_a, expires_at, is_active = promo
+                if not is_active:
+                    return 'inactive', 0.0
+                if max_a is not None and used_a >= max_a:
+                    return 'exhausted', 0.0
+                return 'expired', 0.0
+            try:
+                cursor.execute("INSERT INTO promo_activations (code, user_id) VALUES (?, ?)", (code, user_id))
+            except self.IntegrityError:
+                cursor.execute("ROLLBACK")
+                return 'already_used', 0.0
+            cursor.execute("SELECT amount FROM promo_codes WHERE code = ?", (code,))
+            amount = cursor.fetchone()[0]
+            cursor.execute("UPDATE users SET balance = balance + ? WHERE user_id = ?", (amount, user_id))
+            cursor.execute("COMMIT")
+            logger.info(f"Промокод погашен: code={code}, user_id={user_id}, amount={amount}")
+            return 'ok', amount
+        except Exception:
+            if conn.in_transaction:
+                cursor.execute("ROLLBACK")
+            raise
+        finally:
+            conn.close()
+
+    # Вставка промокодов одной транзакцией; при совпадении кода — откат и IntegrityError бэкенда
+    def create_promo_codes(self, codes, amount, max_activations=None, expires_at=None):
+        created_at = datetime.now()
+        conn = self.connect()
+        cursor = conn.cursor()
+        try:
+            cursor.executemany("""
+                INSERT INTO promo_codes (code, amount, max_activations, expires_at, is_active, created_at)
+                VALUES (?, ?, ?, ?, TRUE, ?)
+            """, [(code, amount, max_activations, expires_at, created_at) for code in codes])
+            conn.commit()
+        except self.IntegrityError:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+
+    def set_promo_code_active(self, code, is_active):
+        with closing(self.connect()) as conn:
+            cursor = conn.cursor()
+            cursor.execute("UPDATE promo_codes SET is_active = ? WHERE code = ?", (bool(is_active), code))
+            conn.commit()
+
+    # Удалить промокод вместе с его активациями
+    def delete_promo_code(self, code):
+        with closing(self.connect()) as conn:
+            cursor = conn.cursor()
+            cursor.execute("DELETE FROM promo_activations WHERE code = ?", (code,))
+            cursor.execute("DELETE FROM promo_codes WHERE code = ?", (code,))
+            conn.commit()
+
+    # Страница промокодов по алфавиту (keyset по первичному ключу code)
+    def get_promo_codes_page(self, filter_code='a', after_code=None, before_code=None, limit=PROMOS_PAGE_SIZE):
+        condition = PROMO_FILTERS.get(filter_code, PROMO_FILTERS['a'])[1]
+        params = {'now': datetime.now().isoformat(), 'limit': limit + 1}
+        query = f"""
+            SELECT code, amount, max_activations, used_activations, expires_at, is_active
+            FROM promo_codes
+            WHERE {condition}
+        """
+        with closing(self.connect()) as conn:
+            cursor = conn.cursor()
+            if before_code is not None:
+                params['cursor'] = before_code
+                cursor.execute(query + " AND code < :cursor ORDER BY code DESC LIMIT :limit", params)
+                promos = cursor.fetchall()
+                return promos[:limit][::-1], len(promos) > limit, True
+            if after_code is not None:
+                params['cursor'] = after_code
+                query += " AND code > :cursor"
+            cursor.execute(query + " ORDER BY code LIMIT :limit", params)
+            promos = cursor.fetchall()
+        return promos[:limit], after_code is not None, len(promos) > limit
+
+    # Рассылки
+
+    # Создать рассылку: фиксируем число получателей на момент старта
+    def create_broadcast(self, text):
+        with closing(self.connect()) as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT COUNT(*) FROM users WHERE is_blocked = FALSE")
+            total = cursor.fetchone()[0]
+            broadcast_id = self.insert_returning_id(cursor, "INSERT INTO broadcasts (text, total) VALUES (?, ?)", (text, total))
+            conn.commit()
+        logger.info(f"Создана рассылка: id={broadcast_id}, получателей={total}")
+        return broadcast_id
+
+    def get_broadcast(self, broadcast_id):
+        with closing(self.connect()) as conn:
+            cursor = conn.cursor()
+            cursor.execute("""
+                SELECT id, text, status, last_user_id, total, sent, failed, blocked, created_at, finished_at
+                FROM broadcasts WHERE id = ?
+            """, (broadcast_id,))
+            broadcast = cursor.fetchone()
+        return broadcast
+
+    # Последняя рассылка (для экрана в админке)
+    def get_last_broadcast(self):
+        with closing(self.connect()) as conn:
+            cursor = conn.cursor()
+            cursor.execute("""
+                SELECT id, text, status, last_user_id, total, sent, failed, blocked, created_at, finished_at
+                FROM broadcasts ORDER BY id DESC LIMIT 1
+            """)
+            broadcast = cursor.fetchone()
+        return broadcast
+
+    # Незавершённые рассылки (возобновляются при старте бота)
+    def get_running_broadcasts(self):
+        with closing(self.connect()) as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT id FROM broadcasts WHERE status = 'running' ORDER BY id")
+            ids = [row[0] for row in cursor.fetchall()]
+        return ids
+
+    # Следующая пачка получателей по курсору user_id (keyset, без OFFSET)
+    def get_broadcast_recipients(self, after_user_id, limit):
+        with closing(self.connect()) as conn:
+            cursor = conn.cursor()
+            cursor.execute("""
+                SELECT user_id FROM users
+                WHERE user_id > ? AND is_blocked = FALSE
+                ORDER BY user_id
+                LIMIT ?
+            """, (after_user_id, limit))
+            user_ids = [row[0] for row in cursor.fetchall()]
+        return user_ids
+
+    # Пометить пользователей, заблокировавших бота (их пропускают рассылки и напоминания)
+    def mark_users_blocked(self, user_ids):
+        with closing(self.connect()) as conn:
+            cursor = conn.cursor()
+            cursor.executemany("UPDATE users SET is_blocked = TRUE WHERE user_id = ?", [(uid,) for uid in user_ids])
+            conn.commit()
+
+    # Сохранить прогресс пачки одной транзакцией: курсор, счётчики и заблокировавших бота
+    def save_broadcast_progress(self, broadcast_id, last_user_id, sent, failed, blocked_ids):
+        with closing(self.connect()) as conn:
+            cursor = conn.cursor()
+            cursor.executemany("UPDATE users SET is_blocked = TRUE WHERE user_id = ?", [(uid,) for uid in blocked_ids])
+            cursor.execute("""
+                UPDATE broadcasts
+                SET last_user_id = ?, sent = sent + ?, failed = failed + ?, blocked = blocked + ?
+                WHERE id = ?
+            """, (last_user_id, sent, failed, len(blocked_ids), broadcast_id))
+            conn.commit()
+
+    # Обновление статуса рассылки (running / done / cancelled)
+    def set_broadcast_status(self, broadcast_id, status):
+        with closing(self.connect()) as conn:
+            cursor = conn.cursor()
+            if status == 'running':
+                cursor.execute("UPDATE broadcasts SET status = ? WHERE id = ?", (status, broadcast_id))
+            else:
+                cursor.execute("UPDATE broadcasts SET status = ?, finished_at = CURRENT_TIMESTAMP WHERE id = ?", (status, broadcast_id))
+            conn.commit()
+
+    # Состояние диалогов (user_data / chat_data) для DatabasePersistence; kind — 'user' или 'chat'
+
+    def load_state(self, kind, key):
+        with closing(self.connect()) as conn:
+            cursor = conn.cursor()
+            cursor.execute(f"SELECT data FROM {kind}_state WHERE {kind}_id = ?", (key,))
+            row = cursor.fetchone()
+        return row[0] if row else None
+
+    def save_states(self, users, chats):
+        with closing(self.connect()) as conn:
+            cursor = conn.cursor()
+            for kind, rows in (('user', users), ('chat', chats)):
+                if rows:
+                    cursor.executemany(f"""
+                        INSERT INTO {kind}_state ({kind}_id, data, updated_at) VALUES (?, ?, CURRENT_TIMESTAMP)
+                        ON CONFLICT ({kind}_id) DO UPDATE SET data = excluded.data, updated_at = excluded.updated_at
+                    """, list(rows.items()))
+            conn.commit()
+
+    def delete_state(self, kind, key):
+        with closing(self.connect()) as conn:
+            cursor = conn.cursor()
+            cursor.execute(f"DELETE FROM {kind}_state WHERE {kind}_id = ?", (key,))
+            conn.commit()
+
+    # Апдейты, обработанные воркерами: повтор от роутера после рестарта воркера отбрасывается
+    def is_update_processed(self, update_id):
+        with closing(self.connect()) as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT 1 FROM processed_updates WHERE update_id = ?", (update_id,))
+            row = cursor.fetchone()
+        return row is not None
+
+    def mark_update_processed(self, update_id):
+        with closing(self.connect()) as conn:
+            cursor = conn.cursor()
+            cursor.execute("""
+                INSERT INTO processed_updates (update_id, processed_at) VALUES (?, ?)
+                ON CONFLICT (update_id) DO NOTHING
+            """, (update_id, datetime.now()))
+            conn.commit()
+
+    # Telegram хранит неподтверждённые апдейты сутки — более старые id повторно не придут
+    def prune_processed_updates(self, before):
+        with closing(self.connect()) as conn:
+            cursor = conn.cursor()
+            cursor.execute("DELETE FROM processed_updates WHERE processed_at < ?", (before,))
+            conn.commit()
+
+class SQLiteStorage(Storage):
+    """Хранилище в файле SQLite (DB_PATH): один хост, один пишущий процесс."""
+
+    IntegrityError = sqlite3.IntegrityError
+    # Сразу берём блокировку записи: иначе параллельное погашение упадёт на апгрейде блокировки
+    BEGIN = "BEGIN IMMEDIATE"
+
+    def __init__(self, database=None):
+        self.database = database
+
+    def connect(self, **kwargs):
+        conn = db_connect(self.database, **kwargs)
+        conn.helper = sys._getframe(1).f_code.co_name
+        return conn
+
+    def connect_transaction(self):
+        conn = db_connect(self.database, isolation_level=None)
+        conn.helper = sys._getframe(1).f_code.co_name
+        return conn
+
+    def init_schema(self):
+        with closing(self.connect()) as conn:
+            cursor = conn.cursor()
+
+            # Таблица тарифов
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS plans (
+                    id INTEGER PRIMARY KEY,
+                    name TEXT NOT NULL,
+                    duration INTEGER NOT NULL,
+                    price REAL NOT NULL,
+                    description TEXT
+                )
+            ''')
+
+            # Таблица конфигураций
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS configs (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    plan_id INTEGER,
+                    country TEXT NOT NULL,
+                    config TEXT NOT NULL,
+                    is_used BOOLEAN DEFAULT FALSE,
+                    FOREIGN KEY (plan_id) REFERENCES plans (id)
+                )
+            ''')
+
+            # Таблица пользователей
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS users (
+                    user_id INTEGER PRIMARY KEY,
+                    username TEXT,
+                    first_name TEXT,
+                    last_name TEXT
+                )
+            ''')
+
+            # Проверка и добавление столбца balance
+            cursor.execute("PRAGMA table_info(users)")
+            columns = [info[1] for info in cursor.fetchall()]
+            if 'balance' not in columns:
+                cursor.execute("ALTER TABLE users ADD COLUMN balance REAL DEFAULT 0.0")
+                logger.info("Добавлен столбец balance в таблицу users")
+            if 'is_blocked' not in columns:
+                # Пользователь заблокировал бота — рассылки его пропускают
+                cursor.execute("ALTER TABLE users ADD COLUMN is_blocked BOOLEAN DEFAULT FALSE")
+                logger.info("Добавлен столбец is_blocked в таблицу users")
+            if 'auto_renew' not in columns:
+                # Пользователь включил автопродление подписок с баланса
+                cursor.execute("ALTER TABLE users ADD COLUMN auto_renew BOOLEAN DEFAULT FALSE")
+                logger.info("Добавлен столбец auto_renew в таблицу users")
+
+            # Таблица заказов
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS orders (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    user_id INTEGER,
+                    plan_id INTEGER,
+                    config_id INTEGER,
+                    order_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    expiry_date TIMESTAMP,
+                    FOREIGN KEY (user_id) REFERENCES users (user_id),
+                    FOREIGN KEY (plan_id) REFERENCES plans (id),
+                    FOREIGN KEY (config_id) REFERENCES configs (id)
+                )
+            ''')
+
+            # Индекс для поиска пользователей по началу username в админке (LIKE 'abc%' без учёта регистра)
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_users_username ON users (username COLLATE NOCASE)")
+
+            # Индекс для постраничного вывода заказов пользователя (keyset по order_date, id)
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_orders_user_date ON orders (user_id, order_date, id)")
+
+            cursor.execute("PRAGMA table_info(orders)")
+            columns = [info[1] for info in cursor.fetchall()]
+            if 'reminder_days' not in columns:
+                # За сколько дней до окончания уже отправлено напоминание (NULL — не отправлялось)
+                cursor.execute("ALTER TABLE orders ADD COLUMN reminder_days INTEGER")
+                logger.info("Добавлен столбец reminder_days в таблицу orders")
+            if 'renew_notified' not in columns:
+                # Владельцу уже сообщили, что на автопродление не хватает средств
+                cursor.execute("ALTER TABLE orders ADD COLUMN renew_notified BOOLEAN DEFAULT FALSE")
+                logger.info("Добавлен столбец renew_notified в таблицу orders")
+            # Индекс для выбора заказов, истекающих в ближайшие дни
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_orders_expiry ON orders (expiry_date, id)")
+
+            # Таблица платежей
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS payments (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    user_id INTEGER,
+                    type TEXT DEFAULT 'purchase',
+                    plan_id INTEGER,
+                    amount REAL,
+                    invoice_id TEXT UNIQUE,
+                    cryptobot_invoice_id TEXT,
+                    crystal_pay_id TEXT,
+                    status TEXT DEFAULT 'pending',
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    FOREIGN KEY (user_id) REFERENCES users (user_id),
+                    FOREIGN KEY (plan_id) REFERENCES plans (id)
+                )
+            ''')
+
+            # Проверка и добавление недостающих столбцов в payments (миграции)
+            cursor.execute("PRAGMA table_info(payments)")
+            columns = [info[1] for info in cursor.fetchall()]
+            if 'type' not in columns:
+                cursor.execute("ALTER TABLE payments ADD COLUMN type TEXT DEFAULT 'purchase'")
+                logger.info("Добавлен столбец type в таблицу payments")
+            if 'cryptobot_invoice_id' not in columns:
+                cursor.execute("ALTER TABLE payments ADD COLUMN cryptobot_invoice_id TEXT")
+                logger.info("Добавлен столбец cryptobot_invoice_id в таблицу payments")
+            if 'crystal_pay_id' not in columns:
+                cursor.execute("ALTER TABLE payments ADD COLUMN crystal_pay_id TEXT")
+                logger.info("Добавлен столбец crystal_pay_id в таблицу payments")
+            if 'status' not in columns:
+                cursor.execute("ALTER TABLE payments ADD COLUMN status TEXT DEFAULT 'pending'")
+                logger.info("Добавлен столбец status в таблицу payments")
+            if 'created_at' not in columns:
+                cursor.execute("ALTER TABLE payments ADD COLUMN created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP")
+                logger.info("Добавлен столбец created_at в таблицу payments")
+            if 'country' not in columns:
+                # Страна покупки: нужна, чтобы выдать конфиг при сверке без исходного сообщения
+                cursor.execute("ALTER TABLE payments ADD COLUMN country TEXT")
+                logger.info("Добавлен столбец country в таблицу payments")
+
+            # Индекс для истории платежей пользователя (keyset по created_at, id)
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_payments_user_created ON payments (user_id, created_at, id)")
+
+            # Индексы для ленты платежей в админке: все платежи и с фильтром по статусу
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_payments_created ON payments (created_at, id)")
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_payments_status_created ON payments (status, created_at, id)")
+
+            # Проверка и добавление столбца country в configs
+            cursor.execute("PRAGMA table_info(configs)")
+            columns = [info[1] for info in cursor.fetchall()]
+            if 'country' not in columns:
+                cursor.execute("ALTER TABLE configs ADD COLUMN country TEXT NOT NULL DEFAULT 'de'")
+                logger.info("Добавлен столбец country в таблицу configs")
+            if 'reserved_by' not in columns:
+                # Резерв конфига под неоплаченный счёт: ключ счёта и срок резерва
+                cursor.execute("ALTER TABLE configs ADD COLUMN reserved_by TEXT")
+                cursor.execute("ALTER TABLE configs ADD COLUMN reserved_until TIMESTAMP")
+                logger.info("Добавлены столбцы reserved_by, reserved_until в таблицу configs")
+            if 'reserved_for' not in columns:
+                # Кто держит резерв: ограничение числа резервов на пользователя
+                cursor.execute("ALTER TABLE configs ADD COLUMN reserved_for INTEGER")
+                logger.info("Добавлен столбец reserved_for в таблицу configs")
+
+            # Индексы для выбора свободного конфига и поиска резерва по ключу счёта
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_configs_free ON configs (plan_id, country, is_used)")
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_configs_reserved_by ON configs (reserved_by)")
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_configs_reserved_for ON configs (reserved_for)")
+
+            # Добавление тарифов (обновленные цены)
+            cursor.execute("DELETE FROM plans")  # Очищаем старые тарифы
+            cursor.executemany("INSERT INTO plans VALUES (?, ?, ?, ?, ?)", PLANS)
+
+            # Таблица промокодов
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS promo_codes (
+                    code TEXT PRIMARY KEY,
+                    amount REAL NOT NULL,
+                    max_activations INTEGER,
+                    used_activations INTEGER DEFAULT 0,
+                    expires_at TIMESTAMP,
+                    is_active BOOLEAN DEFAULT TRUE
+                )
+            ''')
+            cursor.execute("PRAGMA table_info(promo_codes)")
+            if 'created_at' not in [info[1] for info in cursor.fetchall()]:
+                # Время создания: по нему процессы дочитывают в фильтр промокоды, созданные другими процессами
+                cursor.execute("ALTER TABLE promo_codes ADD COLUMN created_at TIMESTAMP")
+                logger.info("Добавлен столбец created_at в таблицу promo_codes")
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_promo_codes_created ON promo_codes (created_at)")
+            # Таблица активаций промокодов
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS promo_activations (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    code TEXT NOT NULL,
+                    user_id INTEGER NOT NULL,
+                    activated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    FOREIGN KEY (code) REFERENCES promo_codes (code),
+                    FOREIGN KEY (user_id) REFERENCES users (user_id)
+                )
+            ''')
+
+            # Один пользователь — одна активация промокода (проверяется самой вставкой при погашении).
+            # Повторные активации из старых версий удаляются (остаётся первая), иначе индекс не создать
+            cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = 'idx_promo_activations_code_user'")
+            if cursor.fetchone() is None:
+                cursor.execute("""
+                    DELETE FROM promo_activations
+                    WHERE id NOT IN (SELECT MIN(id) FROM promo_activations GROUP BY code, user_id)
+                """)
+                if cursor.rowcount:
+                    logger.warning(f"Удалены повторные активации промокодов: {cursor.rowcount}")
+                cursor.execute("CREATE UNIQUE INDEX idx_promo_activations_code_user ON promo_activations (code, user_id)")
+
+            # Таблица рассылок (last_user_id — курсор, с которого продолжаем после рестарта)
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS broadcasts (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    text TEXT NOT NULL,
+                    status TEXT DEFAULT 'running',
+                    last_user_id INTEGER DEFAULT 0,
+                    total INTEGER DEFAULT 0,
+                    sent INTEGER DEFAULT 0,
+                    failed INTEGER DEFAULT 0,
+                    blocked INTEGER DEFAULT 0,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    finished_at TIMESTAMP
+                )
+            ''')
+
+            # Состояние диалогов (context.user_data / context.chat_data) в JSON
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS user_state (
+                    user_id INTEGER PRIMARY KEY,
+                    data TEXT NOT NULL,
+                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS chat_state (
+                    chat_id INTEGER PRIMARY KEY,
+                    data TEXT NOT NULL,
+                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
+
+            # Апдейты, обработанные воркерами (многопроцессный режим)
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS processed_updates (
+                    update_id INTEGER PRIMARY KEY,
+                    processed_at TIMESTAMP NOT NULL
+                )
+            ''')
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_processed_updates_at ON processed_updates (processed_at)")
+
+            conn.commit()
+
+# Плейсхолдеры SQLite (? и :name) -> psycopg (%s и %(name)s); литеральный % экранируется
+@functools.lru_cache(maxsize=1024)
+def postgres_sql(sql):
+    sql = sql.replace('%', '%%')
+    sql = re.sub(r'(?<!:):([A-Za-z_]\w*)', r'%(\1)s', sql)
+    return sql.replace('?', '%s')
+
+class PostgresCursor:
+    """Курсор psycopg с интерфейсом sqlite3: плейсхолдеры ?/:name, lastrowid нет (см. insert_returning_id).
+    BEGIN/COMMIT/ROLLBACK, выполненные как запросы, управляют транзакцией соединения.
+    Каждый запрос замеряется так же, как в TracedCursor."""
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.cursor = connection.raw.cursor()
+
+    def execute(self, sql, parameters=()):
+        statement = sql.strip().upper()
+        if statement.startswith('BEGIN'):
+            return self  # psycopg открывает транзакцию сам перед первым запросом
+        if statement == 'COMMIT':
+            self.connection.commit()
+            return self
+        if statement == 'ROLLBACK':
+            self.connection.rollback()
+            return self
+        start = time.perf_counter()
+        ok = False
+        try:
+            self.cursor.execute(postgres_sql(sql), parameters)
+            ok = True
+            return self
+        finally:
+            observe_query(self.connection, sql, parameters, time.perf_counter() - start, ok)
+
+    def executemany(self, sql, seq_of_parameters):
+        seq_of_parameters = list(seq_of_parameters)
+        start = time.perf_counter()
+        ok = False
+        try:
+            self.cursor.executemany(postgres_sql(sql), seq_of_parameters)
+            ok = True
+            return self
+        finally:
+            observe_query(self.connection, sql, seq_of_parameters, time.perf_counter() - start, ok, many=True)
+
+    @property
+    def rowcount(self):
+        return self.cursor.rowcount
+
+    def fetchone(self):
+        return self.cursor.fetchone()
+
+    def fetchall(self):
+        return self.cursor.fetchall()
+
+    def __iter__(self):
+        return iter(self.cursor)
+
+class PostgresConnection:
+    """Соединение из пула PostgresStorage; close() возвращает его в пул (незакоммиченное откатывается)."""
+
+    helper = 'unknown'
+
+    def __init__(self, pool, raw):
+        self.pool = pool
+        self.raw = raw
+
+    def cursor(self):
+        return PostgresCursor(self)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+    def commit(self):
+        self.raw.commit()
+
+    def rollback(self):
+        self.raw.rollback()
+
+    @property
+    def in_transaction(self):
+        return self.raw.info.transaction_status != 0  # psycopg.pq.TransactionStatus.IDLE
+
+    # EXPLAIN внутри transaction(): в открытой транзакции это SAVEPOINT, и откат (или ошибка EXPLAIN)
+    # не задевает уже сделанные записи вызывающего; без транзакции — отдельная, тоже откатываемая
+    def query_plan(self, statement, parameters):
+        import psycopg
+        plan = []
+        with self.raw.transaction():
+            with self.raw.cursor() as cursor:
+                cursor.execute(f"EXPLAIN {postgres_sql(statement)}", parameters)
+                plan = [row[0].strip() for row in cursor.fetchall()]
+            raise psycopg.Rollback()
+        return plan
+
+    def close(self):
+        if self.raw is None:
+            return
+        if self.in_transaction:
+            self.raw.rollback()
+        self.pool.putconn(self.raw)
+        self.raw = None
+
+class PostgresStorage(Storage):
+    """Хранилище в PostgreSQL (DATABASE_URL): общее для нескольких процессов и хостов.
+
+    Драйвер — psycopg 3 с пулом соединений (pip install "psycopg[binary,pool]"); запросы те же,
+    что у SQLite, плейсхолдеры переводит PostgresCursor. Вызовы синхронные, как и у SQLite,
+    поэтому обработчики вызывают хелперы через asyncio.to_thread — сетевой запрос к базе не блокирует event loop.
+    """
+
+    # Конкурирующие процессы пропускают строки, которые уже захватывает другая транзакция
+    LOCK_FREE_CONFIG = "FOR UPDATE SKIP LOCKED"
+    SECONDS_AGO_SQL = "LOCALTIMESTAMP - ? * INTERVAL '1 second'"
+    USERNAME_SEARCH_SQL = """
+        SELECT user_id, username, first_name FROM users
+        WHERE lower(username) LIKE lower(?) ESCAPE '\\'
+        ORDER BY lower(username)
+        LIMIT ?
+    """
 
-# Фиксированные цены в звёздах для тарифов
-STARS_PRICE_BY_PLAN = {
-    1: 50,    # 1 месяц
-    2: 110,   # 3 месяца
-    3: 205,   # 6 месяцев
-    4: 285    # 12 месяцев
-}
+    def __init__(self, url, pool_size=10):
+        try:
+            import psycopg
+            from psycopg_pool import ConnectionPool
+        except ImportError as e:
+            raise RuntimeError('Для STORAGE_BACKEND=postgres нужен psycopg 3: pip install "psycopg[binary,pool]"') from e
+        self.IntegrityError = psycopg.IntegrityError
+        self.pool = ConnectionPool(url, min_size=1, max_size=pool_size, open=True, name="vpn_bot")
 
-# Список стран
-COUNTRIES = {
-    'de': '🇩🇪 Германия',
-    'ch': '🇨🇭 Швейцария',
-    'nl': '🇳🇱 Нидерланды',
-    'fi': '🇫🇮 Финляндия'
-}
+    def connect(self, **kwargs):
+        conn = PostgresConnection(self.pool, self.pool.getconn())
+        conn.helper = sys._getframe(1).f_code.co_name
+        return conn
+
+    def connect_transaction(self):
+        conn = PostgresConnection(self.pool, self.pool.getconn())
+        conn.helper = sys._getframe(1).f_code.co_name
+        return conn
+
+    def insert_returning_id(self, cursor, sql, parameters):
+        cursor.execute(f"{sql.rstrip()} RETURNING id", parameters)
+        return cursor.fetchone()[0]
+
+    def init_schema(self):
+        with closing(self.connect()) as conn:
+            cursor = conn.cursor()
+            for statement in POSTGRES_SCHEMA:
+                cursor.execute(statement)
+            # Тарифы обновляются на месте: на них ссылаются заказы и платежи
+            cursor.executemany("""
+                INSERT INTO plans (id, name, duration, price, description) VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT (id) DO UPDATE SET name = excluded.name, duration = excluded.duration,
+                    price = excluded.price, description = excluded.description
+            """, PLANS)
+            cursor.execute(f"DELETE FROM plans WHERE id NOT IN ({', '.join('?' * len(PLANS))})", [plan[0] for plan in PLANS])
+            conn.commit()
+
+    def close(self):
+        self.pool.close()
+
+# Тарифы (id, название, месяцев, цена USDT, описание) — перезаписываются при каждом старте
+PLANS = [
+    (1, "1 месяц", 1, 1.0, "VPN на 1 месяц"),
+    (2, "3 месяца", 3, 2.5, "VPN на 3 месяца"),
+    (3, "6 месяцев", 6, 4.0, "VPN на 6 месяцев"),
+    (4, "12 месяцев", 12, 5.0, "VPN на 12 месяцев")
+]
+
+# Схема PostgreSQL: те же таблицы и индексы, что у SQLite, с родными типами (BIGINT для id Telegram)
+POSTGRES_SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS plans (
+        id INTEGER PRIMARY KEY, name TEXT NOT NULL, duration INTEGER NOT NULL,
+        price DOUBLE PRECISION NOT NULL, description TEXT
+    )""",
+    """CREATE TABLE IF NOT EXISTS configs (
+        id BIGSERIAL PRIMARY KEY, plan_id INTEGER, country TEXT NOT NULL DEFAULT 'de',
+        config TEXT NOT NULL, is_used BOOLEAN DEFAULT FALSE, reserved_by TEXT, reserved_until TIMESTAMP,
+        reserved_for BIGINT
+    )""",
+    "ALTER TABLE configs ADD COLUMN IF NOT EXISTS reserved_by TEXT",
+    "ALTER TABLE configs ADD COLUMN IF NOT EXISTS reserved_until TIMESTAMP",
+    "ALTER TABLE configs ADD COLUMN IF NOT EXISTS reserved_for BIGINT",
+    """CREATE TABLE IF NOT EXISTS users (
+        user_id BIGINT PRIMARY KEY, username TEXT, first_name TEXT, last_name TEXT,
+        balance DOUBLE PRECISION DEFAULT 0.0, is_blocked BOOLEAN DEFAULT FALSE, auto_renew BOOLEAN DEFAULT FALSE
+    )""",
+    "ALTER TABLE users ADD COLUMN IF NOT EXISTS auto_renew BOOLEAN DEFAULT FALSE",
+    """CREATE TABLE IF NOT EXISTS orders (
+        id BIGSERIAL PRIMARY KEY, user_id BIGINT, plan_id INTEGER, config_id BIGINT,
+        order_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP, expiry_date TIMESTAMP, reminder_days INTEGER,
+        renew_notified BOOLEAN DEFAULT FALSE
+    )""",
+    "ALTER TABLE orders ADD COLUMN IF NOT EXISTS reminder_days INTEGER",
+    "ALTER TABLE orders ADD COLUMN IF NOT EXISTS renew_notified BOOLEAN DEFAULT FALSE",
+    """CREATE TABLE IF NOT EXISTS payments (
+        id BIGSERIAL PRIMARY KEY, user_id BIGINT, type TEXT DEFAULT 'purchase', plan_id INTEGER,
+        amount DOUBLE PRECISION, invoice_id TEXT UNIQUE, cryptobot_invoice_id TEXT, crystal_pay_id TEXT,
+        status TEXT DEFAULT 'pending', created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP, country TEXT
+    )""",
+    "ALTER TABLE payments ADD COLUMN IF NOT EXISTS country TEXT",
+    """CREATE TABLE IF NOT EXISTS promo_codes (
+        code TEXT PRIMARY KEY, amount DOUBLE PRECISION NOT NULL, max_activations INTEGER,
+        used_activations INTEGER DEFAULT 0, expires_at TIMESTAMP, is_active BOOLEAN DEFAULT TRUE, created_at TIMESTAMP
+    )""",
+    "ALTER TABLE promo_codes ADD COLUMN IF NOT EXISTS created_at TIMESTAMP",
+    "CREATE INDEX IF NOT EXISTS idx_promo_codes_created ON promo_codes (created_at)",
+    """CREATE TABLE IF NOT EXISTS promo_activations (
+        id BIGSERIAL PRIMARY KEY, code TEXT NOT NULL, user_id BIGINT NOT NULL,
+        activated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )""",
+    """CREATE TABLE IF NOT EXISTS broadcasts (
+        id BIGSERIAL PRIMARY KEY, text TEXT NOT NULL, status TEXT DEFAULT 'running',
+        last_user_id BIGINT DEFAULT 0, total INTEGER DEFAULT 0, sent INTEGER DEFAULT 0,
+        failed INTEGER DEFAULT 0, blocked INTEGER DEFAULT 0,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP, finished_at TIMESTAMP
+    )""",
+    """CREATE TABLE IF NOT EXISTS user_state (
+        user_id BIGINT PRIMARY KEY, data TEXT NOT NULL, updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )""",
+    """CREATE TABLE IF NOT EXISTS chat_state (
+        chat_id BIGINT PRIMARY KEY, data TEXT NOT NULL, updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )""",
+    """CREATE TABLE IF NOT EXISTS processed_updates (
+        update_id BIGINT PRIMARY KEY, processed_at TIMESTAMP NOT NULL
+    )""",
+    "CREATE INDEX IF NOT EXISTS idx_processed_updates_at ON processed_updates (processed_at)",
+    "CREATE INDEX IF NOT EXISTS idx_users_username ON users (lower(username) text_pattern_ops)",
+    "CREATE INDEX IF NOT EXISTS idx_orders_user_date ON orders (user_id, order_date, id)",
+    "CREATE INDEX IF NOT EXISTS idx_orders_expiry ON orders (expiry_date, id)",
+    "CREATE INDEX IF NOT EXISTS idx_configs_free ON configs (plan_id, country, is_used)",
+    "CREATE INDEX IF NOT EXISTS idx_configs_reserved_by ON configs (reserved_by)",
+    "CREATE INDEX IF NOT EXISTS idx_configs_reserved_for ON configs (reserved_for)",
+    "CREATE INDEX IF NOT EXISTS idx_payments_user_created ON payments (user_id, created_at, id)",
+    "CREATE INDEX IF NOT EXISTS idx_payments_created ON payments (created_at, id)",
+    "CREATE INDEX IF NOT EXISTS idx_payments_status_created ON payments (status, created_at, id)",
+    # Повторные активации из старых версий: остаётся первая, иначе уникальный индекс не создать
+    """DELETE FROM promo_activations a USING promo_activations b
+        WHERE a.code = b.code AND a.user_id = b.user_id AND a.id > b.id""",
+    "CREATE UNIQUE INDEX IF NOT EXISTS idx_promo_activations_code_user ON promo_activations (code, user_id)",
+]
+
+# Бэкенд хранилища по STORAGE_BACKEND
+def create_storage():
+    if STORAGE_BACKEND == 'sqlite':
+        return SQLiteStorage()
+    if STORAGE_BACKEND == 'postgres':
+        if not DATABASE_URL:
+            raise RuntimeError("Для STORAGE_BACKEND=postgres задайте DATABASE_URL")
+        return PostgresStorage(DATABASE_URL, PG_POOL_SIZE)
+    raise RuntimeError(f"Неизвестный STORAGE_BACKEND: {STORAGE_BACKEND}")
+
+storage = create_storage()
 
 # Инициализация базы данных
 def init_db():
     try:
-        conn = sqlite3.connect('vpn_bot.db')
-        cursor = conn.cursor()
-        
-        # Таблица тарифов
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS plans (
-                id INTEGER PRIMARY KEY,
-                name TEXT NOT NULL,
-                duration INTEGER NOT NULL,
-                price REAL NOT NULL,
-                description TEXT
-            )
-        ''')
-        
-        # Таблица конфигураций
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS configs (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                plan_id INTEGER,
-                country TEXT NOT NULL,
-                config TEXT NOT NULL,
-                is_used BOOLEAN DEFAULT FALSE,
-                FOREIGN KEY (plan_id) REFERENCES plans (id)
-            )
-        ''')
-        
-        # Таблица пользователей
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS users (
-                user_id INTEGER PRIMARY KEY,
-                username TEXT,
-                first_name TEXT,
-                last_name TEXT
-            )
-        ''')
-        
-        # Проверка и добавление столбца balance
-        cursor.execute("PRAGMA table_info(users)")
-        columns = [info[1] for info in cursor.fetchall()]
-        if 'balance' not in columns:
-            cursor.execute("ALTER TABLE users ADD COLUMN balance REAL DEFAULT 0.0")
-            logger.info("Добавлен столбец balance в таблицу users")
-        
-        # Таблица заказов
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS orders (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER,
-                plan_id INTEGER,
-                config_id INTEGER,
-                order_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                expiry_date TIMESTAMP,
-                FOREIGN KEY (user_id) REFERENCES users (user_id),
-                FOREIGN KEY (plan_id) REFERENCES plans (id),
-                FOREIGN KEY (config_id) REFERENCES configs (id)
-            )
-        ''')
-        
-        # Таблица платежей
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS payments (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER,
-                type TEXT DEFAULT 'purchase',
-                plan_id INTEGER,
-                amount REAL,
-                invoice_id TEXT UNIQUE,
-                cryptobot_invoice_id TEXT,
-                crystal_pay_id TEXT,
-                status TEXT DEFAULT 'pending',
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (user_id) REFERENCES users (user_id),
-                FOREIGN KEY (plan_id) REFERENCES plans (id)
-            )
-        ''')
-        
-        # Проверка и добавление недостающих столбцов в payments (миграции)
-        cursor.execute("PRAGMA table_info(payments)")
-        columns = [info[1] for info in cursor.fetchall()]
-        if 'type' not in columns:
-            cursor.execute("ALTER TABLE payments ADD COLUMN type TEXT DEFAULT 'purchase'")
-            logger.info("Добавлен столбец type в таблицу payments")
-        if 'cryptobot_invoice_id' not in columns:
-            cursor.execute("ALTER TABLE payments ADD COLUMN cryptobot_invoice_id TEXT")
-            logger.info("Добавлен столбец cryptobot_invoice_id в таблицу payments")
-        if 'crystal_pay_id' not in columns:
-            cursor.execute("ALTER TABLE payments ADD COLUMN crystal_pay_id TEXT")
-            logger.info("Добавлен столбец crystal_pay_id в таблицу payments")
-        if 'status' not in columns:
-            cursor.execute("ALTER TABLE payments ADD COLUMN status TEXT DEFAULT 'pending'")
-            logger.info("Добавлен столбец status в таблицу payments")
-        if 'created_at' not in columns:
-            cursor.execute("ALTER TABLE payments ADD COLUMN created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP")
-            logger.info("Добавлен столбец created_at в таблицу payments")
-        
-        # Проверка и добавление столбца country в configs
-        cursor.execute("PRAGMA table_info(configs)")
-        columns = [info[1] for info in cursor.fetchall()]
-        if 'country' not in columns:
-            cursor.execute("ALTER TABLE configs ADD COLUMN country TEXT NOT NULL DEFAULT 'de'")
-            logger.info("Добавлен столбец country в таблицу configs")
-        
-        # Добавление тарифов (обновленные цены)
-        cursor.execute("DELETE FROM plans")  # Очищаем старые тарифы
-        plans = [
-            (1, "1 месяц", 1, 1.0, "VPN на 1 месяц"),
-            (2, "3 месяца", 3, 2.5, "VPN на 3 месяца"),
-            (3, "6 месяцев", 6, 4.0, "VPN на 6 месяцев"),
-            (4, "12 месяцев", 12, 5.0, "VPN на 12 месяцев")
-        ]
-        cursor.executemany("INSERT INTO plans VALUES (?, ?, ?, ?, ?)", plans)
-        
-        # Таблица промокодов
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS promo_codes (
-                code TEXT PRIMARY KEY,
-                amount REAL NOT NULL,
-                max_activations INTEGER,
-                used_activations INTEGER DEFAULT 0,
-                expires_at TIMESTAMP,
-                is_active BOOLEAN DEFAULT TRUE
-            )
-        ''')
-        # Таблица активаций промокодов
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS promo_activations (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                code TEXT NOT NULL,
-                user_id INTEGER NOT NULL,
-                activated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (code) REFERENCES promo_codes (code),
-                FOREIGN KEY (user_id) REFERENCES users (user_id)
-            )
-        ''')
-        
-        conn.commit()
-        conn.close()
+        storage.init_schema()
         logger.info("База данных инициализирована успешно")
     except Exception as e:
         logger.error(f"Ошибка инициализации базы данных: {e}")
         exit(1)
 
-# Получение баланса пользователя
-def get_balance(user_id):
-    conn = sqlite3.connect('vpn_bot.db')
-    cursor = conn.cursor()
-    cursor.execute("SELECT balance FROM users WHERE user_id = ?", (user_id,))
-    result = cursor.fetchone()
-    conn.close()
-    return result[0] if result else 0.0
-
-# Обновление баланса
-def update_balance(user_id, amount):
-    conn = sqlite3.connect('vpn_bot.db')
-    cursor = conn.cursor()
-    cursor.execute("""
-        UPDATE users SET balance = balance + ? WHERE user_id = ?
-    """, (amount, user_id))
-    conn.commit()
-    conn.close()
-
-# Конвертация RUB->USDT
-def rub_to_usdt(rub_amount):
-    try:
-        return round(float(rub_amount) / RUB_PER_USDT, 2)
-    except Exception:
-        return 0.0
-
-# Получение тарифов из БД
-def get_plans():
-    conn = sqlite3.connect('vpn_bot.db')
-    cursor = conn.cursor()
-    cursor.execute("SELECT * FROM plans ORDER BY duration")
-    plans = cursor.fetchall()
-    conn.close()
-    return plans
+# Операции хранилища — функциями модуля, как их вызывают обработчики и скрипты (benchmark.py, load_test.py)
+get_balance = storage.get_balance
+update_balance = storage.update_balance
+save_user = storage.save_user
+search_users = storage.search_users
+get_user_card = storage.get_user_card
+get_plans = storage.get_plans
+claim_config_order = storage.claim_config_order
+reserve_config = storage.reserve_config
+release_reservation = storage.release_reservation
+purchase_with_balance = storage.purchase_with_balance
+add_configs = storage.add_configs
+get_configs_stats = storage.get_configs_stats
+create_order = storage.create_order
+get_user_orders = storage.get_user_orders
+get_user_orders_page = storage.get_user_orders_page
+get_order_config = storage.get_order_config
+get_admin_stats = storage.get_admin_stats
+get_pending_payments_stats = storage.get_pending_payments_stats
+create_payment = storage.create_payment
+update_cryptobot_invoice_id = storage.update_cryptobot_invoice_id
+update_crystal_pay_id = storage.update_crystal_pay_id
+update_payment_status = storage.update_payment_status
+settle_payment = storage.settle_payment
+get_pending_payments = storage.get_pending_payments
+settle_external_payment = storage.settle_external_payment
+settle_purchase = storage.settle_purchase
+settle_external_purchase = storage.settle_external_purchase
+get_user_payments_page = storage.get_user_payments_page
+get_payments_page = storage.get_payments_page
+get_payment = storage.get_payment
+get_promo_code = storage.get_promo_code
+redeem_promo_code = storage.redeem_promo_code
+delete_promo_code = storage.delete_promo_code
+get_promo_codes_page = storage.get_promo_codes_page
+create_broadcast = storage.create_broadcast
+get_broadcast = storage.get_broadcast
+get_last_broadcast = storage.get_last_broadcast
+get_running_broadcasts = storage.get_running_broadcasts
+get_broadcast_recipients = storage.get_broadcast_recipients
+save_broadcast_progress = storage.save_broadcast_progress
+mark_users_blocked = storage.mark_users_blocked
+get_expiring_orders = storage.get_expiring_orders
+mark_orders_reminded = storage.mark_orders_reminded
+mark_orders_renew_notified = storage.mark_orders_renew_notified
+get_auto_renew = storage.get_auto_renew
+toggle_auto_renew = storage.toggle_auto_renew
+get_renewable_orders = storage.get_renewable_orders
+renew_orders = storage.renew_orders
+set_broadcast_status = storage.set_broadcast_status
 
 # Получение плана по ID
 def get_plan_by_id(plan_id):
     plans = get_plans()
     return next((p for p in plans if p[0] == plan_id), None)
 
-# Получение неиспользованного конфига для тарифа и страны
-def get_unused_config(plan_id, country):
-    conn = sqlite3.connect('vpn_bot.db')
-    cursor = conn.cursor()
-    cursor.execute("""
-        SELECT id, config FROM configs 
-        WHERE plan_id = ? AND country = ? AND is_used = FALSE 
-        LIMIT 1
-    """, (plan_id, country))
-    config = cursor.fetchone()
-    conn.close()
-    return config
-
-# Пометка конфига как использованного
-def mark_config_as_used(config_id):
-    conn = sqlite3.connect('vpn_bot.db')
-    cursor = conn.cursor()
-    cursor.execute("UPDATE configs SET is_used = TRUE WHERE id = ?", (config_id,))
-    conn.commit()
-    conn.close()
-
-# Сохранение/обновление пользователя
-def save_user(user):
-    conn = sqlite3.connect('vpn_bot.db')
-    cursor = conn.cursor()
-    cursor.execute("""
-        INSERT OR REPLACE INTO users (user_id, username, first_name, last_name, balance)
-        VALUES (?, ?, ?, ?, COALESCE((SELECT balance FROM users WHERE user_id = ?), 0.0))
-    """, (user.id, user.username, user.first_name, user.last_name, user.id))
-    conn.commit()
-    conn.close()
-    logger.info(f"Пользователь сохранён: user_id={user.id}, username={user.username}")
-    
-# Создание заказа
-def create_order(user_id, plan_id, config_id, duration):
-    expiry_date = datetime.now() + timedelta(days=duration * 30)
-    conn = sqlite3.connect('vpn_bot.db')
-    cursor = conn.cursor()
-    cursor.execute("""
-        INSERT INTO orders (user_id, plan_id, config_id, expiry_date)
-        VALUES (?, ?, ?, ?)
-    """, (user_id, plan_id, config_id, expiry_date))
-    order_id = cursor.lastrowid
-    conn.commit()
-    conn.close()
-    return order_id
-
-# Получение заказов пользователя
-def get_user_orders(user_id):
-    conn = sqlite3.connect('vpn_bot.db')
-    cursor = conn.cursor()
-    cursor.execute("""
-        SELECT o.id, p.name, o.order_date, o.expiry_date, c.config, c.country
-        FROM orders o
-        JOIN plans p ON o.plan_id = p.id
-        LEFT JOIN configs c ON o.config_id = c.id
-        WHERE o.user_id = ? AND o.expiry_date > CURRENT_TIMESTAMP
-        ORDER BY o.order_date DESC
-    """, (user_id,))
-    orders = cursor.fetchall()
-    conn.close()
-    return orders
-
-# Получение статистики конфигураций
-def get_configs_stats():
-    conn = sqlite3.connect('vpn_bot.db')
-    cursor = conn.cursor()
-    cursor.execute("""
-        SELECT p.name, c.country, COUNT(*) as count
-        FROM configs c
-        JOIN plans p ON c.plan_id = p.id
-        WHERE c.is_used = FALSE
-        GROUP BY p.id, c.country
-    """)
-    stats = cursor.fetchall()
-    conn.close()
-    return stats
-
-# Создание платежа
-def create_payment(user_id, payment_type, plan_id, amount):
-    invoice_id = str(uuid.uuid4())
-    conn = sqlite3.connect('vpn_bot.db')
-    cursor = conn.cursor()
-    cursor.execute("""
-        INSERT INTO payments (user_id, type, plan_id, invoice_id, amount)
-        VALUES (?, ?, ?, ?, ?)
-    """, (user_id, payment_type, plan_id, invoice_id, amount))
-    conn.commit()
-    conn.close()
-    logger.info(f"Создан платёж: user_id={user_id}, type={payment_type}, plan_id={plan_id}, amount={amount}, invoice_id={invoice_id}")
-    return invoice_id
-
-# Обновление cryptobot_invoice_id
-def update_cryptobot_invoice_id(internal_invoice_id, cb_invoice_id):
-    conn = sqlite3.connect('vpn_bot.db')
-    cursor = conn.cursor()
-    cursor.execute("""
-        UPDATE payments SET cryptobot_invoice_id = ? WHERE invoice_id = ?
-    """, (cb_invoice_id, internal_invoice_id))
-    conn.commit()
-    conn.close()
-
-# Обновление crystal_pay_id в базе данных
-def update_crystal_pay_id(internal_invoice_id, crystal_id):
-    conn = sqlite3.connect('vpn_bot.db')
-    cursor = conn.cursor()
-    cursor.execute("""
-        UPDATE payments SET crystal_pay_id = ? WHERE invoice_id = ?
-    """, (crystal_id, internal_invoice_id))
-    conn.commit()
-    conn.close()
-
-# Обновление статуса платежа
-def update_payment_status(invoice_id, status):
-    conn = sqlite3.connect('vpn_bot.db')
-    cursor = conn.cursor()
-    cursor.execute("""
-        UPDATE payments SET status = ? WHERE invoice_id = ?
-    """, (status, invoice_id))
-    conn.commit()
-    conn.close()
-
-# Получение данных платежа
-def get_payment(internal_invoice_id):
-    conn = sqlite3.connect('vpn_bot.db')
-    cursor = conn.cursor()
-    cursor.execute("""
-        SELECT p.id, p.user_id, p.type, p.plan_id, p.amount, p.invoice_id, p.cryptobot_invoice_id, p.crystal_pay_id, p.status, p.created_at, pl.name as plan_name 
-        FROM payments p
-        LEFT JOIN plans pl ON p.plan_id = pl.id
-        WHERE p.invoice_id = ?
-    """, (internal_invoice_id,))
-    payment = cursor.fetchone()
-    conn.close()
-    if payment:
-        logger.info(f"Получен платёж: invoice_id={internal_invoice_id}, type={payment[2]}, status={payment[8]}")
-    else:
-        logger.warning(f"Платёж не найден: invoice_id={internal_invoice_id}")
-    return payment
+# Деактивировать промокод
+def deactivate_promo_code(code):
+    storage.set_promo_code_active(code, False)
+
+# Снова активировать промокод
+def reactivate_promo_code(code):
+    storage.set_promo_code_active(code, True)
+
+# HTTP-запрос к платёжному провайдеру с замером времени (спан 'provider')
+def provider_request(provider, operation, method, url, **kwargs):
+    start = time.perf_counter()
+    ok = False
+    try:
+        response = requests.request(method, url, **kwargs)
+        ok = response.status_code < 400
+        return response
+    finally:
+        record_span('provider', f"{provider}.{operation}", time.perf_counter() - start, ok)
 
 # Создание счета в CryptoBot
-def create_cryptobot_invoice(user_id, amount, description, payload):
+def create_cryptobot_invoice(user_id, amount, description, payload, expires_in=None):
     data = {
         "amount": str(amount),
         "asset": "USDT",  # Изменено на USDT
@@ -394,12 +2061,14 @@ def create_cryptobot_invoice(user_id, amount, description, payload):
         "paid_btn_name": "viewItem",
         "paid_btn_url": f"https://t.me/{BOT_TOKEN.split(':')[0]}?start=menu"
     }
+    if expires_in:
+        data["expires_in"] = expires_in
     
     try:
         logger.info(f"Sending request to CryptoBot API: {data}")
         url = f"{CRYPTO_BOT_API_URL}/createInvoice"
         headers = {"Crypto-Pay-API-Token": CRYPTO_BOT_TOKEN}
-        response = requests.post(url, headers=headers, data=data, timeout=10)
+        response = provider_request('cryptobot', 'createInvoice', 'POST', url, headers=headers, data=data, timeout=10)
         logger.info(f"CryptoBot response: {response.status_code} - {response.text}")
         if response.status_code == 200:
             result = response.json()
@@ -418,8 +2087,8 @@ def create_crypto_invoice(user_id, amount, description, payload=None):
     return create_cryptobot_invoice(user_id, amount, description, payload)
 
 # Создание счета в CrystalPAY
-def create_crystal_pay_invoice(user_id, amount, description, callback_url=None):
-    """Создание счета в CrystalPAY (минимальный JSON-набор полей)"""
+def create_crystal_pay_invoice(user_id, amount, description, callback_url=None, lifetime=300):
+    """Создание счета в CrystalPAY (минимальный JSON-набор полей); lifetime — в минутах"""
     url = f"{CRYSTAL_PAY_API_URL}/invoice/create/"
 
     invoice_id = str(uuid.uuid4())
@@ -430,7 +2099,7 @@ def create_crystal_pay_invoice(user_id, amount, description, callback_url=None):
         "type": "purchase",
         "amount": int(round(float(amount))),
         "extra": invoice_id,
-        "lifetime": 300
+        "lifetime": lifetime
     }
     # callback_url опционально, если поддерживается вашим тарифом
     if callback_url:
@@ -439,7 +2108,7 @@ def create_crystal_pay_invoice(user_id, amount, description, callback_url=None):
     try:
         headers = {"Content-Type": "application/json"}
         logger.info("Sending request to CrystalPAY API (json)")
-        response = requests.post(url, headers=headers, json=payload, timeout=10)
+        response = provider_request('crystalpay', 'invoice.create', 'POST', url, headers=headers, json=payload, timeout=10)
         logger.info(f"CrystalPAY response: {response.status_code} - {response.text}")
 
         if response.status_code == 200:
@@ -478,7 +2147,7 @@ def create_crystal_pay_invoice_rub(user_id, rub_amount, description, internal_in
     try:
         headers = {"Content-Type": "application/json"}
         logger.info("Sending request to CrystalPAY API (json, RUB)")
-        response = requests.post(url, headers=headers, json=payload, timeout=10)
+        response = provider_request('crystalpay', 'invoice.create', 'POST', url, headers=headers, json=payload, timeout=10)
         logger.info(f"CrystalPAY RUB response: {response.status_code} - {response.text}")
         if response.status_code == 200:
             result = response.json()
@@ -497,6 +2166,9 @@ def create_crystal_pay_invoice_rub(user_id, rub_amount, description, internal_in
         logger.error(f"Error creating CrystalPAY RUB invoice: {e}")
         return {"error": True, "errors": [str(e)]}
 
+# Состояния счёта CrystalPAY, после которых оплаты уже не будет
+CRYSTAL_PAY_EXPIRED_STATES = ("expired", "canceled", "cancelled")
+
 def check_crystal_pay_payment(crystal_id):
     """Проверка статуса платежа в CrystalPAY (используем JSON)."""
     url = f"{CRYSTAL_PAY_API_URL}/invoice/info/"
@@ -509,7 +2181,7 @@ def check_crystal_pay_payment(crystal_id):
 
     try:
         headers = {"Content-Type": "application/json"}
-        response = requests.post(url, headers=headers, json=data, timeout=10)
+        response = provider_request('crystalpay', 'invoice.info', 'POST', url, headers=headers, json=data, timeout=10)
         logger.info(f"CrystalPAY check response: {response.status_code} - {response.text}")
         if response.status_code == 200:
             result = response.json()
@@ -525,6 +2197,25 @@ def check_crystal_pay_payment(crystal_id):
         logger.error(f"Error checking CrystalPAY payment: {e}")
         return "error"
 
+# Статусы пачки счетов CryptoBot одним getInvoices: {id счёта: счёт}; None — ошибка запроса
+def get_cryptobot_invoices(cb_invoice_ids):
+    url = f"{CRYPTO_BOT_API_URL}/getInvoices"
+    headers = {"Crypto-Pay-API-Token": CRYPTO_BOT_TOKEN}
+    params = {"invoice_ids": ",".join(str(i) for i in cb_invoice_ids), "count": len(cb_invoice_ids)}
+    try:
+        response = provider_request('cryptobot', 'getInvoices', 'GET', url, headers=headers, params=params, timeout=10)
+        if response.status_code != 200:
+            logger.error(f"HTTP error checking CryptoBot invoices: {response.status_code} - {response.text}")
+            return None
+        result = response.json()
+        if not result.get("ok"):
+            logger.error(f"CryptoBot getInvoices error: {result}")
+            return None
+        return {str(item["invoice_id"]): item for item in result["result"].get("items", [])}
+    except Exception as e:
+        logger.error(f"Error checking CryptoBot invoices: {e}")
+        return None
+
 # Главное меню с красивыми кнопками
 def get_main_menu(is_admin=False):
     keyboard = [
@@ -539,11 +2230,13 @@ def get_main_menu(is_admin=False):
     return InlineKeyboardMarkup(keyboard)
     
 # Кнопки профиль
-def get_profile_menu():
+def get_profile_menu(user_id):
+    auto_renew = "✅ вкл" if get_auto_renew(user_id) else "выкл"
     keyboard = [
         [InlineKeyboardButton("💰 Пополнить баланс", callback_data="topup")],
         [InlineKeyboardButton("🎁 Активировать промокод", callback_data="promo")],
         [InlineKeyboardButton("🧾 Мои VPN", callback_data="orders")],
+        [InlineKeyboardButton(f"🔁 Автопродление с баланса: {auto_renew}", callback_data="auto_renew")],
         [InlineKeyboardButton("📊 История платежей", callback_data="payment_history")],
         [InlineKeyboardButton("🔙 Главное меню", callback_data="menu")]
     ]
@@ -567,6 +2260,9 @@ def get_admin_panel():
         [InlineKeyboardButton("💸 Выдать баланс", callback_data="admin_grant_balance")],
         [InlineKeyboardButton("👥 Пользователи", callback_data="admin_users")],
         [InlineKeyboardButton("💰 Платежи", callback_data="admin_payments")],
+        [InlineKeyboardButton("📣 Рассылка", callback_data="admin_broadcast")],
+        [InlineKeyboardButton("🐢 Медленные запросы", callback_data="admin_slow_queries")],
+        [InlineKeyboardButton("🔬 Профилирование", callback_data="admin_profile")],
         [InlineKeyboardButton("🔙 Выход", callback_data="menu")]
     ]
     logger.info(f"Формирование админ-панели: {keyboard}")
@@ -576,7 +2272,7 @@ def get_admin_panel():
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
         user = update.effective_user
-        save_user(user)
+        await asyncio.to_thread(save_user, user)
         
         # Проверяем подписку на канал (кроме админа)
         if user.id != ADMIN_ID:
@@ -614,7 +2310,8 @@ async def check_channel_subscription(bot, user_id):
     """Проверяет подписку пользователя на канал"""
     try:
         # Получаем информацию о статусе подписки
-        chat_member = await bot.get_chat_member(chat_id=CHANNEL_ID, user_id=user_id)
+        with trace_span('subscription', 'check_channel_subscription'):
+            chat_member = await bot.get_chat_member(chat_id=CHANNEL_ID, user_id=user_id)
         return chat_member.status in ['member', 'administrator', 'creator']
     except Exception as e:
         logger.error(f"Ошибка проверки подписки для пользователя {user_id}: {e}")
@@ -640,12 +2337,36 @@ def get_subscription_required_menu():
     
     return text, InlineKeyboardMarkup(keyboard)
 
+# Маршруты callback-кнопок для трассировки и метрик: динамическая часть (ID, суммы, коды) отбрасывается
+CALLBACK_ROUTES = {
+    "menu", "admin", "profile", "auto_renew", "plans", "orders", "payment_history", "topup", "topup_rub", "topup_rub_custom", "help",
+    "promo", "check_subscription", "admin_upload", "admin_stats", "admin_configs", "admin_users",
+    "admin_payments", "admin_broadcast", "admin_promos", "admin_create_promo", "admin_bulk_promo",
+    "admin_grant_balance", "admin_list_promos", "apl_back", "admin_slow_queries", "admin_profile",
+    "admin_profile_stop",
+}
+CALLBACK_ROUTE_PREFIXES = sorted([
+    "admin_broadcast_cancel_", "admin_profile_start_", "admin_upload_plan_", "admin_user_", "ap_", "apd_", "apl_", "apt_", "apx_",
+    "au_", "buy_balance_", "check_crystal_topup_", "check_crystal_", "check_invoice_", "check_payment_",
+    "country_", "order_cfg_", "orders_n", "orders_p", "pay_crystal_", "pay_stars_", "ph_", "plan_",
+    "topup_amount_", "topup_crypto_", "topup_crystal_rub_", "topup_crystal_", "topup_rub_amount_",
+], key=len, reverse=True)
+
+def callback_route(data):
+    if data in CALLBACK_ROUTES:
+        return data
+    for prefix in CALLBACK_ROUTE_PREFIXES:
+        if data.startswith(prefix):
+            return prefix.rstrip('_')
+    return 'unknown'
+
 async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     await query.answer()
     data = query.data
     user_id = query.from_user.id
     
+    set_trace_route(f"callback:{callback_route(data)}")
     logger.info(f"Callback data: {data}, user_id: {user_id}, state: {context.user_data.get('state')}")
     
     # Проверяем подписку для всех действий (кроме админа и самой проверки подписки)
@@ -715,7 +2436,7 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     
     if data == "profile":
-        balance = get_balance(user_id)
+        balance = await asyncio.to_thread(get_balance, user_id)
         username = escape_markdown(query.from_user.username or 'Не указан')
         first_name = escape_markdown(query.from_user.first_name)
         balance_str = escape_markdown(f"{balance:.2f}")
@@ -727,7 +2448,7 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             f"💰 Баланс: *{balance_str} USDT*\n\n"
             f"Выберите действие:"
         )
-        reply_markup = get_profile_menu()
+        reply_markup = await asyncio.to_thread(get_profile_menu, user_id)
         try:
             await query.edit_message_text(profile_text, reply_markup=reply_markup, parse_mode=ParseMode.MARKDOWN_V2)
         except Exception as e:
@@ -744,33 +2465,66 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await query.message.reply_text(profile_text_safe, reply_markup=reply_markup)
         return
     
+    if data == "auto_renew":
+        await asyncio.to_thread(toggle_auto_renew, user_id)
+        reply_markup = await asyncio.to_thread(get_profile_menu, user_id)
+        try:
+            await query.edit_message_reply_markup(reply_markup)
+        except BadRequest as e:
+            logger.info(f"Меню профиля не обновлено для user_id {user_id}: {e}")
+        return
+
     if data == "plans":
         await show_plans(update, context)
         return
     
     if data == "orders":
-        orders = get_user_orders(user_id)
-        if not orders:
-            orders_text = "📋 *У вас нет активных VPN-подписок.*"
-        else:
-            orders_text = "📋 *Ваши активные VPN:*\n\n"
-            for order in orders:
-                country_emoji = COUNTRIES.get(order[5], '🌍')
-                config_escaped = escape_markdown(order[4])
-                orders_text += (
-                    f"🆔 Заказ #{order[0]}\n"
-                    f"📦 {order[1]} | {country_emoji}\n"
-                    f"📅 С: {order[2][:10]}\n"
-                    f"⏰ До: {order[3][:10]}\n"
-                    f"🔑 Конфиг: `{config_escaped}`\n\n"
-                )
-        keyboard = [[InlineKeyboardButton("🔙 Профиль", callback_data="profile")]]
-        reply_markup = InlineKeyboardMarkup(keyboard)
+        await show_orders(update, context)
+        return
+
+    if data.startswith("orders_n"):
+        await show_orders(update, context, after_order_id=int(data.replace("orders_n", "", 1)))
+        return
+
+    if data.startswith("orders_p"):
+        await show_orders(update, context, before_order_id=int(data.replace("orders_p", "", 1)))
+        return
+
+    if data.startswith("order_cfg_"):
+        order_id = int(data.replace("order_cfg_", "", 1))
+        result = await asyncio.to_thread(get_order_config, user_id, order_id)
+        if not result:
+            await query.message.reply_text("❌ Заказ не найден.")
+            return
+        config, country = result
+        # Внутри блока кода MarkdownV2 экранируются только обратная кавычка и обратный слэш
+        config_code = config.replace('\\', '\\\\').replace('`', '\\`')
+        config_text = (
+            f"🔑 *Конфиг заказа \\#{order_id}* \\| {escape_markdown(COUNTRIES.get(country, '🌍'))}\n\n"
+            f"```\n{config_code}\n```"
+        )
         try:
-            await query.edit_message_text(orders_text, reply_markup=reply_markup, parse_mode=ParseMode.MARKDOWN_V2)
+            await query.message.reply_text(config_text, parse_mode=ParseMode.MARKDOWN_V2)
         except Exception as e:
-            logger.error(f"Ошибка при открытии заказов для user_id {user_id}: {e}")
-            await query.message.reply_text(orders_text.replace("*", ""), reply_markup=reply_markup)
+            logger.error(f"Ошибка отправки конфига заказа {order_id} для user_id {user_id}: {e}")
+            await query.message.reply_text(f"🔑 Конфиг заказа #{order_id}:\n\n{config}")
+        return
+
+    if data == "payment_history":
+        await show_payment_history(update, context)
+        return
+
+    if data.startswith("ph_"):
+        # ph_<статус><тип>[_n<id>|_p<id>]
+        parts = data.split('_')
+        filters_code = parts[1]
+        after_id = before_id = None
+        if len(parts) > 2:
+            if parts[2].startswith('n'):
+                after_id = int(parts[2][1:])
+            else:
+                before_id = int(parts[2][1:])
+        await show_payment_history(update, context, filters_code[0], filters_code[1], after_id, before_id)
         return
 
     if data == "topup":
@@ -795,15 +2549,15 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await query.edit_message_text("❌ Неверная сумма для CryptoBot.")
             return
         # создаём внутренний платёж
-        internal_invoice_id = create_payment(user_id, 'topup', None, amount)
+        internal_invoice_id = await asyncio.to_thread(create_payment, user_id, 'topup', None, amount)
         description = f"Пополнение баланса на {amount} USDT"
         payload = json.dumps({"invoice_id": internal_invoice_id, "type": "topup"})
-        invoice = create_crypto_invoice(user_id, amount, description, payload)
+        invoice = await asyncio.to_thread(create_crypto_invoice, user_id, amount, description, payload)
         if not invoice:
             await query.edit_message_text("❌ Ошибка создания счёта CryptoBot.")
             return
         # сохраняем внешний id в БД
-        update_cryptobot_invoice_id(internal_invoice_id, invoice.get("invoice_id"))
+        await asyncio.to_thread(update_cryptobot_invoice_id, internal_invoice_id, invoice.get("invoice_id"))
         keyboard = [
             [InlineKeyboardButton("💳 Оплатить", url=invoice.get('pay_url'))],
             [InlineKeyboardButton("✅ Проверить", callback_data=f"check_payment_{internal_invoice_id}")],
@@ -832,12 +2586,12 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         except Exception:
             await query.edit_message_text("❌ Неверная сумма для CrystalPay (RUB).")
             return
-        crystal = create_crystal_pay_invoice_rub(user_id, rub_amount, f"Пополнение на {rub_amount} RUB", internal_invoice_id)
+        crystal = await asyncio.to_thread(create_crystal_pay_invoice_rub, user_id, rub_amount, f"Пополнение на {rub_amount} RUB", internal_invoice_id)
         if not crystal or crystal.get("error"):
             await query.edit_message_text("❌ Ошибка создания счёта CrystalPay (RUB).")
             return
         if crystal.get("crystal_id"):
-            update_crystal_pay_id(internal_invoice_id, crystal["crystal_id"])
+            await asyncio.to_thread(update_crystal_pay_id, internal_invoice_id, crystal["crystal_id"])
         keyboard = [
             [InlineKeyboardButton("💎 Оплатить", url=crystal.get('url', ''))],
             [InlineKeyboardButton("✅ Проверить", callback_data=f"check_crystal_topup_{internal_invoice_id}")],
@@ -858,17 +2612,17 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         except Exception:
             await query.edit_message_text("❌ Неверная сумма для CrystalPay.")
             return
-        internal_invoice_id = create_payment(user_id, 'topup', None, amount)
+        internal_invoice_id = await asyncio.to_thread(create_payment, user_id, 'topup', None, amount)
         description = f"Пополнение баланса на {amount} USDT"
         # важное: CrystalPay работает в RUB. Создаём счёт в RUB по курсу
         rub_amount = int(round(amount * RUB_PER_USDT))
-        crystal_invoice = create_crystal_pay_invoice_rub(user_id, rub_amount, description, internal_invoice_id)
+        crystal_invoice = await asyncio.to_thread(create_crystal_pay_invoice_rub, user_id, rub_amount, description, internal_invoice_id)
         if not crystal_invoice or crystal_invoice.get("error"):
             await query.edit_message_text("❌ Ошибка при создании счёта CrystalPay (RUB).")
             return
         # сохраняем crystal id в БД
         if crystal_invoice.get("crystal_id"):
-            update_crystal_pay_id(internal_invoice_id, crystal_invoice.get("crystal_id"))
+            await asyncio.to_thread(update_crystal_pay_id, internal_invoice_id, crystal_invoice.get("crystal_id"))
         keyboard = [
             [InlineKeyboardButton("💎 Оплатить", url=crystal_invoice.get('url', ''))],
             [InlineKeyboardButton("✅ Проверить", callback_data=f"check_crystal_topup_{internal_invoice_id}")],
@@ -886,7 +2640,7 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if data.startswith("topup_rub_amount_"):
         rub_amount = int(data.split('_')[3])
         usdt_amount = rub_to_usdt(rub_amount)
-        internal_invoice_id = create_payment(user_id, 'topup', None, usdt_amount)
+        internal_invoice_id = await asyncio.to_thread(create_payment, user_id, 'topup', None, usdt_amount)
         description = f"Пополнение баланса на {rub_amount} RUB (~{usdt_amount} USDT)"
         # Для CryptoBot платёж всё равно будет в USDT, предлагаем оба способа
         keyboard = [
@@ -906,12 +2660,12 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         rub_amount = int(parts[3])
         internal_invoice_id = parts[4]
         # создадим отдельный счёт в CrystalPay в рублях: используем amount как целое RUB
-        crystal = create_crystal_pay_invoice_rub(user_id, rub_amount, f"Пополнение на {rub_amount} RUB", internal_invoice_id)
+        crystal = await asyncio.to_thread(create_crystal_pay_invoice_rub, user_id, rub_amount, f"Пополнение на {rub_amount} RUB", internal_invoice_id)
         if not crystal or crystal.get("error"):
             await query.edit_message_text("❌ Ошибка создания счёта CrystalPay (RUB).")
             return
         if crystal.get("crystal_id"):
-            update_crystal_pay_id(internal_invoice_id, crystal["crystal_id"])
+            await asyncio.to_thread(update_crystal_pay_id, internal_invoice_id, crystal["crystal_id"])
         await query.edit_message_text(f"Ссылка для оплаты (RUB) через CrystalPay:\n{crystal.get('url')}")
         context.user_data['state'] = 'waiting_payment'
         return
@@ -976,7 +2730,7 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if data.startswith("country_") and context.user_data.get('state') == 'admin_select_country_upload':
         country = data.split('_')[1]
         plan_text = "📤 Выберите тариф:"
-        plans = get_plans()
+        plans = await asyncio.to_thread(get_plans)
         keyboard = []
         for plan in plans:
             keyboard.append([InlineKeyboardButton(f"{plan[1]} ({plan[3]} USDT)", callback_data=f"admin_upload_plan_{plan[0]}_{country}")])
@@ -991,8 +2745,9 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         country = parts[4]
         context.user_data['uploading_plan'] = plan_id
         context.user_data['uploading_country'] = country
+        plan = await asyncio.to_thread(get_plan_by_id, plan_id)
         upload_text = (
-            f"📤 Загрузка для {COUNTRIES[country]} | {get_plan_by_id(plan_id)[1]}\n\n"
+            f"📤 Загрузка для {COUNTRIES[country]} | {plan[1]}\n\n"
             "📁 Отправьте JSON-файл с конфигами (строка или массив строк)."
         )
         await query.edit_message_text(upload_text, parse_mode=ParseMode.MARKDOWN)
@@ -1001,24 +2756,7 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if data == "admin_stats":
         if user_id != ADMIN_ID:
             return
-        conn = sqlite3.connect('vpn_bot.db')
-        cursor = conn.cursor()
-        cursor.execute("SELECT COUNT(*) FROM users")
-        users_count = cursor.fetchone()[0]
-        cursor.execute("SELECT COUNT(*) FROM orders WHERE expiry_date > CURRENT_TIMESTAMP")
-        active_orders = cursor.fetchone()[0]
-        cursor.execute("SELECT SUM(amount) FROM payments WHERE status = 'paid'")
-        total_revenue = cursor.fetchone()[0] or 0
-        # Количество использованных промокодов
-        cursor.execute("SELECT COUNT(*) FROM promo_activations")
-        promo_used = cursor.fetchone()[0]
-        # Сумма выданных бонусов через промокоды
-        cursor.execute("SELECT SUM(p.amount) FROM promo_activations a JOIN promo_codes p ON a.code = p.code")
-        promo_bonus = cursor.fetchone()[0] or 0
-        # Сумма вручную выданных бонусов (через admin_grant_balance)
-        # (нет отдельной таблицы, считаем по payments с type='grant', если реализовано, иначе пропустить)
-        # stats_text
-        conn.close()
+        users_count, active_orders, total_revenue, promo_used, promo_bonus = await asyncio.to_thread(get_admin_stats)
         stats_text = (
             f"📊 *Статистика*\n\n"
             f"👥 Пользователей: *{users_count}*\n"
@@ -1032,10 +2770,55 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await query.edit_message_text(stats_text, reply_markup=reply_markup, parse_mode=ParseMode.MARKDOWN)
         return
     
+    if data == "admin_profile" or data.startswith("admin_profile_"):
+        if user_id != ADMIN_ID:
+            return
+        if data == "admin_profile_stop":
+            await finish_profiling(context.application)
+        elif data.startswith("admin_profile_start_"):
+            mode, max_updates, seconds = parse_profile_args(data[len("admin_profile_start_"):].split('_')[::-1])
+            start_profiling(context.application, query.message.chat_id, mode, max_updates, seconds)
+        text, reply_markup = get_profile_panel()
+        try:
+            await query.edit_message_text(text, reply_markup=reply_markup)
+        except BadRequest as e:
+            # «Message is not modified» при повторном нажатии «Обновить»
+            logger.info(f"Экран профилирования не обновлён: {e}")
+        return
+
+    if data == "admin_slow_queries":
+        if user_id != ADMIN_ID:
+            return
+        entries = slow_query_log.top(SLOW_QUERIES_TOP)
+        if not entries:
+            text = f"🐢 Медленные запросы\n\nЗапросов дольше {SLOW_QUERY_MS:g} мс с момента запуска не было."
+        else:
+            text = f"🐢 Медленные запросы (> {SLOW_QUERY_MS:g} мс, с момента запуска)\n"
+            for entry in entries:
+                sql = entry['sql'] if len(entry['sql']) <= 200 else entry['sql'][:200] + '…'
+                text += (
+                    f"\n⏱ max {entry['max'] * 1000:.1f} мс, avg {entry['total'] / entry['count'] * 1000:.1f} мс, "
+                    f"×{entry['count']} | {', '.join(entry['helpers'])}\n{sql}\n"
+                )
+                if entry['plan']:
+                    text += "📋 " + "; ".join(entry['plan']) + "\n"
+            if len(text) > 4000:
+                text = text[:4000] + "…"
+        keyboard = [
+            [InlineKeyboardButton("🔄 Обновить", callback_data="admin_slow_queries")],
+            [InlineKeyboardButton("🔙 Админ", callback_data="admin")],
+        ]
+        try:
+            await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard))
+        except BadRequest as e:
+            # «Message is not modified» при повторном нажатии «Обновить»
+            logger.info(f"Список медленных запросов не обновлён: {e}")
+        return
+
     if data == "admin_configs":
         if user_id != ADMIN_ID:
             return
-        stats = get_configs_stats()
+        stats = await asyncio.to_thread(get_configs_stats)
         if not stats:
             configs_text = "🔍 *Конфигурации*\n\nНет доступных конфигов."
         else:
@@ -1048,8 +2831,73 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await query.edit_message_text(configs_text, reply_markup=reply_markup, parse_mode=ParseMode.MARKDOWN)
         return
     
-    if data in ["admin_users", "admin_payments"]:
-        await query.edit_message_text("🔧 Функция в разработке.", reply_markup=[[InlineKeyboardButton("🔙 Админ", callback_data="admin")]])
+    if data == "admin_broadcast":
+        if user_id != ADMIN_ID:
+            return
+        broadcast = await asyncio.to_thread(get_last_broadcast)
+        keyboard = []
+        if broadcast and broadcast[2] == 'running':
+            text = format_broadcast_status(broadcast)
+            keyboard.append([InlineKeyboardButton("🔄 Обновить", callback_data="admin_broadcast")])
+            keyboard.append([InlineKeyboardButton("⛔ Остановить", callback_data=f"admin_broadcast_cancel_{broadcast[0]}")])
+        else:
+            text = "📣 Рассылка\n\nОтправьте текст сообщения для всех пользователей."
+            if broadcast:
+                text += f"\n\nПоследняя:\n{format_broadcast_status(broadcast)}"
+            context.user_data['state'] = 'waiting_broadcast_text'
+        keyboard.append([InlineKeyboardButton("🔙 Админ", callback_data="admin")])
+        await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard))
+        return
+
+    if data.startswith("admin_broadcast_cancel_"):
+        if user_id != ADMIN_ID:
+            return
+        broadcast_id = int(data.replace("admin_broadcast_cancel_", "", 1))
+        await asyncio.to_thread(set_broadcast_status, broadcast_id, 'cancelled')
+        keyboard = [[InlineKeyboardButton("🔙 Админ", callback_data="admin")]]
+        await query.edit_message_text(f"⛔ Рассылка #{broadcast_id} остановлена.", reply_markup=InlineKeyboardMarkup(keyboard))
+        return
+
+    if data == "admin_users":
+        if user_id != ADMIN_ID:
+            return
+        keyboard = [[InlineKeyboardButton("🔙 Админ", callback_data="admin")]]
+        await query.edit_message_text("👥 Пользователи\n\nВведите ID пользователя или начало username:", reply_markup=InlineKeyboardMarkup(keyboard))
+        context.user_data['state'] = 'waiting_admin_user_search'
+        return
+
+    if data.startswith("admin_user_"):
+        if user_id != ADMIN_ID:
+            return
+        await show_admin_user_card(update, context, int(data.replace("admin_user_", "", 1)))
+        return
+
+    if data.startswith("au_"):
+        # au_<o|p>_<user_id>[_n<id>|_p<id>] — заказы / платежи выбранного пользователя
+        if user_id != ADMIN_ID:
+            return
+        parts = data.split('_')
+        after_id = before_id = None
+        if len(parts) > 3:
+            if parts[3].startswith('n'):
+                after_id = int(parts[3][1:])
+            else:
+                before_id = int(parts[3][1:])
+        await show_admin_user_items(update, context, parts[1], int(parts[2]), after_id, before_id)
+        return
+
+    if data == "admin_payments" or data.startswith("ap_"):
+        # ap_<статус>[_n<id>|_p<id>]
+        if user_id != ADMIN_ID:
+            return
+        parts = data.split('_') if data.startswith("ap_") else ["ap", "a"]
+        after_id = before_id = None
+        if len(parts) > 2:
+            if parts[2].startswith('n'):
+                after_id = int(parts[2][1:])
+            else:
+                before_id = int(parts[2][1:])
+        await show_admin_payments(update, context, parts[1], after_id, before_id)
         return
     
     if data.startswith("country_") and 'selected_plan' in context.user_data:
@@ -1098,6 +2946,7 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         )
         keyboard = [
             [InlineKeyboardButton("➕ Создать промокод", callback_data="admin_create_promo")],
+            [InlineKeyboardButton("📦 Сгенерировать пачку", callback_data="admin_bulk_promo")],
             [InlineKeyboardButton("📋 Список промокодов", callback_data="admin_list_promos")],
             [InlineKeyboardButton("🔙 Админ", callback_data="admin")]
         ]
@@ -1117,6 +2966,18 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await query.edit_message_text(text, reply_markup=reply_markup, parse_mode=ParseMode.MARKDOWN_V2)
         context.user_data['state'] = 'waiting_create_promo'
         return
+    if data == "admin_bulk_promo":
+        if user_id != ADMIN_ID:
+            return
+        text = (
+            "📦 Генерация промокодов\n\n"
+            "Введите через пробел: КОЛИЧЕСТВО СУММА МАКС_АКТИВАЦИЙ(или 0) ДНЕЙ(или 0, если без срока) [ПРЕФИКС]\n"
+            f"Пример: 5000 1 1 30 NY\n\nНе больше {PROMO_BULK_MAX} кодов за раз. Коды придут файлом."
+        )
+        keyboard = [[InlineKeyboardButton("🔙 Промокоды", callback_data="admin_promos")]]
+        await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard))
+        context.user_data['state'] = 'waiting_bulk_promo'
+        return
     if data == "admin_grant_balance":
         if user_id != ADMIN_ID:
             return
@@ -1130,85 +2991,57 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         context.user_data['state'] = 'waiting_grant_id'
         return
 
-    if data == "admin_list_promos":
+    if data == "apl_back":
+        # Возврат на ту же страницу списка, с которой ушли
         if user_id != ADMIN_ID:
             return
-        conn = sqlite3.connect('vpn_bot.db')
-        cursor = conn.cursor()
-        cursor.execute("SELECT code, amount, max_activations, used_activations, expires_at, is_active FROM promo_codes ORDER BY code")
-        promos = cursor.fetchall()
-        conn.close()
-        if not promos:
-            text = "Нет промокодов."
-            keyboard = [[InlineKeyboardButton("🔙 Промокоды", callback_data="admin_promos")]]
-            reply_markup = InlineKeyboardMarkup(keyboard)
-            await query.edit_message_text(text, reply_markup=reply_markup, parse_mode=ParseMode.MARKDOWN)
-            return
-        text = "📋 *Список промокодов*\n\nВыберите промокод для управления:" 
-        keyboard = []
-        for p in promos:
-            code, amount, max_a, used_a, expires, active = p
-            max_a = max_a if max_a is not None else '∞'
-            expires = expires[:10] if expires else '∞'
-            status = '✅' if active else '❌'
-            text += f"\n{status} `{code}` | {amount} USDT | {used_a}/{max_a} | до {expires}"
-            row = [
-                InlineKeyboardButton("❌ Деактивировать" if active else "✅ Активировать", callback_data=f"admin_deactivate_promo_{code}"),
-                InlineKeyboardButton("🗑️ Удалить", callback_data=f"admin_delete_promo_{code}")
-            ]
-            keyboard.append(row)
-        keyboard.append([InlineKeyboardButton("🔙 Промокоды", callback_data="admin_promos")])
-        reply_markup = InlineKeyboardMarkup(keyboard)
-        await query.edit_message_text(text, reply_markup=reply_markup, parse_mode=ParseMode.MARKDOWN)
+        await show_promo_list(update, context, **context.user_data.get('promo_page', {}))
         return
-    if data.startswith("admin_deactivate_promo_"):
+    if data == "admin_list_promos" or data.startswith("apl_"):
+        # apl_<фильтр>[_n<код>|_p<код>]
         if user_id != ADMIN_ID:
             return
-        code = data.replace("admin_deactivate_promo_", "")
-        promo = get_promo_code(code)
-        if not promo:
-            await query.edit_message_text("Промокод не найден.")
+        parts = data.split('_', 2) if data.startswith("apl_") else ["apl", "a"]
+        after_code = before_code = None
+        if len(parts) > 2:
+            if parts[2].startswith('n'):
+                after_code = parts[2][1:]
+            else:
+                before_code = parts[2][1:]
+        await show_promo_list(update, context, parts[1], after_code, before_code)
+        return
+    if data.startswith("apt_"):
+        # Включить/выключить промокод и перерисовать текущую страницу
+        if user_id != ADMIN_ID:
             return
-        if promo[5]:
-            deactivate_promo_code(code)
-            await query.edit_message_text(f"❌ Промокод `{code}` деактивирован.", parse_mode=ParseMode.MARKDOWN)
-        else:
-            # Активировать обратно
-            conn = sqlite3.connect('vpn_bot.db')
-            cursor = conn.cursor()
-            cursor.execute("UPDATE promo_codes SET is_active = 1 WHERE code = ?", (code,))
-            conn.commit()
-            conn.close()
-            await query.edit_message_text(f"✅ Промокод `{code}` активирован.", parse_mode=ParseMode.MARKDOWN)
-        # Вернуться к списку
-        await button_callback(update, context)
+        code = data.replace("apt_", "", 1)
+        promo = await asyncio.to_thread(get_promo_code, code)
+        if promo:
+            if promo[5]:
+                await asyncio.to_thread(deactivate_promo_code, code)
+            else:
+                await asyncio.to_thread(reactivate_promo_code, code)
+        await show_promo_list(update, context, **context.user_data.get('promo_page', {}))
         return
-    if data.startswith("admin_delete_promo_"):
+    if data.startswith("apd_"):
         if user_id != ADMIN_ID:
             return
-        code = data.replace("admin_delete_promo_", "")
+        code = data.replace("apd_", "", 1)
         # Подтверждение удаления
-        text = f"Вы уверены, что хотите удалить промокод `{code}`? Это действие необратимо."
+        text = f"Вы уверены, что хотите удалить промокод {code}? Это действие необратимо."
         keyboard = [
-            [InlineKeyboardButton("🗑️ Подтвердить удаление", callback_data=f"admin_confirm_delete_promo_{code}")],
-            [InlineKeyboardButton("🔙 Назад", callback_data="admin_list_promos")]
+            [InlineKeyboardButton("🗑️ Подтвердить удаление", callback_data=f"apx_{code}")],
+            [InlineKeyboardButton("🔙 Назад", callback_data="apl_back")]
         ]
         reply_markup = InlineKeyboardMarkup(keyboard)
-        await query.edit_message_text(text, reply_markup=reply_markup, parse_mode=ParseMode.MARKDOWN)
+        await query.edit_message_text(text, reply_markup=reply_markup)
         return
-    if data.startswith("admin_confirm_delete_promo_"):
+    if data.startswith("apx_"):
         if user_id != ADMIN_ID:
             return
-        code = data.replace("admin_confirm_delete_promo_", "")
-        conn = sqlite3.connect('vpn_bot.db')
-        cursor = conn.cursor()
-        cursor.execute("DELETE FROM promo_activations WHERE code = ?", (code,))
-        cursor.execute("DELETE FROM promo_codes WHERE code = ?", (code,))
-        conn.commit()
-        conn.close()
-        await query.edit_message_text(f"🗑️ Промокод `{code}` удалён.", parse_mode=ParseMode.MARKDOWN)
-        # Вернуться к списку
-        await button_callback(update, context)
+        code = data.replace("apx_", "", 1)
+        await asyncio.to_thread(delete_promo_code, code)
+        await show_promo_list(update, context, **context.user_data.get('promo_page', {}))
         return
 
     if data.startswith("pay_crystal_"):
@@ -1228,7 +3061,7 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         parts = data.split('_')
         plan_id = int(parts[2])
         country = parts[3]
-        plan = get_plan_by_id(plan_id)
+        plan = await asyncio.to_thread(get_plan_by_id, plan_id)
         if not plan:
             await query.edit_message_text("❌ Тариф не найден.")
             return
@@ -1237,13 +3070,18 @@ async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
         if stars_amount is None:
             amount_usdt = plan[3]
             stars_amount = max(1, int(round(amount_usdt * STARS_PER_USDT)))
+        result, reservation = await asyncio.to_thread(reserve_config_for_invoice, user_id, plan_id, country)
+        if result != 'ok':
+            await refuse_reservation(query, context, plan, country, result)
+            return
         title = "Оплата VPN звёздами"
         description = f"{plan[1]} | {COUNTRIES.get(country, country)} — {stars_amount}⭐"
-        payload = json.dumps({"type": "stars_purchase", "plan_id": plan_id, "country": country})
+        payload = json.dumps({"type": "stars_purchase", "plan_id": plan_id, "country": country, "reservation": reservation})
         try:
             await send_stars_invoice(context, query.message.chat_id, title, description, payload, stars_amount)
             await query.edit_message_text("⏳ Счёт на оплату звёздами отправлен в чат.")
         except Exception as e:
+            await asyncio.to_thread(release_reservation, reservation)
             logger.error(f"Stars invoice error for user {user_id}, plan {plan_id}: {e}")
             await query.message.reply_text("❌ Не удалось создать счёт в Stars. Убедитесь, что у вас доступен Telegram Stars и попробуйте ещё раз.")
         return
@@ -1262,7 +3100,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
             text, keyboard = get_subscription_required_menu()
             await update.message.reply_text(text, reply_markup=keyboard, parse_mode=ParseMode.MARKDOWN)
             context.user_data['state'] = 'subscription_required'
-        return
+            return
     
     state = context.user_data['state']
     if state == 'waiting_topup_rub_amount':
@@ -1273,7 +3111,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 return
 
             usdt_amount = rub_to_usdt(rub_amount)
-            internal_invoice_id = create_payment(user_id, 'topup', None, usdt_amount)
+            internal_invoice_id = await asyncio.to_thread(create_payment, user_id, 'topup', None, usdt_amount)
 
             keyboard = [
                 [InlineKeyboardButton("🤖 CryptoBot (USDT)", callback_data=f"topup_crypto_{usdt_amount}")],
@@ -1307,36 +3145,31 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if state == 'waiting_promo':
         code = update.message.text.strip()
         user_id = update.effective_user.id
-        promo = get_promo_code(code)
-        if not promo:
+        if is_promo_throttled(user_id):
+            await update.message.reply_text("⏳ Слишком много неверных попыток. Попробуйте позже.")
+            return
+        # Неизвестные коды отсекаются в памяти, без запроса к БД
+        if not await promo_code_may_exist(code):
+            register_failed_promo_attempt(user_id)
             await update.message.reply_text("❌ Промокод не найден.")
             return
-        if not promo[5]:  # is_active
-            await update.message.reply_text("❌ Промокод не активен.")
+        status, amount = await asyncio.to_thread(redeem_promo_code, code, user_id)
+        if status != 'ok':
+            errors = {
+                'not_found': "❌ Промокод не найден.",
+                'inactive': "❌ Промокод не активен.",
+                'expired': "❌ Срок действия промокода истёк.",
+                'exhausted': "❌ Промокод уже использован максимальное число раз.",
+                'already_used': "❌ Вы уже использовали этот промокод.",
+            }
+            if status == 'not_found':
+                register_failed_promo_attempt(user_id)
+            await update.message.reply_text(errors[status])
             return
-        if promo[4]:  # expires_at
-            try:
-                from datetime import datetime
-                expires = datetime.fromisoformat(promo[4])
-                if expires < datetime.now():
-                    await update.message.reply_text("❌ Срок действия промокода истёк.")
-                    return
-            except Exception:
-                pass
-        if promo[2] is not None and promo[3] >= promo[2]:  # used_activations >= max_activations
-            await update.message.reply_text("❌ Промокод уже использован максимальное число раз.")
-            return
-        if is_promo_activated_by_user(code, user_id):
-            await update.message.reply_text("❌ Вы уже использовали этот промокод.")
-            return
-        # Всё ок, активируем
-        activate_promo_code(code, user_id)
-        update_balance(user_id, promo[1])
-        credited_str = escape_markdown(f"{promo[1]:.2f}")
-        await update.message.reply_text(f"🎉 Промокод активирован! На ваш баланс зачислено {credited_str} USDT.")
+        await update.message.reply_text(f"🎉 Промокод активирован! На ваш баланс зачислено {amount:.2f} USDT.")
         context.user_data['state'] = 'menu'
         # Показываем профиль
-        balance = get_balance(user_id)
+        balance = await asyncio.to_thread(get_balance, user_id)
         username = escape_markdown(update.effective_user.username or 'Не указан')
         first_name = escape_markdown(update.effective_user.first_name)
         balance_str = escape_markdown(f"{balance:.2f}")
@@ -1348,7 +3181,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
             f"💰 Баланс: *{balance_str} USDT*\n\n"
             f"Выберите действие:"
         )
-        reply_markup = get_profile_menu()
+        reply_markup = await asyncio.to_thread(get_profile_menu, user_id)
         await update.message.reply_text(profile_text, reply_markup=reply_markup, parse_mode=ParseMode.MARKDOWN_V2)
         return
 
@@ -1363,7 +3196,7 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 return
             target_id = int(parts[0])
             amount = float(parts[1])
-            update_balance(target_id, amount)
+            await asyncio.to_thread(update_balance, target_id, amount)
             await update.message.reply_text(f"✅ Пользователю {target_id} начислено {amount:.2f} USDT.")
             # Возврат в админ-панель
             admin_text = "🔧 *Админ панель*"
@@ -1374,6 +3207,86 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await update.message.reply_text(f"Ошибка: {e}\nВведите ID и сумму через пробел.")
         return
 
+    if state == 'waiting_broadcast_text':
+        if update.effective_user.id != ADMIN_ID:
+            await update.message.reply_text("❌ Нет доступа.")
+            return
+        if await asyncio.to_thread(get_running_broadcasts):
+            await update.message.reply_text("⏳ Уже идёт рассылка. Дождитесь завершения или остановите её.")
+            return
+        text = update.message.text
+        broadcast_id = await asyncio.to_thread(create_broadcast, text)
+        start_broadcast_task(context.application, broadcast_id)
+        keyboard = [
+            [InlineKeyboardButton("🔄 Статус", callback_data="admin_broadcast")],
+            [InlineKeyboardButton("⛔ Остановить", callback_data=f"admin_broadcast_cancel_{broadcast_id}")]
+        ]
+        await update.message.reply_text(format_broadcast_status(await asyncio.to_thread(get_broadcast, broadcast_id)), reply_markup=InlineKeyboardMarkup(keyboard))
+        context.user_data['state'] = 'admin_menu'
+        return
+
+    if state == 'waiting_admin_user_search':
+        if update.effective_user.id != ADMIN_ID:
+            await update.message.reply_text("❌ Нет доступа.")
+            return
+        users = await asyncio.to_thread(search_users, update.message.text)
+        if not users:
+            await update.message.reply_text("Пользователь не найден. Попробуйте другой запрос.")
+            return
+        if len(users) == 1:
+            await send_admin_user_card(update.message.reply_text, users[0][0])
+            context.user_data['state'] = 'admin_menu'
+            return
+        keyboard = [
+            [InlineKeyboardButton(f"@{username or '—'} | {first_name or ''} | {uid}", callback_data=f"admin_user_{uid}")]
+            for uid, username, first_name in users[:10]
+        ]
+        keyboard.append([InlineKeyboardButton("🔙 Админ", callback_data="admin")])
+        text = "Найденные пользователи:"
+        if len(users) > 10:
+            text += "\n(показаны первые 10 — уточните запрос)"
+        await update.message.reply_text(text, reply_markup=InlineKeyboardMarkup(keyboard))
+        return
+
+    if state == 'waiting_bulk_promo':
+        if update.effective_user.id != ADMIN_ID:
+            await update.message.reply_text("❌ Нет доступа.")
+            return
+        usage = "Введите КОЛИЧЕСТВО СУММА МАКС_АКТИВАЦИЙ(или 0) ДНЕЙ(или 0) [ПРЕФИКС]. Пример: 5000 1 1 30 NY"
+        try:
+            parts = update.message.text.strip().split()
+            if len(parts) < 4 or len(parts) > 5:
+                await update.message.reply_text(usage)
+                return
+            count = int(parts[0])
+            amount = float(parts[1])
+            max_activations = int(parts[2]) if int(parts[2]) > 0 else None
+            days = int(parts[3])
+            prefix = parts[4].upper() if len(parts) > 4 else ""
+            if count < 1 or count > PROMO_BULK_MAX:
+                await update.message.reply_text(f"Количество должно быть от 1 до {PROMO_BULK_MAX}.")
+                return
+        except ValueError:
+            await update.message.reply_text(usage)
+            return
+        expires_at = (datetime.now() + timedelta(days=days)).isoformat() if days > 0 else None
+        await update.message.reply_text(f"⏳ Генерирую {count} промокодов...")
+        # Генерация и вставка в отдельном потоке, чтобы не блокировать обработку апдейтов
+        try:
+            codes = await asyncio.to_thread(create_promo_codes_bulk, count, amount, max_activations, expires_at, prefix)
+        except Exception as e:
+            logger.error(f"Ошибка генерации промокодов: {e}")
+            await update.message.reply_text("❌ Не удалось сгенерировать промокоды.")
+            return
+        filename = f"promo_{datetime.now().strftime('%Y%m%d_%H%M%S')}.txt"
+        await update.message.reply_document(
+            document="\n".join(codes).encode('utf-8'),
+            filename=filename,
+            caption=f"✅ Создано {len(codes)} промокодов: {amount} USDT, макс. {max_activations or '∞'}, срок {days if days > 0 else '∞'} дн."
+        )
+        context.user_data['state'] = 'admin_menu'
+        return
+
     if state == 'waiting_create_promo':
         if update.effective_user.id != ADMIN_ID:
             await update.message.reply_text("❌ Нет доступа.")
@@ -1387,14 +3300,14 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
             amount = float(parts[1])
             max_activations = int(parts[2]) if int(parts[2]) > 0 else None
             days = int(parts[3]) if len(parts) > 3 else 0
-            from datetime import datetime, timedelta
             expires_at = (datetime.now() + timedelta(days=days)).isoformat() if days > 0 else None
-            create_promo_code(code, amount, max_activations, expires_at)
+            await asyncio.to_thread(create_promo_code, code, amount, max_activations, expires_at)
             await update.message.reply_text(f"✅ Промокод {code} создан! Сумма: {amount} USDT, Макс: {max_activations or '∞'}, Срок: {days if days > 0 else '∞'} дней.")
             # Возврат в меню промокодов
             promo_menu = ("🎁 *Промокоды*\n\nВыберите действие:")
             keyboard = [
                 [InlineKeyboardButton("➕ Создать промокод", callback_data="admin_create_promo")],
+                [InlineKeyboardButton("📦 Сгенерировать пачку", callback_data="admin_bulk_promo")],
                 [InlineKeyboardButton("📋 Список промокодов", callback_data="admin_list_promos")],
                 [InlineKeyboardButton("🔙 Админ", callback_data="admin")]
             ]
@@ -1405,12 +3318,183 @@ async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await update.message.reply_text(f"Ошибка: {e}\nВведите КОД СУММА МАКС_АКТИВАЦИЙ(или 0) ДНЕЙ(или 0, если без срока). Пример: SUMMER2025 5 10 30")
         return
 
+# Страница «Мои VPN»: заказы без конфигов, конфиг — по кнопке
+async def show_orders(update: Update, context: ContextTypes.DEFAULT_TYPE, after_order_id=None, before_order_id=None):
+    query = update.callback_query
+    user_id = query.from_user.id
+    orders, has_newer, has_older = await asyncio.to_thread(get_user_orders_page, user_id, after_order_id, before_order_id)
+    keyboard = []
+    if not orders:
+        orders_text = "📋 *У вас нет активных VPN\\-подписок\\.*"
+    else:
+        orders_text = "📋 *Ваши активные VPN:*\n\n"
+        for order in orders:
+            order_id, plan_name, order_date, expiry_date, country = order
+            country_name = COUNTRIES.get(country, '🌍')
+            orders_text += (
+                f"🆔 Заказ \\#{order_id}\n"
+                f"📦 {escape_markdown(plan_name)} \\| {escape_markdown(country_name)}\n"
+                f"📅 С: {escape_markdown(str(order_date)[:10])}\n"
+                f"⏰ До: {escape_markdown(str(expiry_date)[:10])}\n\n"
+            )
+            keyboard.append([InlineKeyboardButton(f"🔑 Конфиг #{order_id}", callback_data=f"order_cfg_{order_id}")])
+        nav = keyset_nav_buttons(orders, has_newer, has_older, "orders")
+        if nav:
+            keyboard.append(nav)
+    keyboard.append([InlineKeyboardButton("🔙 Профиль", callback_data="profile")])
+    reply_markup = InlineKeyboardMarkup(keyboard)
+    try:
+        await query.edit_message_text(orders_text, reply_markup=reply_markup, parse_mode=ParseMode.MARKDOWN_V2)
+    except Exception as e:
+        logger.error(f"Ошибка при открытии заказов для user_id {user_id}: {e}")
+        await query.message.reply_text(orders_text.replace("*", "").replace("\\", ""), reply_markup=reply_markup)
+
+# История платежей с фильтрами по статусу и типу
+async def show_payment_history(update: Update, context: ContextTypes.DEFAULT_TYPE, status_code='a', type_code='a', after_id=None, before_id=None):
+    query = update.callback_query
+    user_id = query.from_user.id
+    status_label, statuses = PAYMENT_STATUS_FILTERS.get(status_code, PAYMENT_STATUS_FILTERS['a'])
+    type_label, payment_type = PAYMENT_TYPE_FILTERS.get(type_code, PAYMENT_TYPE_FILTERS['a'])
+    payments, has_newer, has_older = await asyncio.to_thread(get_user_payments_page, user_id, statuses, payment_type, after_id, before_id)
+
+    status_emoji = {'paid': '✅', 'pending': '⏳', 'active': '⏳', 'expired': '⌛'}
+    text = f"📊 История платежей\nФильтр: {status_label} · {type_label}\n\n"
+    if not payments:
+        text += "Платежей не найдено."
+    for payment_id, p_type, amount, status, created_at, plan_name in payments:
+        title = f"Покупка «{plan_name}»" if p_type == 'purchase' and plan_name else ("Пополнение" if p_type == 'topup' else "Покупка")
+        text += f"{status_emoji.get(status, '❔')} {str(created_at)[:16]} · {title} · {amount or 0:.2f} USDT\n"
+
+    prefix = f"ph_{status_code}{type_code}"
+    keyboard = [
+        [InlineKeyboardButton(("• " if code == status_code else "") + label, callback_data=f"ph_{code}{type_code}")
+         for code, (label, _) in PAYMENT_STATUS_FILTERS.items()],
+        [InlineKeyboardButton(("• " if code == type_code else "") + label, callback_data=f"ph_{status_code}{code}")
+         for code, (label, _) in PAYMENT_TYPE_FILTERS.items()],
+    ]
+    nav = keyset_nav_buttons(payments, has_newer, has_older, prefix)
+    if nav:
+        keyboard.append(nav)
+    keyboard.append([InlineKeyboardButton("🔙 Профиль", callback_data="profile")])
+    try:
+        await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard))
+    except BadRequest as e:
+        # «Message is not modified» при повторном нажатии на текущий фильтр
+        logger.info(f"История платежей не обновлена для user_id {user_id}: {e}")
+
+# Карточка пользователя в админке (send — reply_text или edit_message_text)
+async def send_admin_user_card(send, target_id):
+    card = await asyncio.to_thread(get_user_card, target_id)
+    keyboard = [[InlineKeyboardButton("🔙 Админ", callback_data="admin")]]
+    if not card:
+        await send("Пользователь не найден.", reply_markup=InlineKeyboardMarkup(keyboard))
+        return
+    uid, username, first_name, last_name, balance, is_blocked, active_orders, paid_count, paid_sum = card
+    text = (
+        f"👤 Пользователь {uid}\n\n"
+        f"📛 Username: @{username or '—'}\n"
+        f"👻 Имя: {first_name or ''} {last_name or ''}\n"
+        f"💰 Баланс: {balance or 0:.2f} USDT\n"
+        f"📦 Активных VPN: {active_orders}\n"
+        f"💳 Оплачено платежей: {paid_count} на {paid_sum:.2f} USDT\n"
+        f"🚫 Заблокировал бота: {'да' if is_blocked else 'нет'}"
+    )
+    keyboard = [
+        [InlineKeyboardButton("🧾 Заказы", callback_data=f"au_o_{uid}"),
+         InlineKeyboardButton("📊 Платежи", callback_data=f"au_p_{uid}")],
+        [InlineKeyboardButton("👥 Поиск", callback_data="admin_users"),
+         InlineKeyboardButton("🔙 Админ", callback_data="admin")]
+    ]
+    await send(text, reply_markup=InlineKeyboardMarkup(keyboard))
+
+async def show_admin_user_card(update: Update, context: ContextTypes.DEFAULT_TYPE, target_id):
+    await send_admin_user_card(update.callback_query.edit_message_text, target_id)
+
+# Заказы ('o') или платежи ('p') пользователя в админке, постранично
+async def show_admin_user_items(update: Update, context: ContextTypes.DEFAULT_TYPE, kind, target_id, after_id=None, before_id=None):
+    query = update.callback_query
+    if kind == 'o':
+        rows, has_newer, has_older = await asyncio.to_thread(get_user_orders_page, target_id, after_id, before_id)
+        text = f"🧾 Активные заказы {target_id}\n\n"
+        for order_id, plan_name, order_date, expiry_date, country in rows:
+            text += f"#{order_id} · {plan_name} · {COUNTRIES.get(country, country)} · до {str(expiry_date)[:10]}\n"
+    else:
+        rows, has_newer, has_older = await asyncio.to_thread(get_user_payments_page, target_id, after_id=after_id, before_id=before_id)
+        text = f"📊 Платежи {target_id}\n\n"
+        for payment_id, p_type, amount, status, created_at, plan_name in rows:
+            text += f"#{payment_id} · {str(created_at)[:16]} · {p_type} · {amount or 0:.2f} USDT · {status}\n"
+    if not rows:
+        text += "Нет записей."
+    keyboard = []
+    nav = keyset_nav_buttons(rows, has_newer, has_older, f"au_{kind}_{target_id}")
+    if nav:
+        keyboard.append(nav)
+    keyboard.append([InlineKeyboardButton("🔙 Пользователь", callback_data=f"admin_user_{target_id}")])
+    await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard))
+
+# Лента платежей в админке с фильтром по статусу
+async def show_admin_payments(update: Update, context: ContextTypes.DEFAULT_TYPE, status_code='a', after_id=None, before_id=None):
+    query = update.callback_query
+    status_label, status = ADMIN_PAYMENT_STATUSES.get(status_code, ADMIN_PAYMENT_STATUSES['a'])
+    rows, has_newer, has_older = await asyncio.to_thread(get_payments_page, status, after_id, before_id)
+    text = f"💰 Платежи · {status_label}\n\n"
+    if not rows:
+        text += "Нет платежей."
+    keyboard = [[
+        InlineKeyboardButton(("• " if code == status_code else "") + label, callback_data=f"ap_{code}")
+        for code, (label, _) in ADMIN_PAYMENT_STATUSES.items()
+    ]]
+    for payment_id, p_user_id, p_type, amount, p_status, created_at in rows:
+        text += f"#{payment_id} · {str(created_at)[:16]} · {p_user_id} · {p_type} · {amount or 0:.2f} USDT · {p_status}\n"
+        keyboard.append([InlineKeyboardButton(f"👤 #{payment_id} → {p_user_id}", callback_data=f"admin_user_{p_user_id}")])
+    nav = keyset_nav_buttons(rows, has_newer, has_older, f"ap_{status_code}")
+    if nav:
+        keyboard.append(nav)
+    keyboard.append([InlineKeyboardButton("🔙 Админ", callback_data="admin")])
+    try:
+        await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard))
+    except BadRequest as e:
+        logger.info(f"Лента платежей не обновлена: {e}")
+
+# Список промокодов в админке. Параметры страницы запоминаются, чтобы после
+# включения/выключения/удаления перерисовать ту же страницу, а не весь список.
+async def show_promo_list(update: Update, context: ContextTypes.DEFAULT_TYPE, filter_code='a', after_code=None, before_code=None):
+    query = update.callback_query
+    context.user_data['promo_page'] = {'filter_code': filter_code, 'after_code': after_code, 'before_code': before_code}
+    promos, has_prev, has_next = await asyncio.to_thread(get_promo_codes_page, filter_code, after_code, before_code)
+    filter_label = PROMO_FILTERS.get(filter_code, PROMO_FILTERS['a'])[0]
+    keyboard = [[
+        InlineKeyboardButton(("• " if code == filter_code else "") + label, callback_data=f"apl_{code}")
+        for code, (label, _) in PROMO_FILTERS.items()
+    ]]
+    if not promos:
+        text = f"📋 Промокоды · {filter_label}\n\nНет промокодов."
+    else:
+        text = f"📋 Промокоды · {filter_label}\n"
+        for code, amount, max_a, used_a, expires, active in promos:
+            max_a = max_a if max_a is not None else '∞'
+            expires = str(expires)[:10] if expires else '∞'
+            status = '✅' if active else '❌'
+            text += f"\n{status} {code} | {amount} USDT | {used_a}/{max_a} | до {expires}"
+            keyboard.append([
+                InlineKeyboardButton(f"{'❌' if active else '✅'} {code}", callback_data=f"apt_{code}"),
+                InlineKeyboardButton("🗑️", callback_data=f"apd_{code}")
+            ])
+    nav = keyset_nav_buttons(promos, has_prev, has_next, f"apl_{filter_code}")
+    if nav:
+        keyboard.append(nav)
+    keyboard.append([InlineKeyboardButton("🔙 Промокоды", callback_data="admin_promos")])
+    try:
+        await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard))
+    except BadRequest as e:
+        logger.info(f"Список промокодов не обновлён: {e}")
+
 # Показ тарифов с красивыми кнопками
 async def show_plans(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
-        plans = get_plans()
+        plans = await asyncio.to_thread(get_plans)
         user_id = update.callback_query.from_user.id if update.callback_query else update.effective_user.id
-        balance = get_balance(user_id)
+        balance = await asyncio.to_thread(get_balance, user_id)
         text = (
             f"🛍️ *Выберите тариф*\n\n"
             f"💰 Ваш баланс: *{balance:.2f} USDT*\n\n"
@@ -1443,14 +3527,14 @@ async def plan_selected(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
         query = update.callback_query
         plan_id = int(query.data.split('_')[1])
-        plan = get_plan_by_id(plan_id)
+        plan = await asyncio.to_thread(get_plan_by_id, plan_id)
         
         if not plan:
             await query.edit_message_text("❌ Тариф не найден.")
             return
         
         user_id = query.from_user.id
-        balance = get_balance(user_id)
+        balance = await asyncio.to_thread(get_balance, user_id)
         can_afford = balance >= plan[3]
         
         confirmation_text = (
@@ -1473,7 +3557,7 @@ async def country_selected(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     country_code = query.data.split('_')[1]
     plan_id = context.user_data.get('selected_plan')
-    plan = get_plan_by_id(plan_id)
+    plan = await asyncio.to_thread(get_plan_by_id, plan_id)
     can_afford = context.user_data.get('can_afford', False)
     
     confirmation_text = (
@@ -1498,32 +3582,24 @@ async def buy_with_balance(update: Update, context: ContextTypes.DEFAULT_TYPE):
         parts = query.data.split('_')
         plan_id = int(parts[2])
         country = parts[3]
-        plan = get_plan_by_id(plan_id)
+        plan = await asyncio.to_thread(get_plan_by_id, plan_id)
         
         user_id = query.from_user.id
-        balance = get_balance(user_id)
-        if balance < plan[3]:
+        # Списание, захват конфига и заказ — одной транзакцией: без конфига деньги не списываются
+        status, config = await asyncio.to_thread(purchase_with_balance, user_id, plan_id, country, plan[3], plan[2])
+        if status == 'no_funds':
             await query.edit_message_text("❌ Недостаточно средств.")
             return
-        
-        # Вычесть с баланса
-        update_balance(user_id, -plan[3])
-        
-        # Выдать конфиг
-        config_data = get_unused_config(plan_id, country)
-        if not config_data:
+        if status == 'no_configs':
             await query.edit_message_text("❌ Конфиги закончились. Свяжитесь с поддержкой.")
             await context.bot.send_message(ADMIN_ID, f"⚠️ Закончились конфиги: {plan[1]} | {COUNTRIES[country]}")
             return
         
-        config_id, config = config_data
-        mark_config_as_used(config_id)
-        create_order(user_id, plan_id, config_id, plan[2])
-        
         config_escaped = escape_markdown(config)
+        balance = await asyncio.to_thread(get_balance, user_id)
         success_text = (
             f"🎉 *Покупка успешна!*\n\n"
-            f"💰 Новый баланс: *{get_balance(user_id):.2f} USDT*\n\n"
+            f"💰 Новый баланс: *{balance:.2f} USDT*\n\n"
             f"🌍 {COUNTRIES[country]}\n"
             f"📦 {plan[1]}\n\n"
             f"🔑 *Конфиг:*\n"
@@ -1542,6 +3618,30 @@ async def buy_with_balance(update: Update, context: ContextTypes.DEFAULT_TYPE):
         logger.error(f"Error in buy_with_balance: {e}")
         await query.edit_message_text("Произошла ошибка.")
 
+RESERVATION_GRACE = 600  # резерв живёт дольше счёта: оплату могут проверить не сразу
+
+# Резерв конфига под новый счёт на покупку; возвращает (статус, ключ резерва — он же id счёта),
+# статус 'ok', 'limit' или 'sold_out'
+def reserve_config_for_invoice(user_id, plan_id, country):
+    reservation = str(uuid.uuid4())
+    reserved_until = datetime.now() + timedelta(seconds=INVOICE_LIFETIME + RESERVATION_GRACE)
+    result = reserve_config(reservation, user_id, plan_id, country, reserved_until)
+    return result, reservation if result == 'ok' else None
+
+# Отказ до выставления счёта: слишком много неоплаченных счетов или конфигов для тарифа и страны нет
+async def refuse_reservation(query, context, plan, country, result):
+    if result == 'limit':
+        await query.edit_message_text(
+            "⏳ У вас уже есть неоплаченные счета. Оплатите их или дождитесь, пока они истекут.",
+            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Меню", callback_data="menu")]])
+        )
+        return
+    await query.edit_message_text(
+        f"❌ Конфиги {plan[1]} | {COUNTRIES[country]} закончились. Выберите другую страну или попробуйте позже.",
+        reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Тарифы", callback_data="plans")]])
+    )
+    await context.bot.send_message(ADMIN_ID, f"⚠️ Закончились конфиги: {plan[1]} | {COUNTRIES[country]}")
+
 # Обработка оплаты через CryptoBot
 async def process_payment(update: Update, context: ContextTypes.DEFAULT_TYPE):
     try:
@@ -1549,20 +3649,26 @@ async def process_payment(update: Update, context: ContextTypes.DEFAULT_TYPE):
         parts = query.data.split('_')
         plan_id = int(parts[1])
         country = parts[2]
-        plan = get_plan_by_id(plan_id)
+        plan = await asyncio.to_thread(get_plan_by_id, plan_id)
         user_id = query.from_user.id
         amount = plan[3]
         
-        invoice_id = create_payment(user_id, 'purchase', plan_id, amount)
+        # Конфиг резервируется под счёт до оплаты: распроданное не продаём
+        result, invoice_id = await asyncio.to_thread(reserve_config_for_invoice, user_id, plan_id, country)
+        if result != 'ok':
+            await refuse_reservation(query, context, plan, country, result)
+            return
+        await asyncio.to_thread(create_payment, user_id, 'purchase', plan_id, amount, invoice_id=invoice_id, country=country)
         description = f"VPN {plan[1]} | {COUNTRIES[country]}"
         payload = json.dumps({"invoice_id": invoice_id, "type": "purchase", "country": country})
         
-        invoice = create_cryptobot_invoice(user_id, amount, description, payload)
+        invoice = await asyncio.to_thread(create_cryptobot_invoice, user_id, amount, description, payload, expires_in=INVOICE_LIFETIME)
         if not invoice:
+            await asyncio.to_thread(release_reservation, invoice_id)
             await query.edit_message_text("❌ Ошибка создания счёта.")
             return
         
-        update_cryptobot_invoice_id(invoice_id, invoice["invoice_id"])
+        await asyncio.to_thread(update_cryptobot_invoice_id, invoice_id, invoice["invoice_id"])
         
         pay_url = invoice["pay_url"]
         payment_text = (
@@ -1592,7 +3698,7 @@ async def check_payment(update: Update, context: ContextTypes.DEFAULT_TYPE):
         prefix = "check_payment_"
         internal_invoice_id = data[len(prefix):] if data.startswith(prefix) else data
         logger.info(f"check_payment: raw_data={data}, parsed_internal_invoice_id={internal_invoice_id}")
-        payment = get_payment(internal_invoice_id)
+        payment = await asyncio.to_thread(get_payment, internal_invoice_id)
         if not payment:
             await query.edit_message_text("❌ Платёж не найден.")
             return
@@ -1613,7 +3719,7 @@ async def check_payment(update: Update, context: ContextTypes.DEFAULT_TYPE):
         headers = {"Crypto-Pay-API-Token": CRYPTO_BOT_TOKEN}
         params = {"invoice_ids": cb_invoice_id}
 
-        response = requests.get(url, headers=headers, params=params, timeout=10)
+        response = await asyncio.to_thread(provider_request, 'cryptobot', 'getInvoices', 'GET', url, headers=headers, params=params, timeout=10)
         if response.status_code != 200:
             await query.edit_message_text("❌ Ошибка подключения.")
             return
@@ -1630,24 +3736,34 @@ async def check_payment(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await query.edit_message_text("❌ Несоответствие платежа.")
             return
 
-        update_payment_status(internal_invoice_id, status)
-
         if status == "paid":
+            # Проводит платёж только один обработчик, даже если «Проверить» нажали в нескольких процессах
+            if payment_type == "purchase":
+                country = payload_data.get("country", "de")
+                plan_id = payment[3]
+                plan_name = payment[10]
+                plan = await asyncio.to_thread(get_plan_by_id, plan_id)
+                result, claimed = await asyncio.to_thread(settle_purchase, internal_invoice_id, user_id, plan_id, country, plan[2], reservation=internal_invoice_id)
+                if result == 'duplicate':
+                    await query.edit_message_text("✅ Платёж уже обработан!")
+                    return
+                await send_config(query, context, plan_name, user_id, country, claimed)
+                return
+            if not await asyncio.to_thread(settle_payment, internal_invoice_id, credit_balance=(payment_type == "topup")):
+                await query.edit_message_text("✅ Платёж уже обработан!")
+                return
             if payment_type == "topup":
-                update_balance(user_id, amount)
+                balance = await asyncio.to_thread(get_balance, user_id)
                 await query.edit_message_text(
-                    f"🎉 Баланс пополнен!\n💰 +{amount} USDT\n💳 Новый баланс: *{get_balance(user_id):.2f} USDT*",
+                    f"🎉 Баланс пополнен!\n💰 +{amount} USDT\n💳 Новый баланс: *{balance:.2f} USDT*",
                     parse_mode=ParseMode.MARKDOWN
                 )
-            elif payment_type == "purchase":
-                country = payload_data.get("country", "de")
-                plan_id = payment[3]
-                plan_name = payment[10]
-                await deliver_config(query, context, plan_id, plan_name, user_id, country)
             else:
                 await query.edit_message_text("✅ Оплата получена.")
             return
-        elif status == "expired":
+        await asyncio.to_thread(update_payment_status, internal_invoice_id, status)
+        if status == "expired":
+            await asyncio.to_thread(release_reservation, internal_invoice_id)
             await query.edit_message_text("⏰ Счёт истёк. Создайте новый.")
             return
         else:
@@ -1658,10 +3774,23 @@ async def check_payment(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await query.edit_message_text("Произошла ошибка.")
         
 # Выдача конфига после оплаты покупки
-async def deliver_config(query, context, plan_id, plan_name, user_id, country):
+async def deliver_config(query, context, plan_id, plan_name, user_id, country, reservation=None):
+    try:
+        plan = await asyncio.to_thread(get_plan_by_id, plan_id)
+        claimed = await asyncio.to_thread(claim_config_order, user_id, plan_id, country, plan[2], reservation)
+    except Exception as e:
+        logger.error(f"Error in deliver_config: {e}")
+        if hasattr(query, 'message'):
+            await query.message.reply_text("Ошибка выдачи конфига.")
+        else:
+            await query.reply_text("Ошибка выдачи конфига.")
+        return
+    await send_config(query, context, plan_name, user_id, country, claimed)
+
+# Отправка выданного конфига пользователю и уведомление админа; claimed=None — конфиги закончились
+async def send_config(query, context, plan_name, user_id, country, claimed):
     try:
-        config_data = get_unused_config(plan_id, country)
-        if not config_data:
+        if not claimed:
             if hasattr(query, 'message'):
                 await query.message.reply_text("❌ Конфиги закончились.")
             else:
@@ -1669,9 +3798,7 @@ async def deliver_config(query, context, plan_id, plan_name, user_id, country):
             await context.bot.send_message(ADMIN_ID, f"⚠️ Закончились конфиги: {plan_name} | {COUNTRIES[country]}")
             return
         
-        config_id, config = config_data
-        mark_config_as_used(config_id)
-        create_order(user_id, plan_id, config_id, get_plan_by_id(plan_id)[2])
+        order_id, config = claimed
         
         # Экранируем конфиг для Markdown
         config_escaped = escape_markdown(config)
@@ -1718,7 +3845,7 @@ async def deliver_config(query, context, plan_id, plan_name, user_id, country):
             f"🆕 Новый заказ!\n👤 {username} (ID: {user_id})\n📦 {plan_name}\n🌍 {COUNTRIES[country]}"
         )
     except Exception as e:
-        logger.error(f"Error in deliver_config: {e}")
+        logger.error(f"Error in send_config: {e}")
         if hasattr(query, 'message'):
             await query.message.reply_text("Ошибка выдачи конфига.")
         else:
@@ -1731,6 +3858,74 @@ async def admin_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     await update.message.reply_text("🔧 *Админ панель*", reply_markup=get_admin_panel(), parse_mode=ParseMode.MARKDOWN)
 
+PROFILE_USAGE = (
+    "🔬 Профилирование\n\n"
+    "/profile 200 — cProfile следующих 200 апдейтов\n"
+    "/profile 60s — cProfile на 60 секунд\n"
+    "/profile 60s sample — семплирование стека вместо cProfile (меньше накладных расходов)\n"
+    "/profile stop — остановить и получить отчёт"
+)
+
+# Разбор аргументов /profile: количество апдейтов или секунды с суффиксом s, режим cprofile/sample
+def parse_profile_args(args):
+    if not args:
+        raise ValueError("нет аргументов")
+    mode = args[1].lower() if len(args) > 1 else 'cprofile'
+    if mode not in ('cprofile', 'sample'):
+        raise ValueError(f"неизвестный режим {mode}")
+    limit = args[0].lower()
+    if limit.endswith('s'):
+        seconds = float(limit[:-1])
+        if not 0 < seconds <= PROFILE_MAX_SECONDS:
+            raise ValueError("длительность вне диапазона")
+        return mode, None, seconds
+    max_updates = int(limit)
+    if not 0 < max_updates <= PROFILE_MAX_UPDATES:
+        raise ValueError("количество вне диапазона")
+    return mode, max_updates, None
+
+# Экран профилирования в админке
+def get_profile_panel():
+    if profiling_session is not None:
+        text = f"🔬 Профилирование идёт: {profiling_session.describe()}"
+        keyboard = [
+            [InlineKeyboardButton("🔄 Обновить", callback_data="admin_profile")],
+            [InlineKeyboardButton("⏹ Остановить и получить отчёт", callback_data="admin_profile_stop")],
+        ]
+    else:
+        text = PROFILE_USAGE
+        keyboard = [
+            [InlineKeyboardButton("▶️ cProfile: 100 апдейтов", callback_data="admin_profile_start_cprofile_100")],
+            [InlineKeyboardButton("▶️ Семплирование: 60 сек", callback_data="admin_profile_start_sample_60s")],
+        ]
+    keyboard.append([InlineKeyboardButton("🔙 Админ", callback_data="admin")])
+    return text, InlineKeyboardMarkup(keyboard)
+
+# Команда /profile (только для админа)
+async def profile_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if update.effective_user.id != ADMIN_ID:
+        await update.message.reply_text("❌ Нет доступа.")
+        return
+    args = context.args or []
+    if args and args[0].lower() == 'stop':
+        if not await finish_profiling(context.application):
+            await update.message.reply_text("Профилирование не запущено.")
+        return
+    if not args:
+        text, reply_markup = get_profile_panel()
+        await update.message.reply_text(text, reply_markup=reply_markup)
+        return
+    try:
+        mode, max_updates, seconds = parse_profile_args(args)
+    except ValueError:
+        await update.message.reply_text(PROFILE_USAGE)
+        return
+    session = start_profiling(context.application, update.effective_chat.id, mode, max_updates, seconds)
+    if session is None:
+        await update.message.reply_text(f"Профилирование уже идёт: {profiling_session.describe()}")
+        return
+    await update.message.reply_text(f"🔬 Профилирование запущено: {session.describe()}. Отчёт придёт документом.")
+
 # Обработка загруженного файла (для админа)
 async def handle_document(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if update.effective_user.id != ADMIN_ID or 'uploading_plan' not in context.user_data:
@@ -1755,25 +3950,22 @@ async def handle_document(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await update.message.reply_text("❌ Неверный формат JSON: ожидается строка или массив строк.")
             return
         
-        conn = sqlite3.connect('vpn_bot.db')
-        cursor = conn.cursor()
-        inserted = 0
+        valid = []
         for config in configs:
             if isinstance(config, str) and config.startswith('vless://'):
                 # Сохраняем полную строку конфига, включая часть после #
-                cursor.execute("INSERT INTO configs (plan_id, country, config) VALUES (?, ?, ?)", (plan_id, country, config))
-                inserted += 1
+                valid.append(config)
             else:
-                logger.warning(f"Пропущен некорректный конфиг: {config[:50]}...")
-        
-        conn.commit()
-        conn.close()
+                logger.warning(f"Пропущен некорректный конфиг: {str(config)[:50]}...")
+        await asyncio.to_thread(add_configs, plan_id, country, valid)
+        inserted = len(valid)
         
         if inserted == 0:
             await update.message.reply_text("❌ Не удалось загрузить конфиги: проверьте формат (должно начинаться с vless://).")
         else:
+            plan = await asyncio.to_thread(get_plan_by_id, plan_id)
             await update.message.reply_text(
-                f"✅ Загружено *{inserted}* конфигов для {COUNTRIES[country]} | {get_plan_by_id(plan_id)[1]}.",
+                f"✅ Загружено *{inserted}* конфигов для {COUNTRIES[country]} | {plan[1]}.",
                 parse_mode=ParseMode.MARKDOWN
             )
         del context.user_data['uploading_plan']
@@ -1785,51 +3977,362 @@ async def handle_document(update: Update, context: ContextTypes.DEFAULT_TYPE):
         logger.error(f"Ошибка в handle_document: {e}")
         await update.message.reply_text("❌ Ошибка загрузки.")
 
-# Получить промокод по коду
-def get_promo_code(code):
-    conn = sqlite3.connect('vpn_bot.db')
-    cursor = conn.cursor()
-    cursor.execute("SELECT code, amount, max_activations, used_activations, expires_at, is_active FROM promo_codes WHERE code = ?", (code,))
-    promo = cursor.fetchone()
-    conn.close()
-    return promo
-
-# Проверить, активировал ли пользователь промокод
-def is_promo_activated_by_user(code, user_id):
-    conn = sqlite3.connect('vpn_bot.db')
-    cursor = conn.cursor()
-    cursor.execute("SELECT 1 FROM promo_activations WHERE code = ? AND user_id = ?", (code, user_id))
-    result = cursor.fetchone()
-    conn.close()
-    return result is not None
-
-# Активировать промокод для пользователя
-def activate_promo_code(code, user_id):
-    conn = sqlite3.connect('vpn_bot.db')
-    cursor = conn.cursor()
-    cursor.execute("INSERT INTO promo_activations (code, user_id) VALUES (?, ?)", (code, user_id))
-    cursor.execute("UPDATE promo_codes SET used_activations = used_activations + 1 WHERE code = ?", (code,))
-    conn.commit()
-    conn.close()
+class PromoCodeFilter:
+    """Bloom-фильтр известных промокодов: «нет» — кода точно нет, «да» — проверяем в БД."""
+
+    def __init__(self, capacity, error_rate=0.01):
+        self.capacity = capacity
+        self.size = int(-capacity * math.log(error_rate) / (math.log(2) ** 2)) + 8
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray(self.size // 8 + 1)
+        self.count = 0
+
+    def _positions(self, code):
+        digest = hashlib.blake2b(code.encode('utf-8'), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def add(self, code):
+        for pos in self._positions(code):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+        self.count += 1
+
+    def __contains__(self, code):
+        return all(self.bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(code))
+
+PROMO_FILTER_TTL = 600  # полная пересборка фильтра (удалённые коды)
+PROMO_FILTER_SLACK = 5  # сек: коды из ещё не завершённых транзакций попадут в следующий дозапрос
+PROMO_MAX_FAILED_ATTEMPTS = 5  # неверных попыток на пользователя за окно
+PROMO_ATTEMPT_WINDOW = 600  # секунд
+promo_filter = None
+promo_filter_built_at = 0.0
+promo_filter_since = None  # created_at, начиная с которого кодов может не быть в фильтре
+promo_filter_lock = asyncio.Lock()
+promo_failed_attempts = {}  # user_id -> [время неудачных попыток]
+
+def promo_filter_stale():
+    return (promo_filter is None or time.monotonic() - promo_filter_built_at > PROMO_FILTER_TTL
+            or promo_filter.count > promo_filter.capacity)
+
+# Полная сборка фильтра (в потоке, вне event loop); возвращает фильтр и отметку для дозапросов
+def build_promo_filter():
+    since = datetime.now() - timedelta(seconds=PROMO_FILTER_SLACK)
+    codes = storage.get_promo_code_list()
+    new_filter = PromoCodeFilter(capacity=max(len(codes) * 2, 10000))
+    for code in codes:
+        new_filter.add(code)
+    logger.info(f"Фильтр промокодов собран: кодов={len(codes)}")
+    return new_filter, since
+
+# Фильтр известных промокодов (собирается лениво и пересобирается раз в PROMO_FILTER_TTL)
+async def get_promo_filter():
+    global promo_filter, promo_filter_built_at, promo_filter_since
+    if promo_filter_stale():
+        async with promo_filter_lock:
+            if promo_filter_stale():
+                promo_filter, promo_filter_since = await asyncio.to_thread(build_promo_filter)
+                promo_filter_built_at = time.monotonic()
+    return promo_filter
+
+# Может ли код существовать. При промахе фильтра дочитываем коды, созданные после его сборки
+# (в режиме router/worker их могли создать другие процессы) — запрос по индексу created_at
+async def promo_code_may_exist(code):
+    global promo_filter_since
+    known = await get_promo_filter()
+    if code in known:
+        return True
+    since = datetime.now() - timedelta(seconds=PROMO_FILTER_SLACK)
+    for new_code in await asyncio.to_thread(storage.get_promo_code_list, promo_filter_since):
+        known.add(new_code)
+    promo_filter_since = max(promo_filter_since, since)
+    return code in known
+
+# Превышен ли лимит неверных попыток ввода промокода
+def is_promo_throttled(user_id):
+    window_start = time.monotonic() - PROMO_ATTEMPT_WINDOW
+    attempts = [t for t in promo_failed_attempts.get(user_id, []) if t > window_start]
+    if attempts:
+        promo_failed_attempts[user_id] = attempts
+    else:
+        promo_failed_attempts.pop(user_id, None)
+    return len(attempts) >= PROMO_MAX_FAILED_ATTEMPTS
+
+def register_failed_promo_attempt(user_id):
+    promo_failed_attempts.setdefault(user_id, []).append(time.monotonic())
+    # Не даём словарю расти бесконечно: чистим пользователей без свежих попыток
+    if len(promo_failed_attempts) > 10000:
+        for uid in list(promo_failed_attempts):
+            is_promo_throttled(uid)
 
 # Создать промокод
 def create_promo_code(code, amount, max_activations=None, expires_at=None):
-    conn = sqlite3.connect('vpn_bot.db')
-    cursor = conn.cursor()
-    cursor.execute("""
-        INSERT INTO promo_codes (code, amount, max_activations, expires_at, is_active)
-        VALUES (?, ?, ?, ?, 1)
-    """, (code, amount, max_activations, expires_at))
-    conn.commit()
-    conn.close()
+    storage.create_promo_codes([code], amount, max_activations, expires_at)
+    if promo_filter is not None:
+        promo_filter.add(code)
 
-# Деактивировать промокод
-def deactivate_promo_code(code):
-    conn = sqlite3.connect('vpn_bot.db')
-    cursor = conn.cursor()
-    cursor.execute("UPDATE promo_codes SET is_active = 0 WHERE code = ?", (code,))
-    conn.commit()
-    conn.close()
+PROMO_BULK_MAX = 100000  # кодов за одну генерацию
+PROMO_CODE_ALPHABET = "ABCDEFGHJKLMNPQRSTUVWXYZ23456789"  # без похожих символов (O/0, I/1)
+PROMO_CODE_LENGTH = 10
+
+# Массовое создание промокодов: все коды одной транзакцией через executemany.
+# При совпадении с существующим кодом (практически невозможно) генерируем пачку заново.
+def create_promo_codes_bulk(count, amount, max_activations=None, expires_at=None, prefix=""):
+    for attempt in range(3):
+        codes = set()
+        while len(codes) < count:
+            codes.add(prefix + "".join(secrets.choice(PROMO_CODE_ALPHABET) for _ in range(PROMO_CODE_LENGTH)))
+        codes = sorted(codes)
+        try:
+            storage.create_promo_codes(codes, amount, max_activations, expires_at)
+        except storage.IntegrityError:
+            logger.warning(f"Совпадение при генерации промокодов, попытка {attempt + 1}")
+            continue
+        if promo_filter is not None:
+            for code in codes:
+                promo_filter.add(code)
+        logger.info(f"Создано промокодов пачкой: {count}, amount={amount}, max={max_activations}, expires_at={expires_at}")
+        return codes
+    raise RuntimeError("Не удалось сгенерировать уникальные промокоды")
+
+class BroadcastRateLimiter:
+    """Глобальный ограничитель: отправки распределяются по слотам не чаще rate в секунду."""
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate
+        self.next_slot = 0.0
+
+    async def acquire(self):
+        loop = asyncio.get_running_loop()
+        now = loop.time()
+        slot = max(self.next_slot, now)
+        self.next_slot = slot + self.interval
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+    def pause(self, seconds):
+        # RetryAfter от Telegram: сдвигаем все следующие слоты
+        self.next_slot = max(self.next_slot, asyncio.get_running_loop().time() + seconds)
+
+# Один ограничитель на процесс: рассылки, напоминания и уведомления автопродления делят общий лимит BROADCAST_RATE
+broadcast_limiter = BroadcastRateLimiter(BROADCAST_RATE)
+
+BROADCAST_BATCH_SIZE = 200  # получателей на одну пачку (после пачки сохраняется курсор)
+broadcast_tasks = {}  # broadcast_id -> asyncio.Task
+
+# Отправка одного сообщения рассылки: 'sent', 'blocked' или 'failed'
+async def send_broadcast_message(bot, limiter, user_id, text, reply_markup=None):
+    for attempt in range(3):
+        await limiter.acquire()
+        try:
+            await bot.send_message(chat_id=user_id, text=text, reply_markup=reply_markup)
+            return 'sent'
+        except RetryAfter as e:
+            logger.warning(f"Рассылка: RetryAfter {e.retry_after} сек.")
+            limiter.pause(e.retry_after)
+        except Forbidden:
+            return 'blocked'
+        except BadRequest as e:
+            if 'chat not found' in str(e).lower():
+                return 'blocked'
+            logger.error(f"Рассылка: ошибка отправки user_id {user_id}: {e}")
+            return 'failed'
+        except (TimedOut, NetworkError) as e:
+            logger.warning(f"Рассылка: сетевая ошибка для user_id {user_id} (попытка {attempt + 1}): {e}")
+    return 'failed'
+
+# Основной цикл рассылки: пачки по курсору, внутри пачки — пул воркеров
+async def run_broadcast(bot, broadcast_id):
+    broadcast = await asyncio.to_thread(get_broadcast, broadcast_id)
+    if not broadcast:
+        return
+    text = broadcast[1]
+    cursor_user_id = broadcast[3]
+    limiter = broadcast_limiter
+    logger.info(f"Рассылка {broadcast_id}: старт с user_id > {cursor_user_id}")
+    try:
+        while True:
+            # Проверяем статус между пачками, чтобы остановка из админки срабатывала быстро
+            if (await asyncio.to_thread(get_broadcast, broadcast_id))[2] != 'running':
+                logger.info(f"Рассылка {broadcast_id} остановлена")
+                return
+            user_ids = await asyncio.to_thread(get_broadcast_recipients, cursor_user_id, BROADCAST_BATCH_SIZE)
+            if not user_ids:
+                break
+            queue = asyncio.Queue()
+            for uid in user_ids:
+                queue.put_nowait(uid)
+            results = {}
+
+            async def worker():
+                while not queue.empty():
+                    uid = queue.get_nowait()
+                    results[uid] = await send_broadcast_message(bot, limiter, uid, text)
+
+            await asyncio.gather(*(worker() for _ in range(min(BROADCAST_WORKERS, len(user_ids)))))
+            cursor_user_id = user_ids[-1]
+            sent = sum(1 for r in results.values() if r == 'sent')
+            failed = sum(1 for r in results.values() if r == 'failed')
+            blocked_ids = [uid for uid, r in results.items() if r == 'blocked']
+            await asyncio.to_thread(save_broadcast_progress, broadcast_id, cursor_user_id, sent, failed, blocked_ids)
+        await asyncio.to_thread(set_broadcast_status, broadcast_id, 'done')
+        broadcast = await asyncio.to_thread(get_broadcast, broadcast_id)
+        logger.info(f"Рассылка {broadcast_id} завершена: отправлено={broadcast[5]}, ошибок={broadcast[6]}, заблокировали={broadcast[7]}")
+        await bot.send_message(ADMIN_ID, f"✅ Рассылка #{broadcast_id} завершена.\n\n{format_broadcast_status(broadcast)}")
+    except Exception as e:
+        # Статус остаётся running — рассылка продолжится с сохранённого курсора после рестарта
+        logger.error(f"Ошибка в рассылке {broadcast_id}: {e}")
+    finally:
+        broadcast_tasks.pop(broadcast_id, None)
+
+# Запуск рассылки в фоне (не блокирует обработку апдейтов)
+def start_broadcast_task(application, broadcast_id):
+    if broadcast_id in broadcast_tasks:
+        return
+    broadcast_tasks[broadcast_id] = application.create_task(run_broadcast(application.bot, broadcast_id))
+
+# Текст статуса рассылки с оценкой оставшегося времени
+def format_broadcast_status(broadcast):
+    broadcast_id, text, status, last_user_id, total, sent, failed, blocked, created_at, finished_at = broadcast
+    processed = sent + failed + blocked
+    status_names = {'running': '⏳ Идёт', 'done': '✅ Завершена', 'cancelled': '⛔ Остановлена'}
+    lines = [
+        f"📣 Рассылка #{broadcast_id}: {status_names.get(status, status)}",
+        f"👥 Получателей: {total}",
+        f"📨 Отправлено: {sent}",
+        f"🚫 Заблокировали бота: {blocked}",
+        f"❌ Ошибок: {failed}",
+    ]
+    if status == 'running':
+        remaining = max(total - processed, 0)
+        lines.append(f"⏱️ Осталось: ~{int(remaining / BROADCAST_RATE // 60)} мин.")
+    return "\n".join(lines)
+
+REMINDER_BATCH_SIZE = 200  # заказов на одну пачку напоминаний
+
+# Напоминания об окончании подписки. Пороги REMINDER_DAYS идут по возрастанию, окно порога — от предыдущего
+# порога до этого, так что заказ получает по одному напоминанию на порог. Пачка отмечается до отправки:
+# после сбоя или рестарта напоминание не повторится. Отправка — через общий с рассылками ограничитель скорости
+async def send_expiry_reminders(bot):
+    limiter = broadcast_limiter
+    now = datetime.now()
+    after = now
+    results = {'sent': 0, 'failed': 0, 'blocked': 0}
+    keyboard = InlineKeyboardMarkup([
+        [InlineKeyboardButton("🛍️ Продлить", callback_data="plans")],
+        [InlineKeyboardButton("🧾 Мои VPN", callback_data="orders")],
+    ])
+    # С автопродлением новая покупка не нужна: сообщаем о списании или просим пополнить баланс
+    auto_renew_keyboard = InlineKeyboardMarkup([
+        [InlineKeyboardButton("👤 Профиль", callback_data="profile")],
+        [InlineKeyboardButton("🧾 Мои VPN", callback_data="orders")],
+    ])
+    for days in REMINDER_DAYS:
+        until = now + timedelta(days=days)
+        while True:
+            orders = await asyncio.to_thread(get_expiring_orders, after, until, days, REMINDER_BATCH_SIZE)
+            if not orders:
+                break
+            await asyncio.to_thread(mark_orders_reminded, [order[0] for order in orders], days)
+            reminders, renew_notices = [], []
+            for order_id, user_id, expiry_date, plan_name, country, auto_renew, balance, price in orders:
+                subscription = f"Подписка «{plan_name}» ({COUNTRIES.get(country, country)})"
+                if not (RENEW_BEFORE_DAYS and auto_renew):
+                    reminders.append((user_id, f"⏰ {subscription} заканчивается {str(expiry_date)[:16]}.\n\n"
+                                               f"Продлите её заранее, чтобы VPN не отключился."))
+                elif balance >= price:
+                    renew_notices.append((user_id, f"🔁 {subscription} заканчивается {str(expiry_date)[:16]} и будет "
+                                                   f"продлена автоматически: с баланса спишется {price} USDT."))
+                else:
+                    renew_notices.append((user_id, f"⏰ {subscription} заканчивается {str(expiry_date)[:16]}.\n\n"
+                                                   f"Для автопродления нужно {price} USDT на балансе — пополните его заранее."))
+            await send_notices(bot, limiter, reminders, results, keyboard)
+            await send_notices(bot, limiter, renew_notices, results, auto_renew_keyboard)
+        after = until
+    return results
+
+# Пачка уведомлений через ограничитель рассылок: notices — [(user_id, текст)], итоги копятся в results
+async def send_notices(bot, limiter, notices, results, reply_markup=None):
+    queue = asyncio.Queue()
+    for notice in notices:
+        queue.put_nowait(notice)
+    blocked_ids = set()
+
+    async def worker():
+        while not queue.empty():
+            user_id, text = queue.get_nowait()
+            result = await send_broadcast_message(bot, limiter, user_id, text, reply_markup=reply_markup)
+            results[result] = results.get(result, 0) + 1
+            if result == 'blocked':
+                blocked_ids.add(user_id)
+
+    await asyncio.gather(*(worker() for _ in range(min(BROADCAST_WORKERS, len(notices)))))
+    if blocked_ids:
+        await asyncio.to_thread(mark_users_blocked, list(blocked_ids))
+
+RENEW_BATCH_SIZE = 200  # заказов на одну транзакцию автопродления
+
+# Автопродление: заказы пользователей с auto_renew, истекающие в ближайшие RENEW_BEFORE_DAYS, продлеваются
+# с баланса пачками — одна транзакция и одна выборка на RENEW_BATCH_SIZE заказов вместо покупки на каждого.
+# Кому не хватило средств, сообщаем один раз (renew_notified); продление повторяется при следующих запусках
+async def renew_expiring_orders(bot):
+    limiter = broadcast_limiter
+    now = datetime.now()
+    until = now + timedelta(days=RENEW_BEFORE_DAYS)
+    after_expiry, after_id = now, 0
+    results = {'renewed': 0, 'no_funds': 0}
+    keyboard = InlineKeyboardMarkup([[InlineKeyboardButton("👤 Профиль", callback_data="profile")]])
+    while True:
+        orders = await asyncio.to_thread(get_renewable_orders, after_expiry, after_id, until, RENEW_BATCH_SIZE)
+        if not orders:
+            break
+        after_expiry, after_id = orders[-1][2], orders[-1][0]
+        renewals = {
+            order_id: (order_id, user_id, expiry_date, datetime.fromisoformat(str(expiry_date)) + timedelta(days=duration * 30), price)
+            for order_id, user_id, expiry_date, renew_notified, plan_name, duration, price in orders
+        }
+        renewed, no_funds = await asyncio.to_thread(renew_orders, list(renewals.values()))
+        results['renewed'] += len(renewed)
+        results['no_funds'] += len(no_funds)
+        by_id = {order[0]: order for order in orders}
+        notices = [
+            (by_id[order_id][1], f"🔁 Подписка «{by_id[order_id][4]}» продлена до {str(renewals[order_id][3])[:16]}.\n"
+                                 f"💰 Списано с баланса: {by_id[order_id][6]} USDT")
+            for order_id in renewed
+        ]
+        unnotified = [order_id for order_id in no_funds if not by_id[order_id][3]]
+        notices += [
+            (by_id[order_id][1], f"⚠️ Не удалось продлить подписку «{by_id[order_id][4]}»: на балансе меньше "
+                                 f"{by_id[order_id][6]} USDT.\n\nПополните баланс до {str(by_id[order_id][2])[:16]}, "
+                                 f"и она продлится автоматически.")
+            for order_id in unnotified
+        ]
+        if unnotified:
+            await asyncio.to_thread(mark_orders_renew_notified, unnotified)
+        await send_notices(bot, limiter, notices, {}, keyboard)
+    return results
+
+# Периодическая проверка истекающих подписок: сначала автопродление, затем напоминания остальным
+async def expiry_reminder_loop(application: Application):
+    while True:
+        if RENEW_BEFORE_DAYS:
+            try:
+                renewal = await renew_expiring_orders(application.bot)
+                if any(renewal.values()):
+                    logger.info(f"Автопродление: продлено={renewal['renewed']}, не хватило средств={renewal['no_funds']}")
+                    await application.bot.send_message(
+                        ADMIN_ID, f"🔁 Автопродление: продлено {renewal['renewed']}, не хватило средств {renewal['no_funds']}"
+                    )
+            except Exception as e:
+                logger.error(f"Ошибка автопродления: {e}")
+        try:
+            results = await send_expiry_reminders(application.bot)
+            if any(results.values()):
+                logger.info(f"Напоминания об окончании подписки: отправлено={results['sent']}, "
+                            f"ошибок={results['failed']}, заблокировали={results['blocked']}")
+        except Exception as e:
+            logger.error(f"Ошибка напоминаний об окончании подписки: {e}")
+        await asyncio.sleep(REMINDER_INTERVAL)
 
 async def send_stars_invoice(context: ContextTypes.DEFAULT_TYPE, chat_id: int, title: str, description: str, payload: str, stars_amount: int):
     prices = [LabeledPrice(label="XTR", amount=stars_amount)]
@@ -1863,15 +4366,19 @@ async def successful_payment_handler(update: Update, context: ContextTypes.DEFAU
     except Exception:
         data = {"type": "unknown"}
     user_id = update.effective_user.id
+    # Повторная доставка того же платежа (ретрай Telegram, другой процесс) не зачисляется второй раз
+    invoice_id = f"stars:{sp.telegram_payment_charge_id}"
     if currency == "XTR":
         if data.get("type") == "stars_topup":
             credited_usdt = total_amount / STARS_PER_USDT
-            update_balance(user_id, credited_usdt)
+            if not await asyncio.to_thread(settle_external_payment, invoice_id, user_id, 'topup', None, credited_usdt, credit_balance=True):
+                logger.warning(f"Повторный платёж Stars пропущен: {invoice_id}")
+                return
             await update.message.reply_text(
                 f"🎉 Баланс пополнен на {credited_usdt:.2f} USDT за {total_amount}⭐"
             )
             # показать профиль
-            balance = get_balance(user_id)
+            balance = await asyncio.to_thread(get_balance, user_id)
             balance_str = escape_markdown(f"{balance:.2f}")
             profile_text = (
                 f"👤 *Ваш профиль*\n\n"
@@ -1879,15 +4386,19 @@ async def successful_payment_handler(update: Update, context: ContextTypes.DEFAU
                 f"💰 Баланс: *{balance_str} USDT*\n\n"
                 f"Выберите действие:"
             )
-            await update.message.reply_text(profile_text, reply_markup=get_profile_menu(), parse_mode=ParseMode.MARKDOWN_V2)
+            await update.message.reply_text(profile_text, reply_markup=await asyncio.to_thread(get_profile_menu, user_id), parse_mode=ParseMode.MARKDOWN_V2)
         elif data.get("type") == "stars_purchase":
             plan_id = int(data.get("plan_id"))
             country = data.get("country", "de")
-            plan = get_plan_by_id(plan_id)
+            plan = await asyncio.to_thread(get_plan_by_id, plan_id)
             if not plan:
                 await update.message.reply_text("❌ Тариф не найден.")
                 return
-            await deliver_config(update.message, context, plan_id, plan[1], user_id, country)
+            result, claimed = await asyncio.to_thread(settle_external_purchase, invoice_id, user_id, plan_id, plan[3], country, plan[2], reservation=data.get("reservation"))
+            if result == 'duplicate':
+                logger.warning(f"Повторный платёж Stars пропущен: {invoice_id}")
+                return
+            await send_config(update.message, context, plan[1], user_id, country, claimed)
         else:
             await update.message.reply_text("Платёж получен.")
     else:
@@ -1907,23 +4418,29 @@ async def handle_successful_payment(update: Update, context: ContextTypes.DEFAUL
 async def process_crystal_pay_payment(update: Update, context: ContextTypes.DEFAULT_TYPE, plan_id: int, country: str):
     try:
         query = update.callback_query
-        plan = get_plan_by_id(plan_id)
+        plan = await asyncio.to_thread(get_plan_by_id, plan_id)
         user_id = query.from_user.id
         amount = int(round(float(plan[3])))
         
+        result, invoice_id = await asyncio.to_thread(reserve_config_for_invoice, user_id, plan_id, country)
+        if result != 'ok':
+            await refuse_reservation(query, context, plan, country, result)
+            return
+        
         # Создаем запись о платеже в базе данных
-        invoice_id = create_payment(user_id, 'purchase', plan_id, amount)
+        await asyncio.to_thread(create_payment, user_id, 'purchase', plan_id, amount, invoice_id=invoice_id, country=country)
         description = ""
         
         # Создаем счет в CrystalPAY
-        crystal_invoice = create_crystal_pay_invoice(user_id, amount, description)
+        crystal_invoice = await asyncio.to_thread(create_crystal_pay_invoice, user_id, amount, description, lifetime=max(1, INVOICE_LIFETIME // 60))
         if not crystal_invoice or crystal_invoice.get("error"):
+            await asyncio.to_thread(release_reservation, invoice_id)
             await query.edit_message_text("❌ Ошибка создания счёта в CrystalPAY.")
             return
         
         # Обновляем запись с ID от CrystalPAY
         if crystal_invoice.get("crystal_id"):
-            update_crystal_pay_id(invoice_id, crystal_invoice["crystal_id"])
+            await asyncio.to_thread(update_crystal_pay_id, invoice_id, crystal_invoice["crystal_id"])
         
         payment_text = (
             f"💎 *Оплата через CrystalPAY*\n\n"
@@ -1950,7 +4467,7 @@ async def process_crystal_pay_payment(update: Update, context: ContextTypes.DEFA
 async def check_crystal_pay_payment_status(update: Update, context: ContextTypes.DEFAULT_TYPE, internal_invoice_id: str):
     try:
         query = update.callback_query
-        payment = get_payment(internal_invoice_id)
+        payment = await asyncio.to_thread(get_payment, internal_invoice_id)
         
         if not payment:
             await query.edit_message_text("❌ Платёж не найден.")
@@ -1960,41 +4477,45 @@ async def check_crystal_pay_payment_status(update: Update, context: ContextTypes
             await query.edit_message_text("✅ Платёж уже обработан!")
             return
         
-        # Получаем crystal_pay_id из базы данных
-        conn = sqlite3.connect('vpn_bot.db')
-        cursor = conn.cursor()
-        cursor.execute("SELECT crystal_pay_id FROM payments WHERE invoice_id = ?", (internal_invoice_id,))
-        result = cursor.fetchone()
-        conn.close()
-        
-        if not result or not result[0]:
+        crystal_id = payment[7]  # crystal_pay_id
+        if not crystal_id:
             await query.edit_message_text("❌ ID платежа CrystalPAY не найден.")
             return
         
-        crystal_id = result[0]
-        status = check_crystal_pay_payment(crystal_id)
+        status = await asyncio.to_thread(check_crystal_pay_payment, crystal_id)
         
         if status == "payed":
             # Платеж успешен
-            update_payment_status(internal_invoice_id, "paid")
             plan_id = payment[3]
-            country = 'de'
-            plan = get_plan_by_id(plan_id)
+            country = payment[11] or 'de'  # платежи до появления столбца country
+            plan = await asyncio.to_thread(get_plan_by_id, plan_id)
+            result, claimed = await asyncio.to_thread(settle_purchase, internal_invoice_id, payment[1], plan_id, country, plan[2], reservation=internal_invoice_id)
+            if result == 'duplicate':
+                await query.edit_message_text("✅ Платёж уже обработан!")
+                return
             
-            await deliver_config(query.message, context, plan_id, plan[1], payment[1], country)
+            await send_config(query.message, context, plan[1], payment[1], country, claimed)
             await query.edit_message_text("✅ Платёж успешно обработан! Конфигурация отправлена.")
             
         elif status == "notpayed":
             await query.edit_message_text("⏳ Платёж ещё не поступил. Попробуйте позже.")
             
+        elif status in CRYSTAL_PAY_EXPIRED_STATES:
+            await asyncio.to_thread(update_payment_status, internal_invoice_id, 'expired')
+            await asyncio.to_thread(release_reservation, internal_invoice_id)
+            await query.edit_message_text("⏰ Счёт истёк. Создайте новый.")
+            
         elif status == "overpayed":
             # Переплата - всё равно засчитываем
-            update_payment_status(internal_invoice_id, "paid")
             plan_id = payment[3]
-            country = 'de'
-            plan = get_plan_by_id(plan_id)
+            country = payment[11] or 'de'  # платежи до появления столбца country
+            plan = await asyncio.to_thread(get_plan_by_id, plan_id)
+            result, claimed = await asyncio.to_thread(settle_purchase, internal_invoice_id, payment[1], plan_id, country, plan[2], reservation=internal_invoice_id)
+            if result == 'duplicate':
+                await query.edit_message_text("✅ Платёж уже обработан!")
+                return
             
-            await deliver_config(query.message, context, plan_id, plan[1], payment[1], country)
+            await send_config(query.message, context, plan[1], payment[1], country, claimed)
             await query.edit_message_text("✅ Платёж обработан (переплата)! Конфигурация отправлена.")
             
         else:
@@ -2012,18 +4533,18 @@ async def process_crystal_topup(update: Update, context: ContextTypes.DEFAULT_TY
         
         # Создаем запись о пополнении в базе данных
         amount_int = int(round(float(amount)))
-        invoice_id = create_payment(user_id, 'topup', None, amount_int)
+        invoice_id = await asyncio.to_thread(create_payment, user_id, 'topup', None, amount_int)
         description = ""
         
         # Создаем счет в CrystalPAY
-        crystal_invoice = create_crystal_pay_invoice(user_id, amount_int, description)
+        crystal_invoice = await asyncio.to_thread(create_crystal_pay_invoice, user_id, amount_int, description)
         if not crystal_invoice or crystal_invoice.get("error"):
             await query.edit_message_text("❌ Ошибка создания счёта в CrystalPAY.")
             return
         
         # Обновляем запись с ID от CrystalPAY
         if crystal_invoice.get("crystal_id"):
-            update_crystal_pay_id(invoice_id, crystal_invoice["crystal_id"])
+            await asyncio.to_thread(update_crystal_pay_id, invoice_id, crystal_invoice["crystal_id"])
         
         payment_text = (
             f"💎 *Пополнение через CrystalPAY*\n\n"
@@ -2048,7 +4569,7 @@ async def process_crystal_topup(update: Update, context: ContextTypes.DEFAULT_TY
 async def check_crystal_topup_status(update: Update, context: ContextTypes.DEFAULT_TYPE, internal_invoice_id: str):
     try:
         query = update.callback_query
-        payment = get_payment(internal_invoice_id)
+        payment = await asyncio.to_thread(get_payment, internal_invoice_id)
         
         if not payment:
             await query.edit_message_text("❌ Платёж не найден.")
@@ -2058,33 +4579,25 @@ async def check_crystal_topup_status(update: Update, context: ContextTypes.DEFAU
             await query.edit_message_text("✅ Пополнение уже обработано!")
             return
         
-        # Получаем crystal_pay_id из базы данных
-        conn = sqlite3.connect('vpn_bot.db')
-        cursor = conn.cursor()
-        cursor.execute("SELECT crystal_pay_id FROM payments WHERE invoice_id = ?", (internal_invoice_id,))
-        result = cursor.fetchone()
-        conn.close()
-        
-        if not result or not result[0]:
+        crystal_id = payment[7]  # crystal_pay_id
+        if not crystal_id:
             await query.edit_message_text("❌ ID платежа CrystalPAY не найден.")
             return
         
-        crystal_id = result[0]
-        status = check_crystal_pay_payment(crystal_id)
+        status = await asyncio.to_thread(check_crystal_pay_payment, crystal_id)
         
         if status in ["payed", "overpayed"]:
-            # Пополнение успешно
-            update_payment_status(internal_invoice_id, "paid")
+            # Пополнение успешно: статус и баланс меняются одной транзакцией и только один раз
+            if not await asyncio.to_thread(settle_payment, internal_invoice_id, credit_balance=True):
+                await query.edit_message_text("✅ Пополнение уже обработано!")
+                return
             amount = payment[4]  # amount
             user_id = payment[1]  # user_id
             
-            # Пополняем баланс
-            update_balance(user_id, amount)
-            
             await query.edit_message_text(f"✅ Баланс успешно пополнен на {amount} USDT!")
             
             # Показываем обновленный профиль
-            balance = get_balance(user_id)
+            balance = await asyncio.to_thread(get_balance, user_id)
             balance_str = escape_markdown(f"{balance:.2f}")
             profile_text = (
                 f"👤 *Ваш профиль*\n\n"
@@ -2092,10 +4605,13 @@ async def check_crystal_topup_status(update: Update, context: ContextTypes.DEFAU
                 f"💰 Баланс: *{balance_str} USDT*\n\n"
                 f"Выберите действие:"
             )
-            await query.message.reply_text(profile_text, reply_markup=get_profile_menu(), parse_mode=ParseMode.MARKDOWN_V2)
+            await query.message.reply_text(profile_text, reply_markup=await asyncio.to_thread(get_profile_menu, user_id), parse_mode=ParseMode.MARKDOWN_V2)
             
         elif status == "notpayed":
             await query.edit_message_text("⏳ Платёж ещё не поступил. Попробуйте позже.")
+        elif status in CRYSTAL_PAY_EXPIRED_STATES:
+            await asyncio.to_thread(update_payment_status, internal_invoice_id, 'expired')
+            await query.edit_message_text("⏰ Счёт истёк. Создайте новый.")
         else:
             await query.edit_message_text("❌ Ошибка проверки платежа. Попробуйте позже.")
             
@@ -2104,17 +4620,906 @@ async def check_crystal_topup_status(update: Update, context: ContextTypes.DEFAU
 
         await query.edit_message_text("❌ Произошла ошибка при проверке пополнения.")
 
-if __name__ == "__main__":
-    init_db()
-    application = Application.builder().token(BOT_TOKEN).build()
-    
+RECONCILE_BATCH = 100  # счетов CryptoBot в одном getInvoices
+RECONCILE_CONCURRENCY = 8  # одновременных запросов к провайдерам при сверке
+
+# Статусы незавершённых платежей у провайдеров: [(платёж, 'paid' | 'expired' | 'pending' | 'error', страна)].
+# CryptoBot опрашивается пачками, CrystalPAY (только поштучно) — параллельно с ограничением
+async def fetch_provider_statuses(payments):
+    semaphore = asyncio.Semaphore(RECONCILE_CONCURRENCY)
+    cryptobot = [payment for payment in payments if payment[5]]
+    crystal = [payment for payment in payments if not payment[5] and payment[6]]
+
+    async def cryptobot_batch(batch):
+        async with semaphore:
+            invoices = await asyncio.to_thread(get_cryptobot_invoices, [payment[5] for payment in batch])
+        results = []
+        for payment in batch:
+            invoice = (invoices or {}).get(str(payment[5]))
+            if not invoice:
+                results.append((payment, 'error', None))
+                continue
+            payload = json.loads(invoice.get("payload") or "{}")
+            if payload.get("invoice_id") != payment[0]:
+                results.append((payment, 'error', None))
+                continue
+            status = invoice["status"] if invoice["status"] in ('paid', 'expired') else 'pending'
+            results.append((payment, status, payload.get("country")))
+        return results
+
+    async def crystal_one(payment):
+        async with semaphore:
+            state = await asyncio.to_thread(check_crystal_pay_payment, payment[6])
+        if state in ("payed", "overpayed"):
+            return [(payment, 'paid', None)]
+        if state in CRYSTAL_PAY_EXPIRED_STATES:
+            return [(payment, 'expired', None)]
+        return [(payment, 'error' if state == 'error' else 'pending', None)]
+
+    tasks = [cryptobot_batch(cryptobot[i:i + RECONCILE_BATCH]) for i in range(0, len(cryptobot), RECONCILE_BATCH)]
+    tasks += [crystal_one(payment) for payment in crystal]
+    return [item for batch in await asyncio.gather(*tasks) for item in batch]
+
+# Провести платёж, найденный при сверке, и сообщить пользователю (без исходного сообщения с кнопкой)
+async def settle_reconciled_payment(application, payment, country):
+    invoice_id, user_id, payment_type, plan_id, amount, _, _, plan_name, payment_country = payment
+    # Страна сохраняется в платеже; из payload CryptoBot — для платежей до появления столбца
+    country = payment_country or country or 'de'
+    if payment_type == "topup":
+        if not await asyncio.to_thread(settle_payment, invoice_id, credit_balance=True):
+            return False  # уже провёл обработчик «Проверить» или другой процесс
+        balance = await asyncio.to_thread(get_balance, user_id)
+        text = f"🎉 Баланс пополнен на {amount} USDT.\n💳 Баланс: {balance:.2f} USDT"
+    else:
+        plan = await asyncio.to_thread(get_plan_by_id, plan_id)
+        result, claimed = await asyncio.to_thread(settle_purchase, invoice_id, user_id, plan_id, country, plan[2], reservation=invoice_id)
+        if result == 'duplicate':
+            return False
+        if not claimed:
+            text = "✅ Оплата получена, но конфиги закончились. Мы уже знаем и скоро выдадим конфиг."
+            await application.bot.send_message(ADMIN_ID, f"⚠️ Закончились конфиги при сверке оплаты {invoice_id}: {plan_name}, user_id={user_id}")
+        else:
+            text = f"🎉 Оплата подтверждена!\n\n📦 {plan_name}\n\n🔑 Конфиг:\n{claimed[1]}"
+    try:
+        await application.bot.send_message(user_id, text, reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Меню", callback_data="menu")]]))
+    except (Forbidden, BadRequest) as e:
+        logger.warning(f"Не удалось уведомить user_id={user_id} о платеже {invoice_id}: {e}")
+    return True
+
+# Сообщить пользователю, что счёт истёк без оплаты (при сверке исходного сообщения с кнопкой нет)
+async def notify_expired_payment(application, payment):
+    invoice_id, user_id, payment_type, _, amount, _, _, plan_name, _ = payment
+    if payment_type == "topup":
+        text = f"⏰ Счёт на пополнение {amount} USDT истёк, оплата не поступила. Создайте новый."
+    else:
+        text = f"⏰ Счёт на {plan_name} истёк, оплата не поступила. Создайте новый."
+    try:
+        await application.bot.send_message(user_id, text, reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Меню", callback_data="menu")]]))
+    except (Forbidden, BadRequest) as e:
+        logger.warning(f"Не удалось уведомить user_id={user_id} об истёкшем счёте {invoice_id}: {e}")
+
+# Сверка при старте: платежи, ожидавшие оплаты во время рестарта, проводятся или закрываются
+# без нажатия «Проверить» — за пределами окна RECONCILE_WINDOW счета у провайдеров уже не живут
+async def reconcile_pending_payments(application):
+    payments = await asyncio.to_thread(get_pending_payments, RECONCILE_WINDOW)
+    if not payments:
+        return
+    logger.info(f"Сверка платежей: незавершённых {len(payments)}")
+    counts = {'paid': 0, 'expired': 0, 'pending': 0, 'error': 0}
+    for payment, status, country in await fetch_provider_statuses(payments):
+        try:
+            if status == 'paid':
+                if not await settle_reconciled_payment(application, payment, country):
+                    continue
+            elif status == 'expired':
+                if not await asyncio.to_thread(update_payment_status, payment[0], 'expired'):
+                    continue  # уже закрыл другой процесс или платёж успели провести
+                await asyncio.to_thread(release_reservation, payment[0])
+                await notify_expired_payment(application, payment)
+            counts[status] += 1
+        except Exception as e:
+            counts['error'] += 1
+            logger.error(f"Ошибка сверки платежа {payment[0]}: {e}")
+    logger.info(f"Сверка платежей завершена: проведено {counts['paid']}, истекло {counts['expired']}, "
+                f"ожидают {counts['pending']}, ошибок {counts['error']}")
+    if counts['paid'] or counts['error']:
+        await application.bot.send_message(
+            ADMIN_ID,
+            f"🔄 Сверка платежей после запуска: проведено {counts['paid']}, истекло {counts['expired']}, "
+            f"ожидают {counts['pending']}, ошибок {counts['error']}"
+        )
+
+class DatabasePersistence(BasePersistence):
+    """Хранение user_data/chat_data в хранилище бота (таблицы user_state/chat_state).
+
+    Данные подгружаются лениво при первом апдейте пользователя (refresh_*), изменения
+    копятся в памяти и пишутся одной транзакцией раз в update_interval. Неактивные
+    пользователи выгружаются из памяти через evict_idle().
+    """
+
+    def __init__(self, update_interval=30, idle_timeout=1800):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, callback_data=False),
+            update_interval=update_interval
+        )
+        # Выгружать можно только то, что уже записано: PTB помечает данные «грязными» до следующего сброса
+        self.idle_timeout = max(idle_timeout, update_interval * 2)
+        self.pending = {'user': {}, 'chat': {}}  # id -> JSON, ожидающие записи
+        self.last_seen = {'user': {}, 'chat': {}}  # id -> время последнего апдейта (только загруженные в память)
+        self.evicted = {'user': set(), 'chat': set()}  # выгружены из памяти, PTB ещё не передал их drop_*_data
+        self.application = None
+        self.write_task = None
+
+    async def _load(self, kind, key):
+        if key in self.pending[kind]:
+            return json.loads(self.pending[kind][key])
+        data = await asyncio.to_thread(storage.load_state, kind, key)
+        return json.loads(data) if data else {}
+
+    async def _write_pending(self):
+        users, chats = self.pending['user'], self.pending['chat']
+        self.pending = {'user': {}, 'chat': {}}
+        if users or chats:
+            await asyncio.to_thread(storage.save_states, users, chats)
+            logger.info(f"Состояние сохранено: пользователей={len(users)}, чатов={len(chats)}")
+
+    def _schedule_write(self):
+        # PTB вызывает update_*_data пачкой на каждом сбросе — собираем их в одну запись
+        if self.write_task is None or self.write_task.done():
+            self.write_task = asyncio.create_task(self._write_pending())
+
+    async def _refresh(self, kind, key, data):
+        if key not in self.last_seen[kind]:
+            data.update(await self._load(kind, key))
+        self.last_seen[kind][key] = time.monotonic()
+
+    async def get_user_data(self):
+        return {}
+
+    async def get_chat_data(self):
+        return {}
+
+    async def get_bot_data(self):
+        return {}
+
+    async def get_callback_data(self):
+        return None
+
+    async def get_conversations(self, name):
+        return {}
+
+    async def update_conversation(self, name, key, new_state):
+        pass
+
+    async def update_user_data(self, user_id, data):
+        self.pending['user'][user_id] = json.dumps(data, ensure_ascii=False)
+        self._schedule_write()
+
+    async def update_chat_data(self, chat_id, data):
+        self.pending['chat'][chat_id] = json.dumps(data, ensure_ascii=False)
+        self._schedule_write()
+
+    async def update_bot_data(self, data):
+        pass
+
+    async def update_callback_data(self, data):
+        pass
+
+    # Выгрузка через application.drop_*_data доходит сюда как удаление: запись в базе оставляем
+    def _was_evicted(self, kind, key):
+        if key not in self.evicted[kind]:
+            return False
+        self.evicted[kind].discard(key)
+        if key in self.last_seen[kind]:
+            # Пользователь вернулся до сброса: PTB отбросил его изменения вместе с «удалением»
+            self.application.mark_data_for_update_persistence(**{f'{kind}_ids': key})
+        return True
+
+    async def drop_user_data(self, user_id):
+        if self._was_evicted('user', user_id):
+            return
+        self.pending['user'].pop(user_id, None)
+        self.last_seen['user'].pop(user_id, None)
+        await asyncio.to_thread(storage.delete_state, 'user', user_id)
+
+    async def drop_chat_data(self, chat_id):
+        if self._was_evicted('chat', chat_id):
+            return
+        self.pending['chat'].pop(chat_id, None)
+        self.last_seen['chat'].pop(chat_id, None)
+        await asyncio.to_thread(storage.delete_state, 'chat', chat_id)
+
+    async def refresh_user_data(self, user_id, user_data):
+        await self._refresh('user', user_id, user_data)
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        await self._refresh('chat', chat_id, chat_data)
+
+    async def refresh_bot_data(self, bot_data):
+        pass
+
+    async def flush(self):
+        if self.write_task is not None:
+            await self.write_task
+        await self._write_pending()
+
+    def evict_idle(self, application):
+        """Выгружает из памяти данные пользователей/чатов без апдейтов дольше idle_timeout."""
+        self.application = application
+        deadline = time.monotonic() - self.idle_timeout
+        drop = {'user': application.drop_user_data, 'chat': application.drop_chat_data}
+        evicted = 0
+        for kind, drop_data in drop.items():
+            for key, seen in list(self.last_seen[kind].items()):
+                if seen < deadline and key not in self.pending[kind]:
+                    drop_data(key)
+                    self.evicted[kind].add(key)
+                    del self.last_seen[kind][key]
+                    evicted += 1
+        if evicted:
+            logger.info(f"Выгружено из памяти неактивных состояний: {evicted}")
+
+# Периодическая выгрузка неактивных пользователей из памяти
+async def evict_idle_state_loop(application: Application):
+    while True:
+        await asyncio.sleep(application.persistence.idle_timeout / 2)
+        application.persistence.evict_idle(application)
+
+# Профилирование по запросу админа (/profile или кнопка в админке)
+PROFILE_LAG_INTERVAL = 0.05  # шаг замера задержки event loop, сек
+PROFILE_SAMPLE_INTERVAL = 0.005  # шаг семплирования стека в режиме sample, сек
+PROFILE_MAX_UPDATES = 10000
+PROFILE_MAX_SECONDS = 3600
+PROFILE_TOP_FUNCTIONS = 30
+
+profiling_session = None
+
+class ProfilingSession:
+    """Профиль следующих N апдейтов или N секунд: cProfile или семплирование стека по маршрутам
+    плюс задержка event loop. Пока сессии нет, process_update ничего лишнего не делает.
+    Апдейты обрабатываются последовательно, но фоновые задачи (рассылки) попадают в профиль текущего апдейта."""
+
+    def __init__(self, mode, chat_id, max_updates=None, seconds=None):
+        self.mode = mode
+        self.chat_id = chat_id
+        self.max_updates = max_updates
+        self.seconds = seconds
+        self.started = time.monotonic()
+        self.update_count = 0
+        self.routes = {}  # маршрут -> [апдейтов, суммарное время]
+        self.stats = {}  # маршрут -> pstats.Stats (режим cprofile)
+        self.samples = {}  # маршрут -> {стек: число попаданий} (режим sample)
+        self.lags = []
+        self.current_route = None
+        self.profiling = False
+        self.finished = False
+        self.tasks = []
+        self.loop_thread_id = threading.get_ident()
+
+    def describe(self):
+        limit = f"{self.max_updates} апдейтов" if self.max_updates else f"{self.seconds:g} сек"
+        return f"{self.mode}, {limit}, прошло {time.monotonic() - self.started:.0f} сек, апдейтов {self.update_count}"
+
+    def is_done(self):
+        return self.max_updates is not None and self.update_count >= self.max_updates
+
+    async def profile_update(self, trace, coro):
+        profile = None
+        # Второй профайлер в том же потоке включить нельзя, параллельные апдейты считаем без профиля
+        if self.mode == 'cprofile' and not self.profiling:
+            profile = cProfile.Profile()
+            self.profiling = True
+            profile.enable()
+        self.current_route = trace.route
+        start = time.perf_counter()
+        try:
+            await coro
+        finally:
+            if profile is not None:
+                profile.disable()
+                self.profiling = False
+            self.current_route = None
+            self.update_count += 1
+            # Маршрут берём после обработки: button_callback уточняет его по callback_data
+            route_stats = self.routes.setdefault(trace.route, [0, 0.0])
+            route_stats[0] += 1
+            route_stats[1] += time.perf_counter() - start
+            if profile is not None:
+                if trace.route in self.stats:
+                    self.stats[trace.route].add(profile)
+                else:
+                    self.stats[trace.route] = pstats.Stats(profile)
+
+    # Задержка event loop: насколько позже запланированного просыпается sleep
+    async def monitor_lag(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(PROFILE_LAG_INTERVAL)
+            self.lags.append(max(0.0, loop.time() - start - PROFILE_LAG_INTERVAL))
+
+    # Семплер в отдельном потоке: снимает стек потока event loop, пока обрабатывается апдейт
+    def sample_loop(self):
+        while not self.finished:
+            route = self.current_route
+            frame = sys._current_frames().get(self.loop_thread_id)
+            if route is not None and frame is not None:
+                stack = []
+                while frame is not None and len(stack) < 50:
+                    stack.append(f"{frame.f_code.co_name} ({os.path.basename(frame.f_code.co_filename)}:{frame.f_lineno})")
+                    frame = frame.f_back
+                stacks = self.samples.setdefault(route, {})
+                key = ';'.join(reversed(stack))
+                stacks[key] = stacks.get(key, 0) + 1
+            time.sleep(PROFILE_SAMPLE_INTERVAL)
+
+    def report(self):
+        out = io.StringIO()
+        elapsed = time.monotonic() - self.started
+        out.write(f"Профилирование: режим {self.mode}, {elapsed:.1f} сек, апдейтов {self.update_count}\n\n")
+        out.write("Маршруты (по суммарному времени):\n")
+        for route, (count, total) in sorted(self.routes.items(), key=lambda item: item[1][1], reverse=True):
+            out.write(f"  {route}: {count} шт., всего {total * 1000:.0f} мс, в среднем {total / count * 1000:.1f} мс\n")
+        if self.lags:
+            lags = sorted(self.lags)
+            def percentile(q):
+                return lags[min(len(lags) - 1, int(q * len(lags)))] * 1000
+            stalls = [lag for lag in lags if lag >= 0.1]
+            out.write(
+                f"\nЗадержка event loop (замеров {len(lags)}, шаг {PROFILE_LAG_INTERVAL * 1000:.0f} мс): "
+                f"p50 {percentile(0.5):.1f} мс, p95 {percentile(0.95):.1f} мс, p99 {percentile(0.99):.1f} мс, "
+                f"max {lags[-1] * 1000:.1f} мс\n"
+                f"Блокировок дольше 100 мс: {len(stalls)}, суммарно {sum(stalls) * 1000:.0f} мс\n"
+            )
+        for route, stats in sorted(self.stats.items()):
+            out.write(f"\n===== {route} =====\n")
+            stats.stream = out
+            stats.sort_stats('cumulative').print_stats(PROFILE_TOP_FUNCTIONS)
+        for route, stacks in sorted(self.samples.items()):
+            total = sum(stacks.values())
+            out.write(f"\n===== {route} (семплов {total}, шаг {PROFILE_SAMPLE_INTERVAL * 1000:.0f} мс) =====\n")
+            own = {}
+            for stack, count in stacks.items():
+                leaf = stack.rsplit(';', 1)[-1]
+                own[leaf] = own.get(leaf, 0) + count
+            out.write("Верх стека:\n")
+            for leaf, count in sorted(own.items(), key=lambda item: item[1], reverse=True)[:PROFILE_TOP_FUNCTIONS]:
+                out.write(f"  {count / total * 100:5.1f}%  {leaf}\n")
+            out.write("Стеки (формат collapsed для flamegraph):\n")
+            for stack, count in sorted(stacks.items(), key=lambda item: item[1], reverse=True)[:PROFILE_TOP_FUNCTIONS]:
+                out.write(f"{stack} {count}\n")
+        return out.getvalue()
+
+def start_profiling(application, chat_id, mode='cprofile', max_updates=None, seconds=None):
+    global profiling_session
+    if profiling_session is not None:
+        return None
+    session = ProfilingSession(mode, chat_id, max_updates, seconds)
+    session.tasks.append(application.create_task(session.monitor_lag()))
+    if seconds:
+        session.tasks.append(application.create_task(stop_profiling_after(application, session, seconds)))
+    if mode == 'sample':
+        threading.Thread(target=session.sample_loop, name="profile-sampler", daemon=True).start()
+    profiling_session = session
+    logger.info(f"Профилирование запущено: {session.describe()}")
+    return session
+
+async def stop_profiling_after(application, session, seconds):
+    await asyncio.sleep(seconds)
+    await finish_profiling(application, session)
+
+# Остановка сессии и отправка отчёта документом тому, кто её запустил
+async def finish_profiling(application, session=None):
+    global profiling_session
+    if profiling_session is None or (session is not None and profiling_session is not session):
+        return False
+    session = profiling_session
+    profiling_session = None
+    session.finished = True
+    for task in session.tasks:
+        if task is not asyncio.current_task():
+            task.cancel()
+    logger.info(f"Профилирование завершено: {session.describe()}")
+    report = await asyncio.to_thread(session.report)
+    try:
+        await application.bot.send_document(
+            chat_id=session.chat_id,
+            document=report.encode('utf-8'),
+            filename=f"profile_{datetime.now().strftime('%Y%m%d_%H%M%S')}.txt",
+            caption=f"🔬 Отчёт профилирования: {session.describe()}"
+        )
+    except Exception as e:
+        logger.error(f"Не удалось отправить отчёт профилирования: {e}")
+    return True
+
+# Сторож event loop: sqlite3 и requests синхронные и могут надолго занять цикл
+LOOP_WATCHDOG_INTERVAL = 0.1  # шаг пульса, сек
+
+class LoopWatchdog:
+    """Пульс в event loop плюс поток-сторож. Если пульс опаздывает больше LOOP_STALL_MS,
+    сторож снимает стек потока цикла и запоминает, чей код его держит; по окончании
+    блокировки пульс пишет её длительность в лог и метрики."""
+
+    def __init__(self, threshold):
+        self.threshold = threshold
+        self.last_beat = time.monotonic()
+        self.trace = None  # апдейт, который сейчас обрабатывается (выставляет TracedApplication)
+        self.stall = None  # (маршрут, место, стек) текущей блокировки
+        self.lock = threading.Lock()
+        self.loop_thread_id = None
+
+    def start(self, application):
+        self.loop_thread_id = threading.get_ident()
+        self.last_beat = time.monotonic()
+        application.create_task(self.heartbeat())
+        threading.Thread(target=self.watch, name="loop-watchdog", daemon=True).start()
+        logger.info(f"Сторож event loop запущен, порог {self.threshold * 1000:.0f} мс")
+
+    async def heartbeat(self):
+        while True:
+            await asyncio.sleep(LOOP_WATCHDOG_INTERVAL)
+            now = time.monotonic()
+            lag = max(0.0, now - self.last_beat - LOOP_WATCHDOG_INTERVAL)
+            self.last_beat = now
+            LOOP_LAG_SECONDS.observe(lag)
+            if lag < self.threshold:
+                continue
+            with self.lock:
+                stall, self.stall = self.stall, None
+            # Сторож мог не успеть снять стек, если блокировка лишь немного превысила порог
+            route, site, stack = stall or ('unknown', 'unknown', '')
+            LOOP_STALLS.inc(route, site)
+            LOOP_STALL_SECONDS.inc(route, site, amount=lag)
+            logger.warning(f"Event loop был заблокирован {lag * 1000:.0f} мс: {route} в {site}\n{stack}")
+
+    def watch(self):
+        while True:
+            time.sleep(LOOP_WATCHDOG_INTERVAL)
+            blocked = time.monotonic() - self.last_beat - LOOP_WATCHDOG_INTERVAL
+            if blocked < self.threshold or self.stall is not None:
+                continue
+            frame = sys._current_frames().get(self.loop_thread_id)
+            if frame is None:
+                continue
+            trace = self.trace
+            route = trace.route if trace else 'background'
+            stack = ''.join(traceback.format_stack(frame, limit=25))
+            with self.lock:
+                self.stall = (route, blocking_site(frame), stack)
+
+# Ближайший к вершине стека кадр из кода бота: хелпер или обработчик, который блокирует цикл
+def blocking_site(frame):
+    while frame is not None:
+        if frame.f_code.co_filename == __file__:
+            return f"{frame.f_code.co_name}:{frame.f_lineno}"
+        frame = frame.f_back
+    return 'unknown'
+
+loop_watchdog = LoopWatchdog(LOOP_STALL_MS / 1000)
+
+class UpdateRecorder:
+    """Пишет входящие апдейты в NDJSON: {"ts": время получения, "u": апдейт} на строку.
+
+    Перед записью апдейт обезличивается: id пользователей и чатов заменяются HMAC от id (с тем же
+    ключом replay.py пересчитывает id в копии базы), имена и username удаляются, конфиги, токены,
+    file_id и идентификаторы платежей вырезаются. Запись на диск — в отдельном потоке.
+    """
+
+    USER_KEYS = {'from', 'user', 'chat', 'sender_chat', 'forward_from', 'forward_from_chat', 'via_bot',
+                 'new_chat_member', 'old_chat_member'}
+    PERSONAL_KEYS = ('username', 'first_name', 'last_name', 'title', 'bio', 'phone_number', 'invite_link')
+    CONFIG_RE = re.compile(r'\b(?:vless|vmess|trojan|ss|ssr|hysteria2?|tuic|wireguard)://\S+', re.IGNORECASE)
+    OPAQUE_KEYS = {'file_id', 'file_unique_id', 'telegram_payment_charge_id', 'provider_payment_charge_id',
+                   'chat_instance', 'inline_message_id'}
+    # Callback-данные админки с id пользователя: admin_user_<id>, au_<o|p>_<id>[_n<id>|_p<id>]
+    USER_CALLBACK_RE = re.compile(r'^(admin_user_|au_[op]_)(\d+)(.*)$')
+
+    def __init__(self, path, salt=""):
+        self.path = path
+        self.salt = salt.encode() if salt else secrets.token_bytes(16)
+        self.queue = queue.Queue(-1)
+        self.thread = threading.Thread(target=self.writer, name="update-recorder", daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+
+    def anonymize_id(self, value):
+        return anonymize_id(value, self.salt)
+
+    def anonymize(self, value, key=None):
+        if isinstance(value, dict):
+            # Флаги со значением false (group_chat_created и т.п.) — значения по умолчанию, не пишем
+            result = {k: self.anonymize(v, k) for k, v in value.items() if v is not False or k == 'is_bot'}
+            if key in self.USER_KEYS:
+                for personal in self.PERSONAL_KEYS:
+                    result.pop(personal, None)
+                if 'id' in result:
+                    result['id'] = self.anonymize_id(result['id'])
+                if 'is_bot' in result:
+                    result['first_name'] = "user"  # обязательное поле User
+            return result
+        if isinstance(value, list):
+            return [self.anonymize(item, key) for item in value]
+        if isinstance(value, str):
+            if key in self.OPAQUE_KEYS:
+                return hashlib.sha256(self.salt + value.encode()).hexdigest()[:16]
+            if key == 'data':
+                match = self.USER_CALLBACK_RE.match(value)
+                if match:
+                    return f"{match.group(1)}{self.anonymize_id(int(match.group(2)))}{match.group(3)}"
+            if key in ('text', 'caption'):
+                value = self.CONFIG_RE.sub('<config>', value)
+                value = SecretRedactingFilter.TOKEN_RE.sub('<BOT_TOKEN>', value)
+        if isinstance(value, int) and key in ('chat_id', 'user_id'):
+            return self.anonymize_id(value)
+        return value
+
+    def record(self, update):
+        self.queue.put_nowait((time.time(), update.to_dict()))
+
+    def writer(self):
+        opener = gzip.open if self.path.endswith('.gz') else open
+        with opener(self.path, 'at', encoding='utf-8') as output:
+            while True:
+                item = self.queue.get()
+                if item is None:
+                    break
+                ts, data = item
+                try:
+                    line = json.dumps({'ts': round(ts, 3), 'u': self.anonymize(data)}, ensure_ascii=False, separators=(',', ':'))
+                    output.write(line + "\n")
+                except Exception as e:
+                    logger.error(f"Ошибка записи апдейта: {e}")
+                if self.queue.empty():
+                    output.flush()
+
+    def close(self):
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join(timeout=5)
+
+# Обезличенный id: HMAC-SHA256 от id, 48 бит (влезает в int64 и в JSON без потерь); знак сохраняется (группы < 0)
+def anonymize_id(value, salt):
+    digest = hmac.new(salt, str(abs(value)).encode(), hashlib.sha256).digest()
+    anonymized = int.from_bytes(digest[:6], 'big') or 1
+    return -anonymized if value < 0 else anonymized
+
+update_recorder = UpdateRecorder(UPDATE_RECORD_FILE, UPDATE_RECORD_SALT) if UPDATE_RECORD_FILE else None
+
+class TracedApplication(Application):
+    """Application, оборачивающий обработку каждого апдейта в трассу и пишущий её итог в лог."""
+
+    async def process_update(self, update):
+        if update_recorder is not None:
+            update_recorder.record(update)
+        trace = UpdateTrace(update)
+        token = current_trace.set(trace)
+        session = profiling_session
+        loop_watchdog.trace = trace
+        try:
+            if session is None:
+                await super().process_update(update)
+            else:
+                await session.profile_update(trace, super().process_update(update))
+        finally:
+            if session is not None and session.is_done():
+                self.create_task(finish_profiling(self, session))
+            duration = time.perf_counter() - trace.started
+            duration_ms = round(duration * 1000, 2)
+            UPDATE_SECONDS.observe(duration, trace.route)
+            level = logging.WARNING if duration_ms >= SLOW_UPDATE_MS else logging.INFO
+            logger.log(level, f"Апдейт обработан: {trace.route} за {duration_ms} мс",
+                       extra={'duration_ms': duration_ms, 'spans': trace.summary()})
+            loop_watchdog.trace = None
+            current_trace.reset(token)
+
+class TracedRequest(HTTPXRequest):
+    """HTTPXRequest, замеряющий исходящие вызовы Bot API (спан 'telegram' с именем метода)."""
+
+    async def do_request(self, url, method, request_data=None, *args, **kwargs):
+        start = time.perf_counter()
+        ok = False
+        try:
+            code, payload = await super().do_request(url, method, request_data, *args, **kwargs)
+            ok = code < 400
+            return code, payload
+        finally:
+            record_span('telegram', url.rsplit('/', 1)[-1], time.perf_counter() - start, ok)
+
+# Текст для /metrics: накопленные гистограммы и счётчики плюс текущие ожидающие платежи и остаток конфигов
+def render_metrics():
+    lines = []
+    for metric in (UPDATE_SECONDS, DB_QUERY_SECONDS, DB_QUERY_ERRORS, EXTERNAL_CALL_SECONDS, EXTERNAL_CALL_ERRORS,
+                   LOOP_LAG_SECONDS, LOOP_STALLS, LOOP_STALL_SECONDS):
+        lines.extend(metric.render())
+    lines.append("# HELP vpn_bot_pending_payments Платежи в статусе pending/active по типу")
+    lines.append("# TYPE vpn_bot_pending_payments gauge")
+    for payment_type, count in get_pending_payments_stats():
+        lines.append(f"vpn_bot_pending_payments{{{format_labels(('type',), (payment_type,))}}} {count}")
+    lines.append("# HELP vpn_bot_configs_available Свободные конфиги по тарифу и стране")
+    lines.append("# TYPE vpn_bot_configs_available gauge")
+    for plan_name, country, count in get_configs_stats():
+        lines.append(f"vpn_bot_configs_available{{{format_labels(('plan', 'country'), (plan_name, country))}}} {count}")
+    return '\n'.join(lines) + '\n'
+
+# Минимальный разбор HTTP-запроса для внутренних эндпоинтов: (метод, путь, заголовки, тело)
+async def read_http_request(reader, timeout=5):
+    request_line = await asyncio.wait_for(reader.readline(), timeout=timeout)
+    headers = {}
+    while True:
+        line = await asyncio.wait_for(reader.readline(), timeout=timeout)
+        if line in (b'\r\n', b'\n', b''):
+            break
+        name, _, value = line.decode('latin-1').partition(':')
+        headers[name.strip().lower()] = value.strip()
+    parts = request_line.decode('latin-1').split()
+    method, path = (parts[0], parts[1].split('?')[0]) if len(parts) >= 2 else ('', '')
+    body = b''
+    length = int(headers.get('content-length') or 0)
+    if length:
+        body = await asyncio.wait_for(reader.readexactly(length), timeout=timeout)
+    return method, path, headers, body
+
+async def handle_metrics_request(reader, writer):
+    try:
+        method, path, _, _ = await read_http_request(reader)
+        if method == 'GET' and path == '/metrics':
+            body = (await asyncio.to_thread(render_metrics)).encode()
+            status, content_type = "200 OK", "text/plain; version=0.0.4; charset=utf-8"
+        else:
+            body = b"not found\n"
+            status, content_type = "404 Not Found", "text/plain; charset=utf-8"
+        writer.write(
+            f"HTTP/1.1 {status}\r\nContent-Type: {content_type}\r\n"
+            f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body
+        )
+        await writer.drain()
+    except Exception as e:
+        logger.warning(f"Ошибка обработки запроса /metrics: {e}")
+    finally:
+        writer.close()
+
+async def serve_metrics():
+    # У каждого воркера свой порт метрик, следующий за METRICS_PORT
+    port = METRICS_PORT + (WORKER_INDEX if BOT_ROLE == 'worker' else 0)
+    try:
+        server = await asyncio.start_server(handle_metrics_request, METRICS_HOST, port)
+    except OSError as e:
+        logger.error(f"Не удалось запустить эндпоинт метрик на {METRICS_HOST}:{port}: {e}")
+        return
+    logger.info(f"Метрики доступны на http://{METRICS_HOST}:{port}/metrics")
+    async with server:
+        await server.serve_forever()
+
+# Фоновые задачи при старте бота
+async def post_init(application: Application):
+    if isinstance(application.persistence, DatabasePersistence):
+        application.create_task(evict_idle_state_loop(application))
+    if METRICS_PORT:
+        application.create_task(serve_metrics())
+    if LOOP_STALL_MS:
+        loop_watchdog.start(application)
+    # Сверка платежей, напоминания и рассылки — общие для всех процессов, в многопроцессном режиме их ведёт воркер 0
+    if BOT_ROLE == 'worker' and WORKER_INDEX != 0:
+        return
+    if RECONCILE_WINDOW:
+        application.create_task(reconcile_pending_payments(application))
+    if REMINDER_INTERVAL and (REMINDER_DAYS or RENEW_BEFORE_DAYS):
+        application.create_task(expiry_reminder_loop(application))
+    # Продолжаем рассылки, прерванные рестартом, с сохранённого курсора
+    for broadcast_id in await asyncio.to_thread(get_running_broadcasts):
+        logger.info(f"Возобновление рассылки {broadcast_id}")
+        start_broadcast_task(application, broadcast_id)
+
+# Шард апдейта: все апдейты одного пользователя (и его user_data) обрабатывает один воркер
+def shard_for(update, count):
+    if update.effective_user:
+        key = update.effective_user.id
+    elif update.effective_chat:
+        key = update.effective_chat.id
+    else:
+        key = update.update_id
+    return key % count
+
+def worker_secret():
+    return WORKER_SECRET or hashlib.sha256(f"worker:{BOT_TOKEN}".encode()).hexdigest()
+
+PROCESSED_UPDATES_TTL = 86400  # секунд: столько Telegram хранит неподтверждённые апдейты
+
+class ProcessedUpdates:
+    """Обработка апдейтов от роутера ровно один раз на воркер. Роутер доставляет «хотя бы раз»:
+    повтор, пришедший во время обработки оригинала, ждёт его завершения, а повтор после
+    рестарта воркера отбрасывается по update_id, записанному в хранилище после обработки."""
+
+    def __init__(self, application):
+        self.application = application
+        self.in_flight = {}  # update_id -> задача обработки
+
+    async def process(self, update):
+        task = self.in_flight.get(update.update_id)
+        if task is not None:
+            await asyncio.shield(task)
+            return False
+        task = asyncio.ensure_future(self._process(update))
+        self.in_flight[update.update_id] = task
+        task.add_done_callback(lambda _: self.in_flight.pop(update.update_id, None))
+        return await asyncio.shield(task)
+
+    async def _process(self, update):
+        if await asyncio.to_thread(storage.is_update_processed, update.update_id):
+            return False
+        await self.application.process_update(update)
+        await asyncio.to_thread(storage.mark_update_processed, update.update_id)
+        return True
+
+# Приём апдейтов от роутера: POST /update с JSON апдейта, ответ 200 только после обработки.
+# Ошибка до ответа (упал воркер, не записалась отметка) — роутер повторит апдейт.
+async def handle_worker_request(application, processed, reader, writer):
+    try:
+        method, path, headers, body = await read_http_request(reader)
+        if method != 'POST' or path != '/update':
+            status = "404 Not Found"
+        elif not hmac.compare_digest(headers.get('x-worker-secret', ''), worker_secret()):
+            status = "403 Forbidden"
+        else:
+            try:
+                update = Update.de_json(json.loads(body), application.bot)
+            except (ValueError, KeyError, TypeError) as e:
+                logger.error(f"Некорректный апдейт от роутера: {e}")
+                update = None
+            if update is None:
+                status = "400 Bad Request"
+            elif await processed.process(update):
+                status = "200 OK"
+            else:
+                logger.info(f"Повторный апдейт {update.update_id} пропущен")
+                status = "200 OK"
+        writer.write(f"HTTP/1.1 {status}\r\nContent-Length: 0\r\nConnection: close\r\n\r\n".encode())
+        await writer.drain()
+    except Exception as e:
+        logger.warning(f"Ошибка приёма апдейта от роутера: {e}")
+    finally:
+        writer.close()
+
+async def prune_processed_updates_loop():
+    while True:
+        before = datetime.now() - timedelta(seconds=PROCESSED_UPDATES_TTL)
+        try:
+            await asyncio.to_thread(storage.prune_processed_updates, before)
+        except Exception as e:
+            logger.warning(f"Ошибка очистки обработанных апдейтов: {e}")
+        await asyncio.sleep(3600)
+
+# Воркер: обработчики и хранилище как у обычного бота, апдейты — только от роутера
+async def run_worker(application):
+    port = WORKER_BASE_PORT + WORKER_INDEX
+    await application.initialize()
+    if application.post_init:
+        await application.post_init(application)
+    await application.start()
+    if WORKER_INDEX == 0:
+        application.create_task(prune_processed_updates_loop())
+    processed = ProcessedUpdates(application)
+    server = await asyncio.start_server(
+        lambda reader, writer: handle_worker_request(application, processed, reader, writer), WORKER_HOST, port
+    )
+    logger.info(f"Воркер {WORKER_INDEX + 1}/{WORKER_COUNT} принимает апдейты на {WORKER_HOST}:{port}")
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        await application.stop()
+        await application.shutdown()
+
+class UpdateRouter:
+    """Единственный получатель апдейтов в многопроцессном режиме: раздаёт их воркерам по shard_for.
+
+    У каждого шарда своя очередь и свой отправитель: апдейты одного пользователя идут по порядку,
+    а недоступный воркер задерживает только свой шард. Апдейт считается доставленным, когда воркер
+    его обработал (ответ 200); при ошибке соединения или 5xx он повторяется, пока воркер не поднимется.
+    offset подтверждается Telegram, как только пачка разложена по очередям: неподтверждённые
+    воркерами апдейты живут в памяти роутера и теряются только при падении самого роутера.
+    Ответы 4xx (неверный секрет, адрес, тело) — ошибка конфигурации, такой апдейт не повторяется.
+    """
+
+    POLL_TIMEOUT = 30
+    # Воркер отвечает после обработки апдейта: с запасом на медленные обработчики
+    FORWARD_TIMEOUT = 120
+
+    def __init__(self, bot, count):
+        self.bot = bot
+        self.urls = [f"http://{WORKER_HOST}:{WORKER_BASE_PORT + index}/update" for index in range(count)]
+        self.headers = {'Content-Type': 'application/json', 'X-Worker-Secret': worker_secret()}
+        self.queues = [asyncio.Queue() for _ in range(count)]
+        self.client = None
+
+    # Доставка одного апдейта; False — воркер отверг его окончательно (4xx)
+    async def deliver(self, shard, update):
+        delay = 0.5
+        while True:
+            try:
+                response = await self.client.post(self.urls[shard], content=update.to_json(), headers=self.headers)
+                if response.status_code == 200:
+                    return True
+                if 400 <= response.status_code < 500:
+                    logger.error(f"Воркер {shard} отверг апдейт {update.update_id}: {response.status_code}, апдейт пропущен")
+                    return False
+                logger.warning(f"Воркер {shard} ответил {response.status_code} на апдейт {update.update_id}, повтор через {delay:.1f} с")
+            except httpx.HTTPError as e:
+                logger.warning(f"Воркер {shard} недоступен ({e!r}), повтор через {delay:.1f} с")
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 10)
+
+    async def forward(self, shard):
+        queue = self.queues[shard]
+        while True:
+            update = await queue.get()
+            try:
+                await self.deliver(shard, update)
+            finally:
+                queue.task_done()
+
+    async def run(self):
+        offset = None
+        async with self.bot, httpx.AsyncClient(timeout=httpx.Timeout(10, read=self.FORWARD_TIMEOUT)) as client:
+            self.client = client
+            await self.bot.delete_webhook()
+            forwarders = [asyncio.create_task(self.forward(shard)) for shard in range(len(self.urls))]
+            logger.info(f"Роутер запущен: воркеров {len(self.urls)}")
+            try:
+                while True:
+                    try:
+                        updates = await self.bot.get_updates(
+                            offset=offset, timeout=self.POLL_TIMEOUT, read_timeout=self.POLL_TIMEOUT + 10,
+                            allowed_updates=Update.ALL_TYPES
+                        )
+                    except RetryAfter as e:
+                        await asyncio.sleep(e.retry_after)
+                        continue
+                    except (TimedOut, NetworkError) as e:
+                        logger.warning(f"Ошибка getUpdates: {e}")
+                        await asyncio.sleep(1)
+                        continue
+                    for update in updates:
+                        self.queues[shard_for(update, len(self.urls))].put_nowait(update)
+                    if updates:
+                        offset = updates[-1].update_id + 1
+            finally:
+                for task in forwarders:
+                    task.cancel()
+
+# Обработчики бота (общие для запуска и нагрузочного теста load_test.py)
+def register_handlers(application):
     application.add_handler(CommandHandler("start", start))
     application.add_handler(CommandHandler("admin", admin_command))
+    application.add_handler(CommandHandler("profile", profile_command))
     application.add_handler(CallbackQueryHandler(button_callback))
     application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
     application.add_handler(MessageHandler(filters.Document.ALL, handle_document))
     application.add_handler(PreCheckoutQueryHandler(precheckout_handler))
     application.add_handler(MessageHandler(filters.SUCCESSFUL_PAYMENT, successful_payment_handler))
+
+if __name__ == "__main__":
+    init_db()
+    persistence = DatabasePersistence(
+        update_interval=PERSISTENCE_FLUSH_INTERVAL,
+        idle_timeout=PERSISTENCE_IDLE_TIMEOUT
+    )
+    application = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .application_class(TracedApplication)
+        .request(TracedRequest(connection_pool_size=256))
+        .persistence(persistence)
+        .post_init(post_init)
+        .build()
+    )
+    register_handlers(application)
     
-    logger.info("Бот запущен")
-    application.run_polling()
+    if BOT_ROLE == 'router':
+        # Роутер только пересылает апдейты: обработчики и состояние диалогов живут в воркерах
+        asyncio.run(UpdateRouter(application.bot, WORKER_COUNT).run())
+    elif BOT_ROLE == 'worker':
+        asyncio.run(run_worker(application))
+    else:
+        logger.info("Бот запущен")
+        application.run_polling()